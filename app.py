@@ -1,15 +1,62 @@
 import os
 import re
+import csv
+import difflib
+import json
+import gzip
+import time
+import codecs
+import hashlib
+import mimetypes
 import uuid
+import bisect
+import random
+import threading
+import concurrent.futures
+import zlib
+import queue
+import atexit
+import gc
 from io import BytesIO
-from datetime import datetime
-from collections import defaultdict
+from datetime import datetime, timedelta
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+import multiprocessing
+
+import click
 
 from flask import (
-    Flask, render_template_string, request, redirect,
-    url_for, session, send_file, send_from_directory
+    Flask, request, redirect,
+    url_for, session, send_file, send_from_directory, abort,
+    g, has_request_context, before_render_template, template_rendered, jsonify
 )
-from werkzeug.utils import secure_filename
+from markupsafe import Markup
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import secure_filename, safe_join
+
+# (opcjonalne) brotli – bez niego odpowiedzi są kompresowane gzipem
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# (opcjonalne) orjson – szybsza serializacja odpowiedzi API; bez niego json ze stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# (opcjonalne) zstandard – lepsza kompresja archiwum; bez niego zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# (opcjonalne) Pillow – bez niego logo zapisywane jest bez przeskalowania
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
 
 # (opcjonalne) torch – nie wymagane do działania
 try:
@@ -19,6 +66,8 @@ try:
 except Exception:
     print("Używane urządzenie: cpu (torch niedostępny)")
 
+import numpy as np
+
 # NLP (opcjonalne)
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
@@ -31,6 +80,10 @@ from docx.oxml.ns import qn
 
 # DB
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import delete, event, func, insert, select, union_all
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.schema import CreateTable
 from werkzeug.security import generate_password_hash, check_password_hash
 
 # -----------------------------------------------------------------------------
@@ -38,7 +91,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 # -----------------------------------------------------------------------------
 app = Flask(__name__, static_folder="static")
 app.secret_key = os.environ.get("SECRET_KEY", "change-me")
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///lotti.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///lotti.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db = SQLAlchemy(app)
 
@@ -49,11 +102,11 @@ class User(db.Model):
     __tablename__ = 'user'
     id            = db.Column(db.Integer, primary_key=True)
     username      = db.Column(db.String(64), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128), nullable=False)
+    password_hash = db.Column(db.String(256), nullable=False)   # scrypt: ~160 znaków
     cabinets      = db.relationship('Cabinet', backref='owner', lazy=True)
 
     def set_password(self, pwd):
-        self.password_hash = generate_password_hash(pwd)
+        self.password_hash = generate_password_hash(pwd, method=PASSWORD_HASH_METHOD)
 
     def check_password(self, pwd):
         return check_password_hash(self.password_hash, pwd)
@@ -79,6 +132,8 @@ class Cabinet(db.Model):
     id           = db.Column(db.Integer, primary_key=True)
     name         = db.Column(db.String(128), nullable=False)
     logo         = db.Column(db.String(256))
+    logo_docx    = db.Column(db.String(256))   # wariant osadzany w DOCX
+    logo_thumb   = db.Column(db.String(256))   # miniatura do panelu WWW
     doctor_name  = db.Column(db.String(128))
     street       = db.Column(db.String(128))
     flat_number  = db.Column(db.String(16))
@@ -112,6 +167,53 @@ class CodeDuration(db.Model):
     code    = db.relationship('ProcedureCode')
 
 
+class Chair(db.Model):
+    """Fotel (stanowisko) gabinetu – godziny pracy w ChairAvailability."""
+    __tablename__ = 'chair'
+    id         = db.Column(db.Integer, primary_key=True)
+    cabinet_id = db.Column(db.Integer, db.ForeignKey('cabinet.id'), nullable=False, index=True)
+    name       = db.Column(db.String(64), nullable=False)
+    doctor     = db.Column(db.String(128))
+    active     = db.Column(db.Boolean, nullable=False, default=True)
+
+    availability = db.relationship('ChairAvailability', backref='chair', lazy=True, cascade="all, delete-orphan")
+
+
+class ChairAvailability(db.Model):
+    """Tygodniowy szablon godzin pracy fotela: dzień tygodnia (0 = poniedziałek) i minuty doby."""
+    __tablename__ = 'chair_availability'
+    id           = db.Column(db.Integer, primary_key=True)
+    chair_id     = db.Column(db.Integer, db.ForeignKey('chair.id'), nullable=False, index=True)
+    weekday      = db.Column(db.Integer, nullable=False)
+    start_minute = db.Column(db.Integer, nullable=False)
+    end_minute   = db.Column(db.Integer, nullable=False)
+
+
+class Booking(db.Model):
+    __tablename__ = 'booking'
+    id         = db.Column(db.Integer, primary_key=True)
+    chair_id   = db.Column(db.Integer, db.ForeignKey('chair.id'), nullable=False)
+    start      = db.Column(db.DateTime, nullable=False)   # czas lokalny gabinetu
+    end        = db.Column(db.DateTime, nullable=False)
+    plan_id    = db.Column(db.Integer)
+    visit_idx  = db.Column(db.Integer)
+    label      = db.Column(db.String(256))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    __table_args__ = (db.Index('ix_booking_chair_start', 'chair_id', 'start', 'end'),)
+
+
+class CodeDurationRollup(db.Model):
+    """Zagregowana stara historia CodeDuration: liczba wystąpień każdego czasu per kod.
+    Histogram (a nie średnia) pozwala liczyć średnią obciętą dokładnie jak z surowych wierszy."""
+    __tablename__ = 'code_duration_rollup'
+    cabinet_id      = db.Column(db.Integer, db.ForeignKey('cabinet.id'), primary_key=True)
+    procedure_code  = db.Column(db.String(16), primary_key=True)
+    duration        = db.Column(db.Integer, primary_key=True)
+    count           = db.Column(db.Integer, nullable=False)
+    last_timestamp  = db.Column(db.DateTime)
+
+
 class GeneratedPlan(db.Model):
     __tablename__ = "generated_plan"
     id         = db.Column(db.Integer, primary_key=True)
@@ -121,15 +223,206 @@ class GeneratedPlan(db.Model):
     plan_text  = db.Column(db.Text,   nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+    # hash sparsowanego wejścia + wersja cennika gabinetu – ponowne wysłanie tej samej
+    # karty trafia w istniejący wiersz (NULL dla planów sprzed deduplikacji)
+    input_hash      = db.Column(db.String(64))
+    pricing_version = db.Column(db.String(16))
+
     user    = db.relationship('User', backref='generated_plans')
     cabinet = db.relationship('Cabinet', backref='generated_plans')
 
+    __table_args__ = (
+        db.Index('ux_generated_plan_dedupe', 'user_id', 'cabinet_id', 'input_hash', 'pricing_version',
+                 unique=True),
+        # id planu żyje dalej w archiwum, plan_stat, plan_revision i maskach zębów –
+        # SQLite bez AUTOINCREMENT nadałby id usuniętego/zarchiwizowanego planu ponownie
+        {"sqlite_autoincrement": True},
+    )
+
+    is_archived = False
+
+
+class PlanToothMask(db.Model):
+    """Zęby planu per kategoria jako maska bitowa (32 zęby stałe FDI, bit = tooth_bit).
+    plan_id bez klucza obcego – maski zostają też dla planów przeniesionych do archiwum."""
+    __tablename__ = 'plan_tooth_mask'
+    plan_id    = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    category   = db.Column(db.String(128), primary_key=True)
+    user_id    = db.Column(db.Integer, nullable=False)
+    cabinet_id = db.Column(db.Integer, nullable=False)
+    mask       = db.Column(db.BigInteger, nullable=False)
+
+    # indeks pokrywający w kolejności plan_id: najnowsze plany czytane wstecz po indeksie,
+    # predykat bitowy sprawdzany na wpisach indeksu, skan kończy się po LIMIT trafieniach
+    __table_args__ = (db.Index('ix_plan_tooth_mask_user', 'user_id', 'category', 'plan_id', 'mask'),)
+
+
+class ArchivedPlan(db.Model):
+    """Plan przeniesiony z generated_plan przez `flask archive` – treść skompresowana."""
+    __tablename__ = 'generated_plan_archive'
+    id              = db.Column(db.Integer, primary_key=True, autoincrement=False)  # id z generated_plan
+    user_id         = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    cabinet_id      = db.Column(db.Integer, db.ForeignKey('cabinet.id'), nullable=False)
+    created_at      = db.Column(db.DateTime, nullable=False)
+    archived_at     = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    input_preview   = db.Column(db.String(200), nullable=False)  # lista /plans bez dekompresji
+    input_hash      = db.Column(db.String(64))
+    pricing_version = db.Column(db.String(16))
+    codec           = db.Column(db.String(8), nullable=False)
+    input_blob      = db.Column(db.LargeBinary, nullable=False)
+    plan_blob       = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (db.Index('ix_generated_plan_archive_user', 'user_id', 'created_at'),)
+
+    def to_plan(self):
+        """Nietrwały GeneratedPlan z rozpakowaną treścią (nie jest dodawany do sesji)."""
+        plan = GeneratedPlan(
+            id=self.id, user_id=self.user_id, cabinet_id=self.cabinet_id, created_at=self.created_at,
+            input_data=decompress_text(self.input_blob, self.codec),
+            plan_text=decompress_text(self.plan_blob, self.codec),
+            input_hash=self.input_hash, pricing_version=self.pricing_version,
+        )
+        plan.is_archived = True
+        return plan
+
+
+class PlanRevision(db.Model):
+    """Wersja planu z historii edycji: pełny zrzut albo delta względem wersji poprzedniej."""
+    __tablename__ = 'plan_revision'
+    id         = db.Column(db.Integer, primary_key=True)
+    plan_id    = db.Column(db.Integer, nullable=False)   # bez FK – plan może leżeć w archiwum
+    user_id    = db.Column(db.Integer, nullable=False)
+    rev        = db.Column(db.Integer, nullable=False)   # 1 = treść sprzed pierwszej edycji
+    created_at = db.Column(db.DateTime, nullable=False)
+    snapshot   = db.Column(db.Boolean, nullable=False)
+    codec      = db.Column(db.String(8), nullable=False)
+    input_blob = db.Column(db.LargeBinary, nullable=False)
+    plan_blob  = db.Column(db.LargeBinary, nullable=False)
+
+    __table_args__ = (db.Index('ux_plan_revision', 'plan_id', 'rev', unique=True),)
+
+
+class PlanStat(db.Model):
+    """Wkład planu w agregaty practice_stat – odejmowany przy edycji i usunięciu planu."""
+    __tablename__ = 'plan_stat'
+    plan_id    = db.Column(db.Integer, primary_key=True, autoincrement=False)   # bez FK – jak plan_revision
+    cabinet_id = db.Column(db.Integer, nullable=False)
+    month      = db.Column(db.String(7), nullable=False)    # "RRRR-MM" z created_at planu
+    data       = db.Column(db.Text, nullable=False)         # JSON z plan_stats()
+
+
+class PracticeStat(db.Model):
+    """Zmaterializowane agregaty gabinetu per miesiąc: dimension "plan" (key ""),
+    "category" (count = zęby, amount = przychód) i "procedure" (kod procedury)."""
+    __tablename__ = 'practice_stat'
+    cabinet_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    month      = db.Column(db.String(7), primary_key=True)
+    dimension  = db.Column(db.String(16), primary_key=True)
+    key        = db.Column(db.String(128), primary_key=True)
+    count      = db.Column(db.Integer, nullable=False, default=0)
+    amount     = db.Column(db.Float, nullable=False, default=0)
+
 # -----------------------------------------------------------------------------
 # STATIC / UPLOADS
 # -----------------------------------------------------------------------------
 UPLOAD_FOLDER = os.path.join(app.static_folder, 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Logo jest przetwarzane raz, przy wysyłce: oryginał + wariant do DOCX (1.5" przy ~300 dpi)
+# + miniatura do tabeli gabinetów. Nazwy plików to hash treści oryginału, więc to samo
+# logo wgrane wielokrotnie (także przez różnych użytkowników) leży na dysku raz.
+LOGO_DOCX_MAX_PX  = int(os.environ.get("LOGO_DOCX_MAX_PX", "600"))
+LOGO_THUMB_MAX_PX = int(os.environ.get("LOGO_THUMB_MAX_PX", "160"))
+LOGO_JPEG_QUALITY = int(os.environ.get("LOGO_JPEG_QUALITY", "85"))
+LOGO_EXTENSIONS   = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp", ".tif", ".tiff", ".svg"}
+
+
+def _has_alpha(img):
+    return img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+
+
+def _write_once(filename, data):
+    path = os.path.join(UPLOAD_FOLDER, filename)
+    if not os.path.exists(path):
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+    return filename
+
+
+def _logo_variant(img, max_px):
+    """Przeskalowana kopia: PNG, gdy logo ma przezroczystość, w przeciwnym razie JPEG."""
+    img = img.copy()
+    img.thumbnail((max_px, max_px), Image.LANCZOS)
+    out = BytesIO()
+    if _has_alpha(img):
+        img.convert("RGBA").save(out, "PNG", optimize=True)
+        return out.getvalue(), ".png"
+    img.convert("RGB").save(out, "JPEG", quality=LOGO_JPEG_QUALITY, optimize=True, progressive=True)
+    return out.getvalue(), ".jpg"
+
+
+def store_logo(data, filename="", original=None):
+    """Zapisuje logo i jego warianty; zwraca dict z nazwami plików dla kolumn Cabinet.
+
+    original: nazwa już zapisanego oryginału – nie jest zapisywany ponownie, powstają tylko warianty.
+    """
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    ext = os.path.splitext(secure_filename(filename))[1].lower()
+    if ext not in LOGO_EXTENSIONS:
+        ext = ""
+    if original is None:
+        original = _write_once(f"{digest}{ext}", data)
+    names = {"logo": original, "logo_docx": None, "logo_thumb": None}
+    if Image is None:
+        return names
+
+    try:
+        with Image.open(BytesIO(data)) as img:
+            # JPEG dekodowany od razu w zmniejszonej skali – duże zdjęcia nie trafiają do RAM w całości
+            img.draft("RGB", (LOGO_DOCX_MAX_PX, LOGO_DOCX_MAX_PX))
+            img = ImageOps.exif_transpose(img)
+            img.load()
+    except Exception:
+        # format nieobsługiwany przez Pillow (np. SVG) – zostaje sam oryginał
+        return names
+
+    for column, suffix, max_px in (("logo_docx", "docx", LOGO_DOCX_MAX_PX),
+                                   ("logo_thumb", "thumb", LOGO_THUMB_MAX_PX)):
+        # warianty mają deterministyczne nazwy – przy duplikacie pomijamy ponowne kodowanie
+        existing = [f"{digest}_{suffix}{e}" for e in (".png", ".jpg")
+                    if os.path.exists(os.path.join(UPLOAD_FOLDER, f"{digest}_{suffix}{e}"))]
+        if existing:
+            names[column] = existing[0]
+            continue
+        variant, vext = _logo_variant(img, max_px)
+        names[column] = _write_once(f"{digest}_{suffix}{vext}", variant)
+    return names
+
+
+def process_logo_upload(file_storage):
+    """Logo z formularza -> dict(logo, logo_docx, logo_thumb) lub None, gdy pola nie wysłano."""
+    if not file_storage or not file_storage.filename:
+        return None
+    return store_logo(file_storage.read(), file_storage.filename)
+
+
+@app.cli.command("rebuild-logos")
+def rebuild_logos_command():
+    """Generuje warianty DOCX/miniatury dla gabinetów z logo wgranym przed ich wprowadzeniem."""
+    done = 0
+    for cab in Cabinet.query.filter(Cabinet.logo.isnot(None), Cabinet.logo_docx.is_(None)):
+        path = os.path.join(UPLOAD_FOLDER, cab.logo)
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as fh:
+            names = store_logo(fh.read(), cab.logo, original=cab.logo)
+        cab.logo_docx, cab.logo_thumb = names["logo_docx"], names["logo_thumb"]
+        done += 1
+    db.session.commit()
+    click.echo(f"Przetworzono logo: {done}")
+
 # -----------------------------------------------------------------------------
 # SZABLONY (pełne)
 # -----------------------------------------------------------------------------
@@ -139,7 +432,7 @@ login_template = """
 <head>
   <meta charset="utf-8">
   <title>Panel Logowania</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
+  {{ vendor_css() }}
 </head>
 <body class="p-4">
   <div class="container" style="max-width:480px">
@@ -167,46 +460,8 @@ cabinets_template = """
   <meta charset="utf-8">
   <title>AdminLotti – Gabinety</title>
 
-  <!-- Bootstrap CSS -->
-  <link
-    href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css"
-    rel="stylesheet">
-
-  <!-- FontAwesome -->
-  <link
-    href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1/css/all.min.css"
-    rel="stylesheet">
-
-  <style>
-    body {
-      background: #f0f4f8;
-      color: #33475b;
-      padding-top: 1rem;
-      padding-bottom: 2rem;
-    }
-    .navbar {
-      background: #ffffffcc;
-      box-shadow: 0 2px 8px rgba(0,0,0,0.05);
-      backdrop-filter: blur(10px);
-    }
-    .navbar-brand, .nav-link {
-      color: #33475b !important;
-      font-weight: 500;
-    }
-    .btn-rounded {
-      border-radius: 50px;
-      padding: .5rem 1.25rem;
-      transition: all .2s ease-in-out;
-    }
-    .btn-rounded:hover {
-      transform: translateY(-2px);
-    }
-    .card-custom {
-      border: none;
-      border-radius: .75rem;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-    }
-  </style>
+  {{ vendor_css() }}
+  <link href="{{ url_for('static', filename='lotti.css') }}" rel="stylesheet">
 </head>
 
 <body>
@@ -244,8 +499,8 @@ cabinets_template = """
                 <td>{{ c.name }}</td>
                 <td>
                   {% if c.logo %}
-                    <img src="{{ url_for('static', filename='uploads/' ~ c.logo) }}"
-                         class="img-fluid rounded" style="max-height:40px;">
+                    <img src="{{ url_for('static', filename='uploads/' ~ (c.logo_thumb or c.logo)) }}"
+                         class="img-fluid rounded" style="max-height:40px;" loading="lazy">
                   {% endif %}
                 </td>
                 <td>
@@ -307,8 +562,7 @@ cabinets_template = """
     </div>
   </div>
 
-  <!-- Bootstrap JS Bundle -->
-  <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+  {{ vendor_js() }}
 </body>
 </html>
 """
@@ -320,46 +574,8 @@ treatments_template = """
   <meta charset="utf-8">
   <title>Zabiegi gabinetu</title>
 
-  <!-- Bootstrap CSS -->
-  <link
-    href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css"
-    rel="stylesheet">
-
-  <!-- FontAwesome -->
-  <link
-    href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1/css/all.min.css"
-    rel="stylesheet">
-
-  <style>
-    body {
-      background: #f0f4f8;
-      color: #33475b;
-      padding-top: 1rem;
-      padding-bottom: 2rem;
-    }
-    .navbar {
-      background: #ffffffcc;
-      box-shadow: 0 2px 8px rgba(0,0,0,0.05);
-      backdrop-filter: blur(10px);
-    }
-    .navbar-brand, .nav-link {
-      color: #33475b !important;
-      font-weight: 500;
-    }
-    .btn-rounded {
-      border-radius: 50px;
-      padding: .5rem 1.25rem;
-      transition: all .2s ease-in-out;
-    }
-    .btn-rounded:hover {
-      transform: translateY(-2px);
-    }
-    .card-custom {
-      border: none;
-      border-radius: .75rem;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-    }
-  </style>
+  {{ vendor_css() }}
+  <link href="{{ url_for('static', filename='lotti.css') }}" rel="stylesheet">
 </head>
 
 <body>
@@ -385,6 +601,13 @@ treatments_template = """
         {% if message %}
           <div class="alert alert-success">{{ message }}</div>
         {% endif %}
+        {% if import_errors %}
+          <div class="alert alert-warning">
+            <ul class="mb-0">
+              {% for e in import_errors %}<li>{{ e }}</li>{% endfor %}
+            </ul>
+          </div>
+        {% endif %}
 
         <table class="table align-middle">
           <thead class="table-light">
@@ -496,10 +719,29 @@ treatments_template = """
         </form>
       </div>
     </div>
+
+    <!-- Import historii czasów -->
+    <div class="card card-custom mt-4">
+      <div class="card-body">
+        <h5 class="card-title"><i class="fa-solid fa-file-import me-2"></i>Import historii czasów (CSV / JSONL)</h5>
+        <p class="text-muted small mb-3">
+          CSV z nagłówkiem <code>procedure_code,duration[,timestamp]</code> lub JSONL z tymi samymi polami.
+          Kody procedur muszą istnieć w katalogu, timestamp w formacie ISO 8601.
+        </p>
+        <form method="post" enctype="multipart/form-data"
+              action="{{ url_for('import_durations', cabinet_id=cabinet.id) }}">
+          <div class="input-group">
+            <input type="file" name="file" class="form-control" accept=".csv,.jsonl,.ndjson,text/csv" required>
+            <button type="submit" class="btn btn-outline-primary">
+              <i class="fa-solid fa-upload me-1"></i>Importuj
+            </button>
+          </div>
+        </form>
+      </div>
+    </div>
   </div>
 
-  <!-- Bootstrap JS Bundle -->
-  <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+  {{ vendor_js() }}
 </body>
 </html>
 """
@@ -511,52 +753,11 @@ edit_treatment_template = """
   <meta charset="utf-8">
   <title>Edytuj zabieg</title>
 
-  <!-- Bootstrap CSS -->
-  <link
-    href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css"
-    rel="stylesheet">
-
-  <!-- FontAwesome -->
-  <link
-    href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1/css/all.min.css"
-    rel="stylesheet">
-
-  <style>
-    body {
-      background: #f0f4f8;
-      color: #33475b;
-      padding-top: 1rem;
-      padding-bottom: 2rem;
-    }
-    .navbar {
-      background: #ffffffcc;
-      box-shadow: 0 2px 8px rgba(0,0,0,0.05);
-      backdrop-filter: blur(10px);
-    }
-    .navbar-brand, .nav-link {
-      color: #33475b !important;
-      font-weight: 500;
-    }
-    .btn-rounded {
-      border-radius: 50px;
-      padding: .5rem 1.25rem;
-      transition: all .2s ease-in-out;
-    }
-    .btn-rounded:hover {
-      transform: translateY(-2px);
-    }
-    .card-custom {
-      border: none;
-      border-radius: .75rem;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-    }
-    .form-label {
-      font-weight: 500;
-    }
-  </style>
+  {{ vendor_css() }}
+  <link href="{{ url_for('static', filename='lotti.css') }}" rel="stylesheet">
 </head>
 
-<body>
+<body class="page-edit">
  <!-- Navbar -->
 <nav class="navbar navbar-expand-lg sticky-top mb-4">
   <div class="container">
@@ -612,8 +813,7 @@ edit_treatment_template = """
     </div>
   </div>
 
-  <!-- Bootstrap JS Bundle -->
-  <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+  {{ vendor_js() }}
 </body>
 </html>
 """
@@ -624,56 +824,8 @@ durations_template = """
   <meta charset="utf-8">
   <title>Dodaj czas wizyty</title>
 
-  <!-- Bootstrap CSS -->
-  <link
-    href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css"
-    rel="stylesheet">
-
-  <!-- FontAwesome -->
-  <link
-    href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1/css/all.min.css"
-    rel="stylesheet">
-
-  <style>
-    body {
-      background: #f0f4f8;
-      color: #33475b;
-      padding-top: 1rem;
-      padding-bottom: 2rem;
-    }
-    .navbar {
-      background: #ffffffcc;
-      box-shadow: 0 2px 8px rgba(0,0,0,0.05);
-      backdrop-filter: blur(10px);
-    }
-    .navbar-brand, .nav-link {
-      color: #33475b !important;
-      font-weight: 500;
-    }
-    .card-custom {
-      border: none;
-      border-radius: .75rem;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-    }
-    .btn-rounded {
-      border-radius: 50px;
-      padding: .5rem 1.25rem;
-      transition: all .2s ease-in-out;
-    }
-    .btn-rounded:hover {
-      transform: translateY(-2px);
-    }
-
-    /* Kontener na tabelę historii – ograniczona wysokość, przewijalność */
-    .history-container {
-      max-height: 250px;
-      overflow-y: auto;
-      margin-bottom: 1rem;
-    }
-    .history-container table {
-      margin-bottom: 0;
-    }
-  </style>
+  {{ vendor_css() }}
+  <link href="{{ url_for('static', filename='lotti.css') }}" rel="stylesheet">
 </head>
 
 <body>
@@ -715,7 +867,7 @@ durations_template = """
                 <tr>
                   <td>{{ group.category }}</td>
                   <td>{{ group.procedure_code }}</td>
-                  <td>{{ group.durations | join(', ') }} min</td>
+                  <td>{{ group.durations | join(', ') }} min{% if group.archived %} <span class="text-muted">(+{{ group.archived }} w archiwum)</span>{% endif %}</td>
                   <td>{{ group.optimal }} min</td>
                 </tr>
               {% endfor %}
@@ -791,10 +943,7 @@ durations_template = """
     </div>
   </div>
 
-  <!-- Bootstrap JS Bundle -->
-  <script
-    src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js">
-  </script>
+  {{ vendor_js() }}
   <script>
     function addField() {
       const container = document.getElementById('times');
@@ -818,67 +967,11 @@ main_template = """<!doctype html>
   <meta charset="utf-8">
   <title>ChatLotti – Generowanie planu leczenia</title>
 
-  <!-- 1. Bootstrap CSS -->
-  <link
-    href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css"
-    rel="stylesheet">
-
-  <!-- 2. Ikony -->
-  <link
-    href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1/css/all.min.css"
-    rel="stylesheet">
-
-  <style>
-    body {
-      background: #f0f4f8;
-      color: #33475b;
-      padding-top: 1rem;
-      padding-bottom: 2rem;
-    }
-    .navbar {
-      background: #ffffffcc;
-      box-shadow: 0 2px 8px rgba(0,0,0,0.05);
-      backdrop-filter: blur(10px);
-    }
-    .navbar-brand, .nav-link {
-      color: #33475b !important;
-      font-weight: 500;
-    }
-    .hero {
-      background: linear-gradient(135deg, #3b8beb 0%, #6fa4ff 100%);
-      color: #fff;
-      padding: 2.5rem;
-      border-radius: .75rem;
-      box-shadow: 0 4px 15px rgba(0,0,0,0.1);
-      text-align: center;
-      margin-bottom: 2rem;
-    }
-    .btn-rounded {
-      border-radius: 50px;
-      padding: .75rem 1.5rem;
-      box-shadow: 0 2px 6px rgba(0, 0, 0, 0.15);
-      transition: all .2s ease-in-out;
-    }
-    .btn-rounded:hover {
-      transform: translateY(-2px);
-      box-shadow: 0 4px 12px rgba(0, 0, 0, 0.2);
-    }
-    .card-custom {
-      border: none;
-      border-radius: .75rem;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-    }
-    pre.plan {
-      background: #e9ecef;
-      border-radius: .5rem;
-      padding: 1rem;
-      font-family: monospace;
-      white-space: pre-wrap;
-    }
-  </style>
+  {{ vendor_css() }}
+  <link href="{{ url_for('static', filename='lotti.css') }}" rel="stylesheet">
 </head>
 
-<body>
+<body class="page-plan">
   <!-- Navbar -->
   <nav class="navbar navbar-expand-lg sticky-top mb-4">
     <div class="container">
@@ -996,35 +1089,15 @@ Koszt: {{ price_map.get(category,0)|int }} zł
       </h5>
       <ol class="ps-3">
         {% for v in visits %}
-          {% set h = v.minutes // 60 %}
-          {% set m = v.minutes % 60 %}
-
           {% if v.category == "Higienizacja" %}
             <li class="mb-3">
-              <strong>Wizyta {{ h }}h {{ m }}min</strong> – Higienizacja.
+              <strong>Wizyta {{ v.hours }}h {{ v.mins }}min</strong> – Higienizacja.
             </li>
           {% else %}
-            {% set teeth_list = v.teeth | join(' i ') %}
-            {% if v.category == "Odbudowa protetyczna - nakład" %}
-              {% set extra_lbl = " (odbudowa tymczasowa)" %}
-            {% else %}
-              {% set extra_lbl = "" %}
-            {% endif %}
-
-            {% if v.extra == 0 and v.count > 1 %}
-              {% set cost_desc = v.count ~ " x " ~ v.unit_price ~ " zł = " ~ v.base_cost ~ " zł" %}
-            {% else %}
-              {% set parts = [] %}
-              {% for tooth in v.teeth %}
-                {% set parts = parts + ["1 x " ~ v.unit_price ~ " zł"] %}
-              {% endfor %}
-              {% set cost_desc = parts | join(" + ") ~ " = " ~ v.base_cost ~ " zł" %}
-            {% endif %}
-
             <li class="mb-3">
-              <strong>Wizyta {{ h }}h {{ m }}min</strong>
-              – leczenie zęba {{ teeth_list }}{{ extra_lbl }}.
-              Przewidywany koszt wizyty to {{ cost_desc }}.
+              <strong>Wizyta {{ v.hours }}h {{ v.mins }}min</strong>
+              – leczenie zęba {{ v.teeth_label }}{{ v.extra_label }}.
+              Przewidywany koszt wizyty to {{ v.cost_desc }}.
             </li>
           {% endif %}
         {% endfor %}
@@ -1033,8 +1106,7 @@ Koszt: {{ price_map.get(category,0)|int }} zł
   </div>
 {% endif %}
 
-  <!-- Bootstrap JS Bundle -->
-  <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+  {{ vendor_js() }}
 </body>
 </html>
 """
@@ -1045,15 +1117,8 @@ plans_list_template = """
 <head>
   <meta charset="utf-8">
   <title>Wygenerowane plany</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
-  <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1/css/all.min.css" rel="stylesheet">
-  <style>
-    body { background: #f0f4f8; color: #33475b; padding-top: 1rem; padding-bottom: 2rem; }
-    .navbar { background: #ffffffcc; box-shadow: 0 2px 8px rgba(0,0,0,0.05); backdrop-filter: blur(10px); }
-    .btn-rounded { border-radius: 50px; padding: .5rem 1.25rem; transition: all .2s ease-in-out; }
-    .btn-rounded:hover { transform: translateY(-2px); }
-    .card-custom { border: none; border-radius: .75rem; box-shadow: 0 2px 10px rgba(0,0,0,0.05); }
-  </style>
+  {{ vendor_css() }}
+  <link href="{{ url_for('static', filename='lotti.css') }}" rel="stylesheet">
 </head>
 <body>
   <nav class="navbar navbar-expand-lg sticky-top mb-4">
@@ -1089,7 +1154,7 @@ plans_list_template = """
                 <tr>
                   <td>{{ loop.index }}</td>
                   <td>{{ p.created_at.strftime("%d.%m.%Y %H:%M:%S") }}</td>
-                  <td>{{ p.cabinet.name }}</td>
+                  <td>{{ p.cabinet_name }}</td>
                   <td style="max-width:200px; overflow:hidden; text-overflow:ellipsis; white-space:nowrap;">
                     {{ p.input_data }}
                   </td>
@@ -1098,6 +1163,10 @@ plans_list_template = """
                        class="btn btn-sm btn-primary btn-rounded me-1">
                       <i class="fa-solid fa-eye me-1"></i>Podgląd / Edytuj
                     </a>
+                    <a href="{{ url_for('download_saved_plan', plan_id=p.id) }}"
+                       class="btn btn-sm btn-outline-secondary btn-rounded me-1">
+                      <i class="fa-solid fa-download me-1"></i>.docx
+                    </a>
                     <form method="POST"
                           action="{{ url_for('delete_plan', plan_id=p.id) }}"
                           style="display:inline;"
@@ -1116,7 +1185,7 @@ plans_list_template = """
     </div>
   </div>
 
-  <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+  {{ vendor_js() }}
 </body>
 </html>
 """
@@ -1128,65 +1197,11 @@ plan_detail_template = """
   <meta charset="utf-8">
   <title>Podgląd / Edytuj plan leczenia</title>
 
-  <!-- Bootstrap CSS -->
-  <link
-    href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css"
-    rel="stylesheet">
-  <!-- FontAwesome -->
-  <link
-    href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1/css/all.min.css"
-    rel="stylesheet">
-  <style>
-    body {
-      background: #f0f4f8;
-      color: #33475b;
-      padding-top: 1rem;
-      padding-bottom: 2rem;
-    }
-    .navbar {
-      background: #ffffffcc;
-      box-shadow: 0 2px 8px rgba(0,0,0,0.05);
-      backdrop-filter: blur(10px);
-    }
-    .navbar-brand, .nav-link {
-      color: #33475b !important;
-      font-weight: 500;
-    }
-    .hero {
-      background: linear-gradient(135deg, #3b8beb 0%, #6fa4ff 100%);
-      color: #fff;
-      padding: 2.5rem;
-      border-radius: .75rem;
-      box-shadow: 0 4px 15px rgba(0,0,0,0.1);
-      text-align: center;
-      margin-bottom: 2rem.
-    }
-    .btn-rounded {
-      border-radius: 50px;
-      padding: .75rem 1.5rem;
-      box-shadow: 0 2px 6px rgba(0, 0, 0, 0.15);
-      transition: all .2s ease-in-out;
-    }
-    .btn-rounded:hover {
-      transform: translateY(-2px);
-      box-shadow: 0 4px 12px rgba(0, 0, 0, 0.2);
-    }
-    .card-custom {
-      border: none;
-      border-radius: .75rem;
-      box-shadow: 0 2px 10px rgba(0,0,0,0.05);
-    }
-    pre.plan {
-      background: #e9ecef;
-      border-radius: .5rem;
-      padding: 1rem;
-      font-family: monospace;
-      white-space: pre-wrap;
-    }
-  </style>
+  {{ vendor_css() }}
+  <link href="{{ url_for('static', filename='lotti.css') }}" rel="stylesheet">
 </head>
 
-<body>
+<body class="page-plan">
   <nav class="navbar navbar-expand-lg sticky-top mb-4">
     <div class="container">
       <a class="navbar-brand" href="/"><i class="fa-solid fa-tooth me-2"></i>ChatLotti</a>
@@ -1251,34 +1266,15 @@ Koszt: {{ price_map.get(category,0)|int }} zł
               </h5>
               <ol class="ps-3">
                 {% for v in visits %}
-                  {% set h = v.minutes // 60 %}
-                  {% set m = v.minutes % 60 %}
                   {% if v.category == "Higienizacja" %}
                     <li class="mb-3">
-                      <strong>Wizyta {{ h }}h {{ m }}min</strong> – Higienizacja.
+                      <strong>Wizyta {{ v.hours }}h {{ v.mins }}min</strong> – Higienizacja.
                     </li>
                   {% else %}
-                    {% set teeth_list = v.teeth | join(' i ') %}
-                    {% if v.category == "Odbudowa protetyczna - nakład" %}
-                      {% set extra_lbl = " (odbudowa tymczasowa)" %}
-                    {% else %}
-                      {% set extra_lbl = "" %}
-                    {% endif %}
-
-                    {% if v.extra == 0 and v.count > 1 %}
-                      {% set cost_desc = v.count ~ " x " ~ v.unit_price ~ " zł = " ~ v.base_cost ~ " zł" %}
-                    {% else %}
-                      {% set parts = [] %}
-                      {% for tooth in v.teeth %}
-                        {% set parts = parts + ["1 x " ~ v.unit_price ~ " zł"] %}
-                      {% endfor %}
-                      {% set cost_desc = parts | join(" + ") ~ " = " ~ v.base_cost ~ " zł" %}
-                    {% endif %}
-
                     <li class="mb-3">
-                      <strong>Wizyta {{ h }}h {{ m }}min</strong>
-                      – leczenie zęba {{ teeth_list }}{{ extra_lbl }}.
-                      Przewidywany koszt wizyty to {{ cost_desc }}.
+                      <strong>Wizyta {{ v.hours }}h {{ v.mins }}min</strong>
+                      – leczenie zęba {{ v.teeth_label }}{{ v.extra_label }}.
+                      Przewidywany koszt wizyty to {{ v.cost_desc }}.
                     </li>
                   {% endif %}
                 {% endfor %}
@@ -1288,42 +1284,78 @@ Koszt: {{ price_map.get(category,0)|int }} zł
         {% endif %}
 
         <div class="d-flex gap-2 mt-3">
-          <form method="POST" action="/download" style="margin-right:1rem;">
-            <input type="hidden" name="cabinet_id" value="{{ plan.cabinet_id }}">
-            <input type="hidden" name="input_data" value="{{ plan.input_data }}">
-            <button class="btn btn-outline-secondary btn-rounded">
-              <i class="fa-solid fa-download me-1"></i> Pobierz (.docx)
-            </button>
-          </form>
+          <a href="{{ url_for('download_saved_plan', plan_id=plan.id) }}"
+             class="btn btn-outline-secondary btn-rounded" style="margin-right:1rem;">
+            <i class="fa-solid fa-download me-1"></i> Pobierz (.docx)
+          </a>
         </div>
 
       </div>
     </div>
   </div>
 
-  <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
+  {{ vendor_js() }}
 </body>
 </html>
 """
+
+TEMPLATE_SOURCES = (
+    login_template, cabinets_template, treatments_template, edit_treatment_template,
+    durations_template, main_template, plans_list_template, plan_detail_template,
+)
+
+# flask.render_template_string kompiluje źródło przy każdym wywołaniu (Jinja nie
+# cache'uje from_string). Szablony są stałymi modułu, więc kompilujemy je raz na
+# proces – przy preload_app jeszcze w masterze, przed fork.
+_compiled_templates = {}
+
+
+def compiled_template(source):
+    template = _compiled_templates.get(source)
+    if template is None:
+        template = _compiled_templates[source] = app.jinja_env.from_string(source)
+    return template
+
+
+def render_template_string(source, **context):
+    """Jak flask.render_template_string (łącznie z sygnałami), ale ze skompilowanym szablonem."""
+    app.update_template_context(context)
+    template = compiled_template(source)
+    before_render_template.send(app, _async_wrapper=app.ensure_sync, template=template, context=context)
+    rv = template.render(context)
+    template_rendered.send(app, _async_wrapper=app.ensure_sync, template=template, context=context)
+    return rv
+
 # -----------------------------------------------------------------------------
 # POMOCNICZE / LOGIKA
 # -----------------------------------------------------------------------------
+SIMILARITY_CATEGORIES = (
+    "Mikroskopowe leczenie odtwórcze",
+    "Weryfikacja zębów po leczeniu kanałowym",
+    "Odbudowa protetyczna - nakład",
+    "Konsultacja implantologiczna celem odbudowy braku zęba",
+    "Gingiwoplastyka",
+)
+_similarity_model = None
+
+
+def similarity_model():
+    """Wektoryzator TF-IDF dopasowany raz na proces: (vectorizer, macierz kategorii)."""
+    global _similarity_model
+    if _similarity_model is None:
+        vect = TfidfVectorizer()
+        _similarity_model = (vect, vect.fit_transform(SIMILARITY_CATEGORIES))
+    return _similarity_model
+
+
 def analyze_treatment_similarity(input_text: str):
-    cats = [
-        "Mikroskopowe leczenie odtwórcze",
-        "Weryfikacja zębów po leczeniu kanałowym",
-        "Odbudowa protetyczna - nakład",
-        "Konsultacja implantologiczna celem odbudowy braku zęba",
-        "Gingiwoplastyka"
-    ]
     try:
-        vect = TfidfVectorizer()
-        std = vect.fit_transform(cats)
+        vect, std = similarity_model()
         inp = vect.transform([input_text or ""])
         sims = cosine_similarity(inp, std)
-        return dict(zip(cats, sims[0]))
+        return dict(zip(SIMILARITY_CATEGORIES, sims[0]))
     except Exception:
-        return {c: 0.0 for c in cats}
+        return {c: 0.0 for c in SIMILARITY_CATEGORIES}
 
 def parse_gingi_range(txt: str):
     m = re.search(r'(\d{2})\s*-\s*(\d{2})', txt)
@@ -1333,56 +1365,64 @@ def parse_gingi_range(txt: str):
     raw = [f"{i:02d}" for i in range(a, b + 1)]
     return [code for code in raw if re.match(r'^[1-4][1-8]$', code)]
 
-def parse_input(text: str):
+_GINGI_CONT_RE = re.compile(r"^\d{2}\s*-\s*\d{2}$|^\d{2}$")
+
+def split_segments(text: str):
+    """Tokeny karty w segmentach parsowanych niezależnie od reszty karty:
+    pojedynczy wpis albo „gingi …” razem z następującymi po nim zakresami/numerami."""
     tokens = re.split(r",\s*", (text or "").strip())
-    parsed = []
     i = 0
     while i < len(tokens):
         entry = tokens[i].strip()
         if not entry:
             i += 1
             continue
+        j = i + 1
         if entry.lower().startswith("gingi"):
-            rest = entry[len("gingi"):].strip()
-            gingi_tokens = []
-            if rest:
-                gingi_tokens.append(rest)
-            j = i + 1
-            while j < len(tokens):
-                cand = tokens[j].strip()
-                if re.match(r"^\d{2}\s*-\s*\d{2}$", cand) or re.match(r"^\d{2}$", cand):
-                    gingi_tokens.append(cand)
-                    j += 1
-                else:
-                    break
-            for tok in gingi_tokens:
-                tok = tok.strip()
-                if "-" in tok:
-                    for code in parse_gingi_range(f"gingi {tok}"):
-                        parsed.append({
-                            "tooth_code": code,
-                            "treatment_code": "Gingiwoplastyka",
-                            "procedure_code": f"{code} Gingiwoplastyka"
-                        })
-                else:
-                    code = tok.zfill(2)
+            while j < len(tokens) and _GINGI_CONT_RE.match(tokens[j].strip()):
+                j += 1
+        yield tuple(tokens[i:j])
+        i = j
+
+def parse_segment(segment):
+    entry = segment[0].strip()
+    parsed = []
+    if entry.lower().startswith("gingi"):
+        rest = entry[len("gingi"):].strip()
+        gingi_tokens = [rest] if rest else []
+        gingi_tokens.extend(segment[1:])
+        for tok in gingi_tokens:
+            tok = tok.strip()
+            if "-" in tok:
+                for code in parse_gingi_range(f"gingi {tok}"):
                     parsed.append({
                         "tooth_code": code,
                         "treatment_code": "Gingiwoplastyka",
                         "procedure_code": f"{code} Gingiwoplastyka"
                     })
-            i = j
-            continue
-        m = re.match(r"(\d{2})\s*(.+)", entry)
-        if m:
-            tooth = m.group(1)
-            treat = m.group(2).strip()
-            parsed.append({
-                "tooth_code": tooth,
-                "treatment_code": treat,
-                "procedure_code": f"{tooth} {treat}"
-            })
-        i += 1
+            else:
+                code = tok.zfill(2)
+                parsed.append({
+                    "tooth_code": code,
+                    "treatment_code": "Gingiwoplastyka",
+                    "procedure_code": f"{code} Gingiwoplastyka"
+                })
+        return parsed
+    m = re.match(r"(\d{2})\s*(.+)", entry)
+    if m:
+        tooth = m.group(1)
+        treat = m.group(2).strip()
+        parsed.append({
+            "tooth_code": tooth,
+            "treatment_code": treat,
+            "procedure_code": f"{tooth} {treat}"
+        })
+    return parsed
+
+def parse_input(text: str):
+    parsed = []
+    for segment in split_segments(text):
+        parsed.extend(parse_segment(segment))
     return parsed
 
 def classify_entry(entry):
@@ -1408,63 +1448,103 @@ def classify_entry(entry):
             return ("Odbudowa protetyczna - nakład", tooth_code)
     return (None, tooth_code)
 
-def generate_visit_plan(parsed_entries, duration_map, price_map, per_tooth_map):
-    visits = []
-    idx = 1
-    visits.append({
-        "idx": idx, "label": f"Wizyta {idx}", "category": "Higienizacja",
-        "unit_price": 0, "count": 0, "teeth": [], "minutes": 60, "base_cost": 0, "extra": 0
+CBCT_CATEGORIES = {"Weryfikacja zębów po leczeniu kanałowym", "Konsultacja implantologiczna celem odbudowy braku zęba"}
+
+
+def _visit(category, unit_price, teeth, minutes, base_cost, extra=0, unit_prices=None):
+    """Wizyta bez numeru – idx/label nadaje _numbered przy składaniu planu.
+
+    unit_prices: cena każdego zęba, gdy wizyta łączy kategorie (CBCT); domyślnie unit_price.
+    """
+    return _add_visit_view_fields({
+        "idx": None, "label": None, "category": category,
+        "unit_price": unit_price, "count": len(teeth), "teeth": teeth,
+        "unit_prices": unit_prices if unit_prices is not None else [unit_price] * len(teeth),
+        "minutes": minutes, "base_cost": base_cost, "extra": extra
     })
-    idx += 1
 
-    cbct_cats = {"Weryfikacja zębów po leczeniu kanałowym", "Konsultacja implantologiczna celem odbudowy braku zęba"}
-    cbct_items = [e for e in parsed_entries if classify_entry(e)[0] in cbct_cats]
-    if cbct_items:
-        teeth_list = [e['tooth_code'] for e in cbct_items]
-        total_time = sum(duration_map.get(e['procedure_code'], 60) for e in cbct_items)
-        category_cbct = classify_entry(cbct_items[0])[0]
-        unit_price_cbct = price_map.get(category_cbct, 0)
-        base_cost_cbct = sum(price_map.get(classify_entry(e)[0], 0) for e in cbct_items)
-        visits.append({
-            "idx": idx, "label": f"Wizyta {idx}", "category": category_cbct,
-            "unit_price": unit_price_cbct, "count": len(teeth_list),
-            "teeth": teeth_list, "minutes": total_time, "base_cost": base_cost_cbct, "extra": 400
-        })
-        idx += 1
+def _numbered(visit, idx):
+    return dict(visit, idx=idx, label=f"Wizyta {idx}")
+
+def _hygiene_visit():
+    return _visit("Higienizacja", 0, [], 60, 0)
+
+def _cbct_visit(cbct_items, duration_map, price_map):
+    teeth_list = [e['tooth_code'] for e in cbct_items]
+    total_time = sum(duration_map.get(e['procedure_code'], 60) for e in cbct_items)
+    category_cbct = classify_entry(cbct_items[0])[0]
+    # wizyta CBCT łączy kategorie (np. po endo + brak) – każdy ząb ma cenę swojej kategorii
+    unit_prices = [price_map.get(classify_entry(e)[0], 0) for e in cbct_items]
+    return _visit(category_cbct, unit_prices[0], teeth_list, total_time, sum(unit_prices),
+                  extra=400, unit_prices=unit_prices)
+
+_UPPER_ORDER = [f"1{i}" for i in range(8,0,-1)] + [f"2{i}" for i in range(1,9)]
+_LOWER_ORDER = [f"3{i}" for i in range(8,0,-1)] + [f"4{i}" for i in range(1,9)]
+_JAW_POSITION = {c:("upper",i) for i,c in enumerate(_UPPER_ORDER)}
+_JAW_POSITION.update({c:("lower",i) for i,c in enumerate(_LOWER_ORDER)})
+
+def cluster_by_tooth_neighborhood(entries_same_category):
+    indexed = []
+    for e in entries_same_category:
+        info = _JAW_POSITION.get(e["tooth_code"])
+        if info:
+            jaw, pos = info
+            indexed.append((jaw, pos, e))
+
+    clusters = []
+    for jaw_label in ("upper","lower"):
+        jaw_list = [(pos, entry) for (jaw,pos,entry) in indexed if jaw==jaw_label]
+        if not jaw_list: continue
+        jaw_list.sort(key=lambda x: x[0])
+        n = len(jaw_list)
+        visited = [False]*n
+        for i in range(n):
+            if visited[i]: continue
+            stack=[i]; visited[i]=True; comp=[]
+            while stack:
+                u=stack.pop(); comp.append(u)
+                for v in range(n):
+                    if not visited[v] and abs(jaw_list[u][0]-jaw_list[v][0])<=2:
+                        visited[v]=True; stack.append(v)
+            clusters.append([jaw_list[k][1] for k in comp])
+    return clusters
+
+def category_visits(category, entries, duration_map, price_map, per_tooth_map):
+    """Wizyty jednej kategorii (klastry sąsiednich zębów dzielone na bloki do 120 min)."""
+    visits = []
+
+    def close(group, minutes):
+        teeth_codes = [x['tooth_code'] for x in group]
+        cnt = len(group)
+        if category == "Gingiwoplastyka":
+            base = price_map.get(category, 0); per = per_tooth_map.get(category, 0)
+            visits.append(_visit(category, per, teeth_codes, minutes, base + cnt*per))
+        else:
+            unit = price_map.get(category, 0)
+            visits.append(_visit(category, unit, teeth_codes, minutes, cnt*unit))
+
+    for group in cluster_by_tooth_neighborhood(entries):
+        group_sorted = sorted(group, key=lambda e: duration_map.get(e['procedure_code'], 60), reverse=True)
+        curr_group, curr_time = [], 0
+        for e in group_sorted:
+            d = duration_map.get(e['procedure_code'], 60)
+            if curr_time + d <= 120:
+                curr_group.append(e); curr_time += d
+            else:
+                close(curr_group, curr_time)
+                curr_group, curr_time = [e], d
+        if curr_group:
+            close(curr_group, curr_time)
+    return visits
 
-    def cluster_by_tooth_neighborhood(entries_same_category):
-        upper_order = [f"1{i}" for i in range(8,0,-1)] + [f"2{i}" for i in range(1,9)]
-        lower_order = [f"3{i}" for i in range(8,0,-1)] + [f"4{i}" for i in range(1,9)]
-        order_map = {c:("upper",i) for i,c in enumerate(upper_order)}
-        order_map.update({c:("lower",i) for i,c in enumerate(lower_order)})
+def generate_visit_plan(parsed_entries, duration_map, price_map, per_tooth_map):
+    visits = [_hygiene_visit()]
 
-        indexed = []
-        for e in entries_same_category:
-            cod = e["tooth_code"]
-            info = order_map.get(cod)
-            if info:
-                jaw, pos = info
-                indexed.append((jaw, pos, e))
-
-        clusters = []
-        for jaw_label in ("upper","lower"):
-            jaw_list = [(pos, entry) for (jaw,pos,entry) in indexed if jaw==jaw_label]
-            if not jaw_list: continue
-            jaw_list.sort(key=lambda x: x[0])
-            n = len(jaw_list)
-            visited = [False]*n
-            for i in range(n):
-                if visited[i]: continue
-                stack=[i]; visited[i]=True; comp=[]
-                while stack:
-                    u=stack.pop(); comp.append(u)
-                    for v in range(n):
-                        if not visited[v] and abs(jaw_list[u][0]-jaw_list[v][0])<=2:
-                            visited[v]=True; stack.append(v)
-                clusters.append([jaw_list[k][1] for k in comp])
-        return clusters
-
-    cbct_and_none = cbct_cats.union({None})
+    cbct_items = [e for e in parsed_entries if classify_entry(e)[0] in CBCT_CATEGORIES]
+    if cbct_items:
+        visits.append(_cbct_visit(cbct_items, duration_map, price_map))
+
+    cbct_and_none = CBCT_CATEGORIES.union({None})
     by_cat = {}
     for e in parsed_entries:
         cat, _ = classify_entry(e)
@@ -1473,82 +1553,64 @@ def generate_visit_plan(parsed_entries, duration_map, price_map, per_tooth_map):
         by_cat.setdefault(cat, []).append(e)
 
     for category, entries in by_cat.items():
-        clusters = cluster_by_tooth_neighborhood(entries)
-        for group in clusters:
-            group_sorted = sorted(group, key=lambda e: duration_map.get(e['procedure_code'], 60), reverse=True)
-            curr_group, curr_time = [], 0
-            for e in group_sorted:
-                d = duration_map.get(e['procedure_code'], 60)
-                if curr_time + d <= 120:
-                    curr_group.append(e); curr_time += d
-                else:
-                    teeth_codes = [x['tooth_code'] for x in curr_group]
-                    if category == "Gingiwoplastyka":
-                        base = price_map.get(category, 0); per = per_tooth_map.get(category, 0); cnt = len(curr_group)
-                        total_cost = base + cnt*per
-                        visits.append({
-                            "idx": idx, "label": f"Wizyta {idx}", "category": category,
-                            "unit_price": per, "count": cnt, "teeth": teeth_codes,
-                            "minutes": curr_time, "base_cost": total_cost, "extra": 0
-                        })
-                    else:
-                        unit = price_map.get(category, 0); cnt = len(curr_group)
-                        visits.append({
-                            "idx": idx, "label": f"Wizyta {idx}", "category": category,
-                            "unit_price": unit, "count": cnt, "teeth": teeth_codes,
-                            "minutes": curr_time, "base_cost": cnt*unit, "extra": 0
-                        })
-                    idx += 1
-                    curr_group, curr_time = [e], d
-            if curr_group:
-                teeth_codes = [x['tooth_code'] for x in curr_group]
-                if category == "Gingiwoplastyka":
-                    base = price_map.get(category, 0); per = per_tooth_map.get(category, 0); cnt = len(curr_group)
-                    total_cost = base + cnt*per
-                    visits.append({
-                        "idx": idx, "label": f"Wizyta {idx}", "category": category,
-                        "unit_price": per, "count": cnt, "teeth": teeth_codes,
-                        "minutes": curr_time, "base_cost": total_cost, "extra": 0
-                    })
-                else:
-                    unit = price_map.get(category, 0); cnt = len(curr_group)
-                    visits.append({
-                        "idx": idx, "label": f"Wizyta {idx}", "category": category,
-                        "unit_price": unit, "count": cnt, "teeth": teeth_codes,
-                        "minutes": curr_time, "base_cost": cnt*unit, "extra": 0
-                    })
-                idx += 1
-    return visits
+        visits.extend(category_visits(category, entries, duration_map, price_map, per_tooth_map))
+    return [_numbered(v, idx) for idx, v in enumerate(visits, 1)]
+
+def _add_visit_view_fields(v):
+    """Pola gotowe do wyświetlenia – szablony tylko je wstawiają."""
+    v["hours"], v["mins"] = divmod(v["minutes"], 60)
+    v["teeth_label"] = " i ".join(v["teeth"])
+    v["extra_label"] = " (odbudowa tymczasowa)" if v["category"] == "Odbudowa protetyczna - nakład" else ""
+    if v["extra"] == 0 and v["count"] > 1:
+        v["cost_desc"] = f"{v['count']} x {v['unit_price']} zł = {v['base_cost']} zł"
+    else:
+        v["cost_desc"] = " + ".join(f"1 x {price} zł" for price in v["unit_prices"]) + f" = {v['base_cost']} zł"
+    return v
+
+PLAN_CATEGORIES = (
+    "Higienizacja",
+    "Mikroskopowe leczenie odtwórcze",
+    "Weryfikacja zębów po leczeniu kanałowym",
+    "Odbudowa protetyczna - nakład",
+    "Odbudowa protetyczna - korona",
+    "Konsultacja implantologiczna celem odbudowy braku zęba",
+    "Do usunięcia",
+    "Gingiwoplastyka",
+)
 
-def aggregate_plan(parsed_entries, price_map, desc_map, duration_map, per_tooth_map):
-    plan = {
-        "Higienizacja": {"teeth":["wszystkie zęby"], "cost":None, "description":desc_map.get("Higienizacja","")},
-        "Mikroskopowe leczenie odtwórcze": {"teeth":[], "cost":0, "description":desc_map.get("Mikroskopowe leczenie odtwórcze",""), "times":[]},
-        "Weryfikacja zębów po leczeniu kanałowym": {"teeth":[], "cost":0, "description":desc_map.get("Weryfikacja zębów po leczeniu kanałowym",""), "times":[]},
-        "Odbudowa protetyczna - nakład": {"teeth":[], "cost":0, "description":desc_map.get("Odbudowa protetyczna - nakład",""), "times":[]},
-        "Odbudowa protetyczna - korona": {"teeth":[], "cost":0, "description":desc_map.get("Odbudowa protetyczna - korona",""), "times":[]},
-        "Konsultacja implantologiczna celem odbudowy braku zęba": {"teeth":[], "cost":0, "description":desc_map.get("Konsultacja implantologiczna celem odbudowy braku zęba",""), "times":[]},
-        "Do usunięcia": {"teeth":[], "cost":0, "description":desc_map.get("Do usunięcia",""), "times":[]},
-        "Gingiwoplastyka": {"teeth":[], "cost":0, "description":desc_map.get("Gingiwoplastyka",""), "times":[]}
-    }
+def group_by_category(parsed_entries):
+    """{kategoria: wpisy} – najpierw PLAN_CATEGORIES (także puste), wpisy w kolejności karty."""
+    by_cat = {c: [] for c in PLAN_CATEGORIES}
     for entry in parsed_entries:
-        category, tooth = classify_entry(entry)
+        category, _ = classify_entry(entry)
         if category is None: continue
-        if category not in plan:
-            plan[category] = {"teeth":[], "cost":0, "description":desc_map.get(category,""), "times":[]}
-        plan[category]["teeth"].append(tooth)
-        plan[category]["times"].append(duration_map.get(entry.get("procedure_code")) or duration_map.get(tooth) or None)
+        by_cat.setdefault(category, []).append(entry)
+    return by_cat
+
+def aggregate_category(category, entries, price_map, desc_map, duration_map, per_tooth_map):
+    if category == "Higienizacja":
+        return {"teeth":["wszystkie zęby"], "cost":None, "description":desc_map.get("Higienizacja","")}
+    data = {"teeth":[], "cost":0, "description":desc_map.get(category,""), "times":[]}
+    for entry in entries:
+        tooth = entry["tooth_code"]
+        data["teeth"].append(tooth)
+        data["times"].append(duration_map.get(entry.get("procedure_code")) or duration_map.get(tooth) or None)
         if category != "Gingiwoplastyka":
-            plan[category]["cost"] += price_map.get(category, 0)
+            data["cost"] += price_map.get(category, 0)
 
-    gingi_teeth = plan["Gingiwoplastyka"]["teeth"]
-    if gingi_teeth:
+    if category == "Gingiwoplastyka" and data["teeth"]:
         base = price_map.get("Gingiwoplastyka", 0)
         per  = per_tooth_map.get("Gingiwoplastyka", 0)
-        total = base + len(gingi_teeth)*per
-        plan["Gingiwoplastyka"]["cost"] = total
-        plan["Gingiwoplastyka"]["cost_expr"] = f"{base} zł + {len(gingi_teeth)} × {per} zł = {total} zł"
-    return plan
+        total = base + len(data["teeth"])*per
+        data["cost"] = total
+        data["cost_expr"] = f"{base} zł + {len(data['teeth'])} × {per} zł = {total} zł"
+    return data
+
+def aggregate_plan(parsed_entries, price_map, desc_map, duration_map, per_tooth_map):
+    return {
+        category: aggregate_category(category, entries, price_map, desc_map, duration_map, per_tooth_map)
+        for category, entries in group_by_category(parsed_entries).items()
+    }
 
 def generate_treatment_plan(input_str, price_map, desc_map, duration_map, per_tooth_map):
     parsed = parse_input(input_str)
@@ -1560,44 +1622,52 @@ def tooth_description(code: str) -> str:
     if len(code)!=2: return ""
     return f"{quad_map.get(code[0],'')} {num_map.get(code[1],'')}".strip()
 
-def format_plan_as_text(plan, price_map):
+def format_category(category, data, price_map):
+    """Linie punktu planu (bez nagłówka „N. kategoria:”); [] dla punktów pomijanych."""
+    if category == "Higienizacja" or not data["teeth"]:
+        return []
+    lines = [""]
+    for tooth in data["teeth"]:
+        desc = tooth_description(tooth)
+        lines.append(f"- {tooth}" + (f" ({desc})" if desc else ""))
+    lines.append("")
+    if category == "Gingiwoplastyka":
+        expr = data.get("cost_expr","")
+        if expr:
+            base_part, _, rest = expr.partition("+")
+            summary = f"Łącznie: {base_part.strip()} (cena podstawowa) +{rest.strip()}"
+            lines.append(summary)
+            lines.append("")
+    elif category == "Konsultacja implantologiczna celem odbudowy braku zęba":
+        lines.append(f"Koszt: {price_map.get(category,0)} zł")
+        lines.append("")
+    else:
+        cnt = len(data["teeth"]); unit = price_map.get(category,0); total = cnt*unit
+        lines.append(f"Łącznie: {cnt} × {unit} zł = {total} zł")
+        lines.append("")
+    desc_text = (data.get("description") or "").strip()
+    if desc_text:
+        lines.append(desc_text); lines.append("")
+    return lines
+
+def join_plan_text(category_lines):
+    """Składa punkty (kategoria, linie) w tekst planu, numerując niepuste."""
     lines = ["Wygenerowany plan leczenia:", ""]
     idx = 1
-    for category, data in plan.items():
-        if category == "Higienizacja" or not data["teeth"]:
+    for category, body in category_lines:
+        if not body:
             continue
         lines.append(f"{idx}. {category}:")
-        lines.append("")
-        if category == "Gingiwoplastyka":
-            for tooth in data["teeth"]:
-                desc = tooth_description(tooth)
-                lines.append(f"- {tooth}" + (f" ({desc})" if desc else ""))
-            lines.append("")
-            expr = data.get("cost_expr","")
-            if expr:
-                base_part, _, rest = expr.partition("+")
-                summary = f"Łącznie: {base_part.strip()} (cena podstawowa) +{rest.strip()}"
-                lines.append(summary)
-                lines.append("")
-        else:
-            for tooth in data["teeth"]:
-                desc = tooth_description(tooth)
-                lines.append(f"- {tooth}" + (f" ({desc})" if desc else ""))
-            lines.append("")
-            if category == "Konsultacja implantologiczna celem odbudowy braku zęba":
-                lines.append(f"Koszt: {price_map.get(category,0)} zł")
-                lines.append("")
-            else:
-                cnt = len(data["teeth"]); unit = price_map.get(category,0); total = cnt*unit
-                lines.append(f"Łącznie: {cnt} × {unit} zł = {total} zł")
-                lines.append("")
-        desc_text = (data.get("description") or "").strip()
-        if desc_text:
-            lines.append(desc_text); lines.append("")
+        lines.extend(body)
         idx += 1
     return "\n".join(lines)
 
-def create_word_doc(plan_text, clinic):
+def format_plan_as_text(plan, price_map):
+    return join_plan_text((category, format_category(category, data, price_map)) for category, data in plan.items())
+
+def create_word_doc(plan_text, clinic, issued=None):
+    """issued: data wystawienia w nagłówku (domyślnie dziś)."""
+    issued = issued or datetime.now().date()
     doc = Document()
     normal = doc.styles['Normal']
     normal.font.name = 'Century Gothic'
@@ -1611,7 +1681,7 @@ def create_word_doc(plan_text, clinic):
         p_logo.add_run().add_picture(clinic['logo_path'], width=Inches(1.5))
 
     date_para = doc.add_paragraph(); date_para.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    date_para.add_run(f"{clinic['city']} {datetime.now():%d.%m.%Y} r.").bold = True
+    date_para.add_run(f"{clinic['city']} {issued:%d.%m.%Y} r.").bold = True
 
     info = (
         f"Lek. dent. {clinic['doctor_name']}\n"
@@ -1634,21 +1704,2227 @@ def create_word_doc(plan_text, clinic):
             doc.add_paragraph(line)
     f = BytesIO(); doc.save(f); f.seek(0); return f
 
+# -----------------------------------------------------------------------------
+# METRYKI / PROFILOWANIE
+# -----------------------------------------------------------------------------
+# Metryki są trzymane w pamięci procesu (każdy worker gunicorna ma własne)
+# i wystawiane na /metrics w formacie tekstowym Prometheusa.
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+# Opcjonalny zrzut profilu dla wylosowanych, wolnych żądań
+PROFILE_DIR    = os.environ.get("LOTTI_PROFILE_DIR", "")
+PROFILE_RATE   = float(os.environ.get("LOTTI_PROFILE_RATE", "0.05"))
+PROFILE_MIN_MS = float(os.environ.get("LOTTI_PROFILE_MIN_MS", "500"))
+PROFILER       = os.environ.get("LOTTI_PROFILER", "cprofile")
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape_label(v)}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, doc, labelnames, buckets=DEFAULT_BUCKETS):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                # liczniki kubełków (niekumulatywne) + suma + liczba obserwacji
+                s = self._series[labels] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def expose(self):
+        with self._lock:
+            series = {k: list(v) for k, v in self._series.items()}
+        lines = []
+        for labels, s in sorted(series.items()):
+            acc = 0
+            for le, cnt in zip(self.buckets, s):
+                acc += cnt
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', le)])} {acc}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', '+Inf')])} {s[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {s[-2]:.6f}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {s[-1]}")
+        return lines
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, doc, labelnames):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labelnames)
+        self._series = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._series[labels] += amount
+
+    def expose(self):
+        with self._lock:
+            series = dict(self._series)
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v:g}" for k, v in sorted(series.items())]
+
+
+class Gauge:
+    """Wartość chwilowa odczytywana funkcją w momencie scrapowania.
+
+    Bez labeli fn zwraca liczbę, z labelnames – słownik {krotka labeli: wartość}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, doc, fn, labelnames=()):
+        self.name, self.doc, self.fn, self.labelnames = name, doc, fn, tuple(labelnames)
+
+    def expose(self):
+        if not self.labelnames:
+            return [f"{self.name} {self.fn():g}"]
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v:g}" for k, v in sorted(self.fn().items())]
+
+
+METRICS = []
+
+def register_metric(metric):
+    METRICS.append(metric)
+    return metric
+
+REQUEST_SECONDS = register_metric(Histogram(
+    "lotti_request_duration_seconds", "Czas obsługi żądania HTTP.", ("endpoint", "method", "status")))
+STAGE_SECONDS = register_metric(Histogram(
+    "lotti_stage_duration_seconds",
+    "Czas etapów obsługi żądania (db, template, parse, classify, schedule, format, docx).",
+    ("endpoint", "stage")))
+REQUEST_DB_QUERIES = register_metric(Histogram(
+    "lotti_request_db_queries", "Liczba zapytań SQL na jedno żądanie.", ("endpoint",),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100, 250)))
+PROFILES_WRITTEN = register_metric(Counter(
+    "lotti_profiles_written_total", "Liczba zapisanych zrzutów profilu.", ("endpoint",)))
+
+
+def render_metrics():
+    out = []
+    for m in METRICS:
+        out.append(f"# HELP {m.name} {m.doc}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        out.extend(m.expose())
+    return "\n".join(out) + "\n"
+
+
+def _endpoint_label():
+    if has_request_context():
+        return request.endpoint or "unknown"
+    return "-"
+
+
+@contextmanager
+def timed(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, _endpoint_label(), stage)
+
+
+# --- czas zapytań SQL (zdarzenia silnika SQLAlchemy) ---
+@event.listens_for(Engine, "before_cursor_execute")
+def _db_query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("lotti_query_t0", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _db_query_end(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get("lotti_query_t0")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    STAGE_SECONDS.observe(elapsed, _endpoint_label(), "db")
+    if has_request_context() and "req_t0" in g:
+        g.db_queries = g.get("db_queries", 0) + 1
+
+
+# --- czas renderowania szablonów (sygnały Flaska) ---
+def _template_start(sender, template, context, **extra):
+    g.setdefault("template_t0", []).append(time.perf_counter())
+
+def _template_end(sender, template, context, **extra):
+    starts = g.get("template_t0")
+    if starts:
+        STAGE_SECONDS.observe(time.perf_counter() - starts.pop(), _endpoint_label(), "template")
+
+before_render_template.connect(_template_start, app)
+template_rendered.connect(_template_end, app)
+
+
+# --- profilowanie wylosowanych żądań ---
+def _start_profiler():
+    if PROFILER == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+            prof = Profiler(async_mode="disabled")
+            prof.start()
+            return prof
+        except Exception:
+            pass
+    import cProfile
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        # inny profiler jest już aktywny (np. równoległe żądanie na Pythonie 3.12+)
+        return None
+    return prof
+
+def _stop_profiler(prof, elapsed_ms):
+    is_pyinstrument = not hasattr(prof, "disable")
+    if is_pyinstrument:
+        prof.stop()
+    else:
+        prof.disable()
+    if elapsed_ms < PROFILE_MIN_MS:
+        return
+    endpoint = _endpoint_label()
+    base = f"{datetime.utcnow():%Y%m%dT%H%M%S}_{secure_filename(endpoint)}_{int(elapsed_ms)}ms_{uuid.uuid4().hex[:6]}"
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        if is_pyinstrument:
+            with open(os.path.join(PROFILE_DIR, base + ".html"), "w", encoding="utf-8") as fh:
+                fh.write(prof.output_html())
+        else:
+            prof.dump_stats(os.path.join(PROFILE_DIR, base + ".prof"))
+        PROFILES_WRITTEN.inc(endpoint)
+    except OSError as exc:
+        app.logger.warning("Nie udało się zapisać profilu: %s", exc)
+
+
+@app.before_request
+def metrics_start():
+    g.req_t0 = time.perf_counter()
+    g.db_queries = 0
+    if PROFILE_DIR and random.random() < PROFILE_RATE:
+        g.profiler = _start_profiler()
+
+@app.after_request
+def metrics_finish(response):
+    t0 = g.pop("req_t0", None)
+    if t0 is not None:
+        elapsed = time.perf_counter() - t0
+        endpoint = _endpoint_label()
+        REQUEST_SECONDS.observe(elapsed, endpoint, request.method, str(response.status_code))
+        REQUEST_DB_QUERIES.observe(g.get("db_queries", 0), endpoint)
+        prof = g.pop("profiler", None)
+        if prof is not None:
+            _stop_profiler(prof, elapsed * 1000)
+    return response
+
+@app.teardown_request
+def metrics_teardown(exc):
+    # after_request nie jest wołane przy nieobsłużonym wyjątku – profiler trzeba wyłączyć tutaj
+    prof = g.pop("profiler", None)
+    if prof is not None:
+        _stop_profiler(prof, 0)
+
+# -----------------------------------------------------------------------------
+# KONTEKST UŻYTKOWNIKA (cache gabinetów)
+# -----------------------------------------------------------------------------
+# Lista gabinetów użytkownika jest trzymana w g (na czas żądania) oraz w
+# krótkim cache procesu z TTL. Dodanie gabinetu unieważnia wpis lokalnie,
+# pozostałe workery widzą zmianę najpóźniej po CABINET_CACHE_TTL sekundach.
+CABINET_CACHE_TTL = float(os.environ.get("CABINET_CACHE_TTL", "30"))
+CABINET_CACHE_MAX = 4096
+
+CabinetInfo = namedtuple(
+    "CabinetInfo", "id name logo logo_docx logo_thumb doctor_name street flat_number postal_code city"
+)
+
+_cabinet_cache = {}
+_cabinet_cache_lock = threading.Lock()
+
+
+def _load_user_cabinets(user_id):
+    rows = (
+        db.session.query(*(getattr(Cabinet, f) for f in CabinetInfo._fields))
+        .filter(Cabinet.user_id == user_id)
+        .order_by(Cabinet.id)
+        .all()
+    )
+    return tuple(CabinetInfo(*r) for r in rows)
+
+
+def user_cabinets(user_id):
+    if has_request_context() and g.get("cabinets_user") == user_id:
+        return g.cabinets
+
+    now = time.monotonic()
+    with _cabinet_cache_lock:
+        entry = _cabinet_cache.get(user_id)
+    if entry and entry[0] > now:
+        cabinets = entry[1]
+    else:
+        cabinets = _load_user_cabinets(user_id)
+        with _cabinet_cache_lock:
+            if len(_cabinet_cache) >= CABINET_CACHE_MAX:
+                for uid in [u for u, (exp, _) in _cabinet_cache.items() if exp <= now]:
+                    del _cabinet_cache[uid]
+                if len(_cabinet_cache) >= CABINET_CACHE_MAX:
+                    _cabinet_cache.clear()
+            _cabinet_cache[user_id] = (now + CABINET_CACHE_TTL, cabinets)
+
+    if has_request_context():
+        g.cabinets_user, g.cabinets = user_id, cabinets
+    return cabinets
+
+
+def invalidate_user_cabinets(user_id):
+    with _cabinet_cache_lock:
+        _cabinet_cache.pop(user_id, None)
+    if has_request_context() and g.get("cabinets_user") == user_id:
+        g.pop("cabinets_user"); g.pop("cabinets", None)
+
+
+def user_cabinet_or_404(cabinet_id):
+    """Gabinet zalogowanego użytkownika z cache; cudze lub nieistniejące -> 404."""
+    try:
+        cabinet_id = int(cabinet_id)
+    except (TypeError, ValueError):
+        abort(404)
+    for c in user_cabinets(g.user_id):
+        if c.id == cabinet_id:
+            return c
+    abort(404)
+
+# -----------------------------------------------------------------------------
+# CZASY ZABIEGÓW (agregaty historii CodeDuration)
+# -----------------------------------------------------------------------------
+# Optymalny czas per kod procedury (średnia obcięta o 10% z obu stron) jest
+# liczony raz na gabinet i trzymany w cache procesu. Każdy zapis historii
+# unieważnia wpis gabinetu – import hurtowy robi to jednorazowo na końcu.
+DURATION_CACHE_TTL = float(os.environ.get("DURATION_CACHE_TTL", "60"))
+IMPORT_CHUNK_SIZE  = 1000
+IMPORT_MAX_ERRORS  = 20
+
+_duration_cache = {}
+_duration_cache_lock = threading.Lock()
+
+
+def optimal_duration(durations):
+    ds = sorted(durations); n = len(ds); trim = int(n * 0.1)
+    trimmed = ds[trim: n - trim] or ds
+    return sum(trimmed) // len(trimmed)
+
+
+def optimal_duration_counts(counts):
+    """optimal_duration dla histogramu {czas: liczba} – ten sam wynik co dla rozwiniętej listy."""
+    n = sum(counts.values()); trim = int(n * 0.1)
+    lo, hi = (trim, n - trim) if n - 2 * trim > 0 else (0, n)
+    total = kept = pos = 0
+    for d in sorted(counts):
+        a, b = max(pos, lo), min(pos + counts[d], hi)
+        if b > a:
+            total += d * (b - a); kept += b - a
+        pos += counts[d]
+    return total // kept
+
+
+def rollup_duration_counts(cabinet_id):
+    """{kod: {czas: liczba}} z zagregowanej (zarchiwizowanej) historii gabinetu."""
+    counts = defaultdict(dict)
+    rows = db.session.query(CodeDurationRollup.procedure_code, CodeDurationRollup.duration,
+                            CodeDurationRollup.count) \
+                     .filter(CodeDurationRollup.cabinet_id == cabinet_id)
+    for proc_code, duration, n in rows:
+        counts[proc_code][duration] = n
+    return counts
+
+
+def cabinet_optimal_durations(cabinet_id):
+    cabinet_id = int(cabinet_id)
+    now = time.monotonic()
+    with _duration_cache_lock:
+        entry = _duration_cache.get(cabinet_id)
+    if entry and entry[0] > now:
+        return entry[1]
+
+    by_code = rollup_duration_counts(cabinet_id)
+    rows = db.session.query(CodeDuration.procedure_code, CodeDuration.duration) \
+                     .filter(CodeDuration.cabinet_id == cabinet_id)
+    for proc_code, duration in rows:
+        hist = by_code[proc_code]
+        hist[duration] = hist.get(duration, 0) + 1
+    optimal = {code: optimal_duration_counts(hist) for code, hist in by_code.items()}
+
+    with _duration_cache_lock:
+        _duration_cache[cabinet_id] = (now + DURATION_CACHE_TTL, optimal)
+    return optimal
+
+
+def invalidate_cabinet_durations(cabinet_id):
+    with _duration_cache_lock:
+        _duration_cache.pop(int(cabinet_id), None)
+
+
+def _iter_duration_records(file_storage):
+    """Strumieniowo czyta CSV (nagłówek: procedure_code,duration[,timestamp]) lub JSONL.
+
+    Zwraca krotki (nr_linii, rekord) – rekord to dict albo None dla pustej linii.
+    """
+    stream = codecs.getreader("utf-8-sig")(file_storage.stream)
+    name = (file_storage.filename or "").lower()
+    if name.endswith((".jsonl", ".ndjson")):
+        for lineno, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield lineno, json.loads(line)
+            except ValueError:
+                yield lineno, None
+        return
+
+    lines = iter(stream)
+    header = next(lines, "")
+    try:
+        dialect = csv.Sniffer().sniff(header, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    columns = [c.strip().lower() for c in next(csv.reader([header], dialect))]
+    for lineno, row in enumerate(csv.reader(lines, dialect), start=2):
+        if not any(cell.strip() for cell in row):
+            continue
+        yield lineno, dict(zip(columns, row))
+
+
+def import_code_durations(cabinet_id, file_storage):
+    """Import hurtowy historii czasów w jednej transakcji, wstawiany paczkami (executemany)."""
+    valid_codes = {code for (code,) in db.session.query(ProcedureCode.code)}
+    now = datetime.utcnow()
+    inserted, rejected, errors = 0, 0, []
+    chunk = []
+
+    def reject(lineno, reason):
+        nonlocal rejected
+        rejected += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append(f"linia {lineno}: {reason}")
+
+    try:
+        for lineno, rec in _iter_duration_records(file_storage):
+            if not isinstance(rec, dict):
+                reject(lineno, "niepoprawny format rekordu"); continue
+            code = str(rec.get("procedure_code") or "").strip()
+            if code not in valid_codes:
+                reject(lineno, f"nieznany kod procedury „{code}”"); continue
+            try:
+                duration = int(str(rec.get("duration", "")).strip())
+            except ValueError:
+                reject(lineno, "czas nie jest liczbą całkowitą"); continue
+            if not 0 < duration <= 24 * 60:
+                reject(lineno, f"czas poza zakresem: {duration}"); continue
+            ts = now
+            if rec.get("timestamp"):
+                try:
+                    ts = datetime.fromisoformat(str(rec["timestamp"]).strip())
+                except ValueError:
+                    reject(lineno, "niepoprawny timestamp (oczekiwany ISO 8601)"); continue
+            chunk.append({"cabinet_id": cabinet_id, "procedure_code": code,
+                          "duration": duration, "timestamp": ts})
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                db.session.execute(insert(CodeDuration), chunk)
+                inserted += len(chunk); chunk = []
+        if chunk:
+            db.session.execute(insert(CodeDuration), chunk)
+            inserted += len(chunk)
+        db.session.commit()
+    except UnicodeDecodeError:
+        # import jest jedną transakcją – plik w innym kodowaniu odrzucamy w całości
+        db.session.rollback()
+        return {"inserted": 0, "rejected": rejected + inserted + len(chunk),
+                "errors": errors + ["plik nie jest zapisany w UTF-8 – import odrzucony"]}
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if inserted:
+        invalidate_cabinet_durations(cabinet_id)
+    return {"inserted": inserted, "rejected": rejected, "errors": errors}
+
+# -----------------------------------------------------------------------------
+# KATALOG ZABIEGÓW
+# -----------------------------------------------------------------------------
+# TreatmentType i ProcedureCode zmienia tylko seed przy starcie, więc katalog jest
+# czytany raz na proces (przy preload_app w masterze) i współdzielony przez workery.
+# Mapy są tylko do odczytu – kto chce je nadpisać cenami gabinetu, robi kopię.
+CatalogType = namedtuple("CatalogType", "id name default_price default_description")
+Catalog = namedtuple("Catalog", "types price_map desc_map duration_map")
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def catalog():
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                rows = db.session.query(
+                    TreatmentType.id, TreatmentType.name,
+                    TreatmentType.default_price, TreatmentType.default_description,
+                ).order_by(TreatmentType.id).all()
+                types = tuple(CatalogType(*r) for r in rows)
+                durations = db.session.query(ProcedureCode.code, ProcedureCode.default_duration).all()
+                _catalog = Catalog(
+                    types,
+                    {t.name: t.default_price for t in types},
+                    {t.name: t.default_description for t in types},
+                    dict(durations),
+                )
+    return _catalog
+
+
+def invalidate_catalog():
+    global _catalog
+    _catalog = None
+
+# -----------------------------------------------------------------------------
+# CENNIK GABINETU
+# -----------------------------------------------------------------------------
+# Mapy przekazywane do aggregate_plan/generate_visit_plan: domyślne typy zabiegów
+# nadpisane cenami/opisami gabinetu, czasy z kodów procedur i historii gabinetu.
+Pricing = namedtuple("Pricing", "price_map desc_map per_tooth_map duration_map")
+
+
+def load_pricing(cabinet_id, history=True):
+    """history=False: czasy tylko z katalogu, bez historii gabinetu (widok zapisanego planu)."""
+    cat       = catalog()
+    price_map = dict(cat.price_map)
+    desc_map  = dict(cat.desc_map)
+
+    duration_map = dict(cat.duration_map)
+    if history:
+        duration_map.update(cabinet_optimal_durations(cabinet_id))
+
+    per_tooth_map = {}
+    for t in Treatment.query.filter_by(cabinet_id=cabinet_id).all():
+        desc_map[t.type] = t.description or ""
+        if t.type == "Gingiwoplastyka":
+            price_map[t.type]     = t.base_price or 0
+            per_tooth_map[t.type] = t.per_tooth_price or 0
+        else:
+            price_map[t.type]     = t.price or 0
+    return Pricing(price_map, desc_map, per_tooth_map, duration_map)
+
+
+# Wycena jednej karty we wszystkich gabinetach naraz: karta -> wektor cech
+# (liczba zębów per kategoria + [czy jest gingiwoplastyka, liczba zębów gingi]),
+# gabinety -> macierz cen o tych samych kolumnach; sumy = jedno mnożenie macierz × wektor.
+# Model kosztu jak w aggregate_plan: cena × liczba zębów, a gingiwoplastyka = baza + n × cena/ząb.
+GINGI = "Gingiwoplastyka"
+
+
+def chart_feature_vector(parsed, categories):
+    """Wektor cech karty dla kolumn: categories (bez gingi) + [gingi_baza, gingi_zęby]."""
+    index = {cat: i for i, cat in enumerate(categories)}
+    x = np.zeros(len(categories) + 2)
+    gingi_teeth = 0
+    for entry in parsed:
+        category, _ = classify_entry(entry)
+        if category == GINGI:
+            gingi_teeth += 1
+        elif category is not None and category in index:
+            x[index[category]] += 1
+    x[-2] = 1.0 if gingi_teeth else 0.0
+    x[-1] = gingi_teeth
+    return x
+
+
+def cabinet_price_matrix(cabinet_ids):
+    """(kategorie, macierz cen gabinety × [kategorie..., gingi_baza, gingi_cena_za_ząb])."""
+    types = catalog().types
+    defaults = {t.name: t.default_price or 0 for t in types}
+    treatments = (
+        db.session.query(Treatment.cabinet_id, Treatment.type, Treatment.price,
+                         Treatment.base_price, Treatment.per_tooth_price)
+        .filter(Treatment.cabinet_id.in_(cabinet_ids))
+        .order_by(Treatment.id)
+        .all()
+    )
+    categories = sorted(({t.name for t in types} | {t.type for t in treatments}) - {GINGI})
+    col = {cat: i for i, cat in enumerate(categories)}
+    row = {cid: i for i, cid in enumerate(cabinet_ids)}
+
+    prices = np.empty((len(cabinet_ids), len(categories) + 2))
+    prices[:, :len(categories)] = [defaults.get(cat, 0) for cat in categories]
+    prices[:, -2] = defaults.get(GINGI, 0)
+    prices[:, -1] = 0
+    # kolejność wg id – przy kilku wpisach tego samego typu wygrywa ostatni, jak w load_pricing
+    for cabinet_id, ttype, price, base_price, per_tooth_price in treatments:
+        r = row[cabinet_id]
+        if ttype == GINGI:
+            prices[r, -2] = base_price or 0
+            prices[r, -1] = per_tooth_price or 0
+        else:
+            prices[r, col[ttype]] = price or 0
+    return categories, prices
+
+
+def compare_cabinet_quotes(cabinets, input_data):
+    """Lista wycen karty we wszystkich gabinetach, od najtańszego."""
+    parsed = parse_input(input_data)
+    cabinet_ids = [c.id for c in cabinets]
+    categories, prices = cabinet_price_matrix(cabinet_ids)
+    x = chart_feature_vector(parsed, categories)
+    totals = prices @ x
+    breakdown = prices * x   # koszt każdej kolumny w każdym gabinecie
+    gingi = breakdown[:, -2] + breakdown[:, -1]
+    used = [i for i, cat in enumerate(categories) if x[i]]
+
+    quotes = []
+    for r in np.argsort(totals, kind="stable"):
+        cabinet = cabinets[r]
+        costs = {categories[i]: float(breakdown[r, i]) for i in used}
+        if x[-1]:
+            costs[GINGI] = float(gingi[r])
+        quotes.append({"cabinet_id": cabinet.id, "name": cabinet.name,
+                       "total": float(totals[r]), "costs": costs})
+    counts = {categories[i]: int(x[i]) for i in used}
+    if x[-1]:
+        counts[GINGI] = int(x[-1])
+    return counts, quotes
+
+
+# -----------------------------------------------------------------------------
+# ZAPIS PLANÓW (opcjonalny write-behind)
+# -----------------------------------------------------------------------------
+# PLAN_WRITE_BEHIND=1: wygenerowany plan trafia do ograniczonej kolejki w procesie,
+# a wątek w tle wstawia rekordy paczkami (co PLAN_FLUSH_INTERVAL_MS albo po
+# PLAN_FLUSH_BATCH wierszach) w jednej transakcji – jeden commit/fsync na paczkę
+# zamiast na żądanie. Pełna kolejka -> zapis synchroniczny (backpressure zamiast utraty).
+# Przy normalnym zamknięciu procesu (atexit) kolejka jest opróżniana do bazy.
+# Plan pojawia się na liście /plans z opóźnieniem rzędu PLAN_FLUSH_INTERVAL_MS.
+PLAN_WRITE_BEHIND      = os.environ.get("PLAN_WRITE_BEHIND", "0") == "1"
+PLAN_FLUSH_INTERVAL_MS = int(os.environ.get("PLAN_FLUSH_INTERVAL_MS", "50"))
+PLAN_FLUSH_BATCH       = int(os.environ.get("PLAN_FLUSH_BATCH", "500"))
+PLAN_QUEUE_MAX         = int(os.environ.get("PLAN_QUEUE_MAX", "10000"))
+
+_plan_queue = queue.Queue(maxsize=PLAN_QUEUE_MAX)
+_plan_flusher = None
+_plan_flusher_pid = None
+_plan_flusher_lock = threading.Lock()
+_plan_flusher_stop = threading.Event()
+
+PLAN_WRITES = register_metric(Counter(
+    "lotti_plan_writes_total", "Zapisane plany wg trybu (sync, queued, overflow).", ("mode",)))
+PLAN_FLUSH_ROWS = register_metric(Histogram(
+    "lotti_plan_flush_rows", "Liczba planów wstawionych w jednej paczce write-behind.", (),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)))
+PLAN_FLUSH_ERRORS = register_metric(Counter(
+    "lotti_plan_flush_errors_total", "Nieudane próby zapisu paczki planów.", ()))
+register_metric(Gauge(
+    "lotti_plan_queue_depth", "Plany oczekujące w kolejce write-behind.", lambda: _plan_queue.qsize()))
+
+
+def _insert_ignoring_conflicts(model):
+    """INSERT pomijający wiersze naruszające klucz/indeks unikalny (SQLite/PostgreSQL)."""
+    dialect = db.engine.dialect.name
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        return insert(model)
+    return dialect_insert(model).on_conflict_do_nothing()
+
+
+def _plan_insert():
+    """INSERT planu pomijający duplikaty z indeksu ux_generated_plan_dedupe."""
+    return _insert_ignoring_conflicts(GeneratedPlan)
+
+
+_PLAN_RECORD_EXTRAS = ("tooth_masks", "stats")
+
+
+def _insert_plans(records):
+    """Wstawia listę planów jednym executemany i jednym commitem (razem z maskami zębów
+    i wkładem do analityki)."""
+    with app.app_context():
+        db.session.execute(_plan_insert(), [
+            {k: v for k, v in r.items() if k not in _PLAN_RECORD_EXTRAS} for r in records
+        ])
+        keyed = _plan_ids_by_key([r for r in records if r["input_hash"]])
+        _insert_tooth_masks_by_key([(plan_id, r) for plan_id, r in keyed if r.get("tooth_masks")])
+        for plan_id, r in keyed:
+            if r.get("stats"):
+                add_plan_stats(plan_id, r["cabinet_id"], r["created_at"], r["stats"])
+        db.session.commit()
+
+
+def _flush_plans(batch):
+    for attempt in range(5):
+        try:
+            _insert_plans(batch)
+            PLAN_FLUSH_ROWS.observe(len(batch))
+            return True
+        except Exception as exc:
+            PLAN_FLUSH_ERRORS.inc()
+            app.logger.warning("Zapis %d planów nieudany (próba %d): %s", len(batch), attempt + 1, exc)
+            time.sleep(0.1 * 2 ** attempt)
+    app.logger.error("Porzucono %d planów po nieudanych próbach zapisu", len(batch))
+    return False
+
+
+def _plan_flusher_loop():
+    interval = PLAN_FLUSH_INTERVAL_MS / 1000
+    while not _plan_flusher_stop.is_set():
+        try:
+            batch = [_plan_queue.get(timeout=0.5)]
+        except queue.Empty:
+            continue
+        deadline = time.monotonic() + interval
+        while len(batch) < PLAN_FLUSH_BATCH:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_plan_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _flush_plans(batch)
+
+
+def _ensure_plan_flusher():
+    """Wątek startowany leniwie – także po fork (gunicorn --preload) w każdym workerze osobno."""
+    global _plan_flusher, _plan_flusher_pid
+    if _plan_flusher_pid == os.getpid() and _plan_flusher.is_alive():
+        return
+    with _plan_flusher_lock:
+        if _plan_flusher_pid == os.getpid() and _plan_flusher.is_alive():
+            return
+        _plan_flusher = threading.Thread(target=_plan_flusher_loop, name="plan-flusher", daemon=True)
+        _plan_flusher.start()
+        _plan_flusher_pid = os.getpid()
+
+
+@atexit.register
+def drain_plan_queue():
+    if _plan_flusher_pid != os.getpid():
+        return
+    _plan_flusher_stop.set()
+    _plan_flusher.join(timeout=5)
+    batch = []
+    while True:
+        try:
+            batch.append(_plan_queue.get_nowait())
+        except queue.Empty:
+            break
+    for i in range(0, len(batch), PLAN_FLUSH_BATCH):
+        _flush_plans(batch[i:i + PLAN_FLUSH_BATCH])
+
+
+def _existing_plan_id(user_id, cabinet_id, input_hash, version):
+    return db.session.query(GeneratedPlan.id).filter_by(
+        user_id=user_id, cabinet_id=cabinet_id, input_hash=input_hash, pricing_version=version,
+    ).scalar()
+
+
+def save_generated_plan(user_id, cabinet_id, input_data, plan_text, input_hash=None, version=None,
+                        tooth_masks=None, stats=None):
+    """Zapisuje plan; zwraca id (także istniejącego duplikatu) albo None, gdy rekord
+    czeka w kolejce write-behind."""
+    cabinet_id = int(cabinet_id)
+    if input_hash is not None:
+        existing = _existing_plan_id(user_id, cabinet_id, input_hash, version)
+        if existing is not None:
+            PLAN_WRITES.inc("duplicate")
+            return existing
+    record = {
+        "user_id": user_id, "cabinet_id": cabinet_id, "input_data": input_data,
+        "plan_text": plan_text, "created_at": datetime.utcnow(),
+        "input_hash": input_hash, "pricing_version": version,
+    }
+    if PLAN_WRITE_BEHIND:
+        record["tooth_masks"] = tooth_masks
+        record["stats"] = stats
+        _ensure_plan_flusher()
+        try:
+            _plan_queue.put_nowait(record)
+            PLAN_WRITES.inc("queued")
+            return None
+        except queue.Full:
+            PLAN_WRITES.inc("overflow")
+    else:
+        PLAN_WRITES.inc("sync")
+    res = db.session.connection().execute(_plan_insert(), record)
+    if res.rowcount == 0:
+        # równoległe, identyczne wysłanie wygrało wyścig o indeks unikalny
+        db.session.commit()
+        return _existing_plan_id(user_id, cabinet_id, input_hash, version)
+    plan_id = res.inserted_primary_key[0]
+    if tooth_masks:
+        _insert_tooth_masks(plan_id, user_id, cabinet_id, tooth_masks)
+    if stats:
+        add_plan_stats(plan_id, cabinet_id, record["created_at"], stats)
+    db.session.commit()
+    return plan_id
+
+
+# -----------------------------------------------------------------------------
+# GENEROWANIE PLANU (z cache wyników)
+# -----------------------------------------------------------------------------
+# Wynik zależy wyłącznie od sparsowanego wejścia i map cennika, więc kluczem jest
+# hash parse_input(...) (różnice w spacjach/przecinkach nie mają znaczenia) oraz
+# wersja cennika (hash map). Ten sam klucz identyfikuje duplikaty GeneratedPlan.
+PLAN_RESULT_CACHE_MAX = int(os.environ.get("PLAN_RESULT_CACHE_MAX", "1024"))
+
+BuiltPlan = namedtuple("BuiltPlan", "result visits plan_text input_hash pricing_version tooth_masks stats")
+
+_plan_result_cache = OrderedDict()
+_plan_result_cache_lock = threading.Lock()
+
+PLAN_RESULT_CACHE = register_metric(Counter(
+    "lotti_plan_result_cache_total", "Generowanie planu wg wyniku cache (hit/miss).", ("result",)))
+
+
+def _digest(obj):
+    data = json.dumps(obj, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def pricing_version(pricing):
+    return _digest(pricing._asdict())[:16]
+
+
+def build_plan(input_data, pricing, version=None):
+    """Plan zagregowany, wizyty i tekst; wyniki współdzielone – nie modyfikować."""
+    version = version or pricing_version(pricing)
+    with timed("parse"):
+        parsed = parse_input(input_data)
+    input_hash = _digest(parsed)
+    key = (version, input_hash)
+    with _plan_result_cache_lock:
+        built = _plan_result_cache.get(key)
+        if built is not None:
+            _plan_result_cache.move_to_end(key)
+    if built is not None:
+        PLAN_RESULT_CACHE.inc("hit")
+        return built
+
+    PLAN_RESULT_CACHE.inc("miss")
+    price_map, desc_map, per_tooth_map, duration_map = pricing
+    with timed("classify"):
+        result = aggregate_plan(parsed, price_map, desc_map, duration_map, per_tooth_map)
+    with timed("schedule"):
+        visits = generate_visit_plan(parsed, duration_map, price_map, per_tooth_map)
+    with timed("format"):
+        plan_text = format_plan_as_text(result, price_map)
+    built = BuiltPlan(result, visits, plan_text, input_hash, version, tooth_masks(parsed),
+                      plan_stats(parsed, result))
+    with _plan_result_cache_lock:
+        _plan_result_cache[key] = built
+        while len(_plan_result_cache) > PLAN_RESULT_CACHE_MAX:
+            _plan_result_cache.popitem(last=False)
+    return built
+
+
+# -----------------------------------------------------------------------------
+# PLANOWANIE PRZYROSTOWE (edycja zapisanego planu)
+# -----------------------------------------------------------------------------
+# Plan składa się z niezależnych kawałków: segment karty (split_segments) parsuje
+# się bez reszty karty, punkt agregatu i tekstu zależy tylko od wpisów swojej
+# kategorii, a wizyty – od wpisów kategorii w jednym łuku (górnym/dolnym).
+# Planner pamięta te kawałki dla ostatniej wersji karty planu i po edycji liczy
+# od nowa tylko te, których wejście się zmieniło; reszta to porównania list
+# (dla niezmienionych segmentów – tych samych obiektów) i liniowe składanie.
+# Wynik jest identyczny z pełnym przeliczeniem – sprawdza to bench/incremental_plan.py.
+PLANNER_CACHE_MAX = int(os.environ.get("PLANNER_CACHE_MAX", "256"))
+
+_planners = OrderedDict()
+_planners_lock = threading.Lock()
+
+PLANNER_CATEGORIES = register_metric(Counter(
+    "lotti_planner_categories_total", "Kategorie planu przy edycji: przeliczone lub użyte ponownie.", ("result",)))
+
+CategoryBlock = namedtuple("CategoryBlock", "entries data visits text mask")
+
+
+class IncrementalPlanner:
+    def __init__(self, pricing, version):
+        self.pricing, self.version = pricing, version
+        self.lock = threading.Lock()
+        self._segments = {}     # segment -> [(wpis, kategoria)]
+        self._blocks = {}       # kategoria -> CategoryBlock
+        self._jaws = {}         # (kategoria, łuk) -> (wpisy, wizyty bez numerów)
+        self._cbct = (None, None)
+
+    def _parse(self, input_data):
+        segments = {}
+        for segment in split_segments(input_data):
+            items = segments.get(segment) or self._segments.get(segment)
+            if items is None:
+                items = [(e, classify_entry(e)[0]) for e in parse_segment(segment)]
+            segments[segment] = items
+            yield from items
+        self._segments = segments
+
+    def _jaw_visits(self, category, entries):
+        price_map, _, per_tooth_map, duration_map = self.pricing
+        by_jaw = {"upper": [], "lower": []}
+        for e in entries:
+            info = _JAW_POSITION.get(e["tooth_code"])
+            if info:
+                by_jaw[info[0]].append(e)
+        visits = []
+        for jaw, jaw_entries in by_jaw.items():
+            cached = self._jaws.get((category, jaw))
+            if cached is None or cached[0] != jaw_entries:
+                cached = self._jaws[(category, jaw)] = (
+                    jaw_entries, category_visits(category, jaw_entries, duration_map, price_map, per_tooth_map))
+            visits.extend(cached[1])
+        return visits
+
+    def update(self, input_data):
+        """BuiltPlan dla nowej wersji karty i lista przeliczonych kategorii."""
+        price_map, desc_map, per_tooth_map, duration_map = self.pricing
+        # jak group_by_category, plus kolejność wizyt (pierwsze wystąpienie) i wpisy CBCT
+        parsed = []
+        by_cat = {c: [] for c in PLAN_CATEGORIES}
+        visit_order, cbct_items = {}, []
+        for entry, category in self._parse(input_data):
+            parsed.append(entry)
+            if category is None: continue
+            by_cat.setdefault(category, []).append(entry)
+            if category in CBCT_CATEGORIES:
+                cbct_items.append(entry)
+            else:
+                visit_order.setdefault(category, None)
+
+        dirty = []
+        for category, entries in by_cat.items():
+            block = self._blocks.get(category)
+            if block is not None and block.entries == entries:
+                continue
+            data = aggregate_category(category, entries, price_map, desc_map, duration_map, per_tooth_map)
+            visits = [] if category in CBCT_CATEGORIES else self._jaw_visits(category, entries)
+            mask = 0
+            for e in entries:
+                mask |= tooth_bit(e["tooth_code"]) or 0
+            self._blocks[category] = CategoryBlock(
+                entries, data, visits, format_category(category, data, price_map), mask)
+            dirty.append(category)
+
+        # wizyta CBCT przeplata dwie kategorie w kolejności karty – ma własny klucz
+        if self._cbct[0] != cbct_items:
+            self._cbct = (cbct_items, _cbct_visit(cbct_items, duration_map, price_map) if cbct_items else None)
+
+        visits = [_hygiene_visit()]
+        if self._cbct[1] is not None:
+            visits.append(self._cbct[1])
+        for category in visit_order:
+            visits.extend(self._blocks[category].visits)
+
+        blocks = [(c, self._blocks[c]) for c in by_cat]
+        result = {c: b.data for c, b in blocks}
+        built = BuiltPlan(
+            result,
+            [_numbered(v, idx) for idx, v in enumerate(visits, 1)],
+            join_plan_text((c, b.text) for c, b in blocks),
+            _digest(parsed), self.version,
+            {c: b.mask for c, b in blocks if b.mask},
+            plan_stats(parsed, result),
+        )
+        return built, dirty
+
+
+def plan_incrementally(plan_id, input_data, pricing, version=None):
+    """Jak build_plan, ale przyrostowo względem poprzedniej wersji karty planu plan_id."""
+    version = version or pricing_version(pricing)
+    with _planners_lock:
+        planner = _planners.get(plan_id)
+        if planner is None or planner.version != version:
+            planner = _planners[plan_id] = IncrementalPlanner(pricing, version)
+        _planners.move_to_end(plan_id)
+        while len(_planners) > PLANNER_CACHE_MAX:
+            _planners.popitem(last=False)
+
+    with timed("classify"), planner.lock:
+        built, dirty = planner.update(input_data)
+    PLANNER_CATEGORIES.inc("recomputed", amount=len(dirty))
+    PLANNER_CATEGORIES.inc("reused", amount=len(built.result) - len(dirty))
+    return built
+
+
+def forget_planner(plan_id):
+    with _planners_lock:
+        _planners.pop(plan_id, None)
+
+
+# -----------------------------------------------------------------------------
+# ARCHIWUM (stare plany i historia czasów)
+# -----------------------------------------------------------------------------
+# `flask archive` przenosi plany starsze niż ARCHIVE_PLANS_AFTER_DAYS do tabeli
+# generated_plan_archive (treść skompresowana zstd lub zlib, kodek zapisany per
+# wiersz), a historię CodeDuration starszą niż ROLLUP_DURATIONS_AFTER_DAYS zwija
+# do histogramów w code_duration_rollup. Podgląd, pobranie i usunięcie planu
+# działają tak samo dla planów zarchiwizowanych; edycja przywraca plan do tabeli głównej.
+ARCHIVE_PLANS_AFTER_DAYS    = int(os.environ.get("ARCHIVE_PLANS_AFTER_DAYS", "365"))
+ROLLUP_DURATIONS_AFTER_DAYS = int(os.environ.get("ROLLUP_DURATIONS_AFTER_DAYS", "180"))
+ARCHIVE_CODEC = os.environ.get("ARCHIVE_CODEC") or ("zstd" if zstandard is not None else "zlib")
+
+
+def compress_text(text, codec=ARCHIVE_CODEC):
+    data = text.encode("utf-8")
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 9)
+
+
+def decompress_text(blob, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("plan zarchiwizowany zstd, a moduł zstandard nie jest zainstalowany")
+        return zstandard.ZstdDecompressor().decompress(blob).decode("utf-8")
+    return zlib.decompress(blob).decode("utf-8")
+
+
+def load_plan_or_404(plan_id):
+    """GeneratedPlan z tabeli głównej albo (rozpakowany, nietrwały) z archiwum."""
+    plan = db.session.get(GeneratedPlan, plan_id)
+    if plan is None:
+        archived = db.session.get(ArchivedPlan, plan_id)
+        if archived is None:
+            abort(404)
+        plan = archived.to_plan()
+    return plan
+
+
+def restore_archived_plan(plan_id):
+    """Przenosi plan z archiwum z powrotem do generated_plan (pod tym samym id)."""
+    archived = db.session.get(ArchivedPlan, plan_id)
+    plan = archived.to_plan()
+    plan.is_archived = False
+    db.session.delete(archived)
+    db.session.add(plan)
+    db.session.flush()
+    return plan
+
+
+def archive_plans(older_than_days, batch_size=1000, codec=ARCHIVE_CODEC):
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    # id zarchiwizowanych planów nie wracają do obiegu – generated_plan ma AUTOINCREMENT
+    moved = 0
+    while True:
+        rows = (
+            GeneratedPlan.query
+            .filter(GeneratedPlan.created_at < cutoff)
+            .order_by(GeneratedPlan.id).limit(batch_size).all()
+        )
+        if not rows:
+            break
+        db.session.execute(insert(ArchivedPlan), [{
+            "id": p.id, "user_id": p.user_id, "cabinet_id": p.cabinet_id,
+            "created_at": p.created_at, "archived_at": datetime.utcnow(),
+            "input_preview": p.input_data[:200], "input_hash": p.input_hash,
+            "pricing_version": p.pricing_version, "codec": codec,
+            "input_blob": compress_text(p.input_data, codec),
+            "plan_blob": compress_text(p.plan_text, codec),
+        } for p in rows])
+        GeneratedPlan.query.filter(GeneratedPlan.id.in_([p.id for p in rows])) \
+                           .delete(synchronize_session=False)
+        db.session.commit()
+        db.session.expunge_all()
+        moved += len(rows)
+    return moved
+
+
+def rollup_code_durations(older_than_days):
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    # górna granica id ustalona z góry – wiersze dopisane w trakcie nie są ani liczone, ani usuwane
+    max_id = db.session.query(func.max(CodeDuration.id)).scalar()
+    if max_id is None:
+        return 0
+    old = (CodeDuration.timestamp < cutoff, CodeDuration.id <= max_id)
+    groups = (
+        db.session.query(CodeDuration.cabinet_id, CodeDuration.procedure_code, CodeDuration.duration,
+                         func.count(), func.max(CodeDuration.timestamp))
+        .filter(*old)
+        .group_by(CodeDuration.cabinet_id, CodeDuration.procedure_code, CodeDuration.duration)
+        .all()
+    )
+    if not groups:
+        return 0
+    cabinet_ids = {g[0] for g in groups}
+    existing = {
+        (r.cabinet_id, r.procedure_code, r.duration): r
+        for r in CodeDurationRollup.query.filter(CodeDurationRollup.cabinet_id.in_(cabinet_ids))
+    }
+    for cabinet_id, proc_code, duration, n, last_ts in groups:
+        row = existing.get((cabinet_id, proc_code, duration))
+        if row is None:
+            db.session.add(CodeDurationRollup(cabinet_id=cabinet_id, procedure_code=proc_code,
+                                              duration=duration, count=n, last_timestamp=last_ts))
+        else:
+            row.count += n
+            row.last_timestamp = max(filter(None, (row.last_timestamp, last_ts)))
+    removed = CodeDuration.query.filter(*old).delete(synchronize_session=False)
+    db.session.commit()
+    for cabinet_id in cabinet_ids:
+        invalidate_cabinet_durations(cabinet_id)
+    return removed
+
+
+@app.cli.command("archive")
+@click.option("--plans-older-than", type=int, default=ARCHIVE_PLANS_AFTER_DAYS, show_default=True,
+              help="wiek planów do archiwizacji [dni]")
+@click.option("--durations-older-than", type=int, default=ROLLUP_DURATIONS_AFTER_DAYS, show_default=True,
+              help="wiek historii CodeDuration do zwinięcia [dni]")
+@click.option("--batch-size", type=int, default=1000, show_default=True)
+@click.option("--vacuum", is_flag=True, help="VACUUM po archiwizacji (tylko SQLite)")
+def archive_command(plans_older_than, durations_older_than, batch_size, vacuum):
+    """Przenosi stare plany do skompresowanego archiwum i zwija starą historię czasów."""
+    plans = archive_plans(plans_older_than, batch_size)
+    durations = rollup_code_durations(durations_older_than)
+    click.echo(f"Zarchiwizowano planów: {plans} ({ARCHIVE_CODEC}), zwinięto wierszy CodeDuration: {durations}")
+    if vacuum and db.engine.dialect.name == "sqlite":
+        with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.exec_driver_sql("VACUUM")
+        click.echo("VACUUM zakończony")
+
+
+# -----------------------------------------------------------------------------
+# HISTORIA WERSJI PLANÓW
+# -----------------------------------------------------------------------------
+# Edycja planu nadpisuje wiersz generated_plan, a poprzednie wersje trafiają do
+# plan_revision: pierwsza edycja zapisuje treść pierwotną (rev 1, pełny zrzut),
+# każda następna – deltę względem wersji poprzedniej. Co PLAN_SNAPSHOT_EVERY
+# wersji (albo gdy delta wyszłaby większa) zapisywany jest pełny zrzut, więc
+# odtworzenie dowolnej wersji to jedno zapytanie i najwyżej tyle delt.
+# Delta to lista operacji na tokenach (linie tekstu planu / wpisy karty po
+# przecinku): [i, j] = skopiuj tokeny i..j-1 wersji poprzedniej, napis = wstaw.
+PLAN_SNAPSHOT_EVERY = int(os.environ.get("PLAN_SNAPSHOT_EVERY", "8"))
+REVISION_CACHE_MAX  = int(os.environ.get("REVISION_CACHE_MAX", "256"))
+
+_DELTA_TOKEN_RE = re.compile(r"(?<=[,\n])")
+
+Revision = namedtuple("Revision", "rev input_data plan_text created_at")
+
+# wersje są niezmienne – odtworzone treści można cache'ować bez unieważniania
+_revision_cache = OrderedDict()
+_revision_cache_lock = threading.Lock()
+
+
+def make_delta(old, new):
+    a, b = _DELTA_TOKEN_RE.split(old), _DELTA_TOKEN_RE.split(new)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append("".join(b[j1:j2]))
+    return ops
+
+
+def apply_delta(old, ops):
+    a = _DELTA_TOKEN_RE.split(old)
+    return "".join(op if isinstance(op, str) else "".join(a[op[0]:op[1]]) for op in ops)
+
+
+def _revision(plan, rev, created_at, input_data, plan_text, base=None):
+    """PlanRevision dla treści; base = (input, tekst) wersji rev-1, None wymusza pełny zrzut."""
+    codec = ARCHIVE_CODEC
+    blobs = (compress_text(input_data, codec), compress_text(plan_text, codec))
+    snapshot = base is None or (rev - 1) % PLAN_SNAPSHOT_EVERY == 0
+    if not snapshot:
+        deltas = tuple(
+            compress_text(json.dumps(make_delta(old, new), ensure_ascii=False, separators=(",", ":")), codec)
+            for old, new in zip(base, (input_data, plan_text))
+        )
+        snapshot = sum(map(len, deltas)) >= sum(map(len, blobs))
+        if not snapshot:
+            blobs = deltas
+    return PlanRevision(plan_id=plan.id, user_id=plan.user_id, rev=rev, created_at=created_at,
+                        snapshot=snapshot, codec=codec, input_blob=blobs[0], plan_blob=blobs[1])
+
+
+def record_plan_revision(plan, new_input, new_text, now):
+    """Dopisuje nową wersję planu do historii (wołane przed nadpisaniem wiersza, w tej samej transakcji)."""
+    if (plan.input_data, plan.plan_text) == (new_input, new_text):
+        return None
+    last = db.session.query(func.max(PlanRevision.rev)).filter(PlanRevision.plan_id == plan.id).scalar()
+    if last is None:
+        db.session.add(_revision(plan, 1, plan.created_at, plan.input_data, plan.plan_text))
+        last = 1
+    rev = _revision(plan, last + 1, now, new_input, new_text, base=(plan.input_data, plan.plan_text))
+    db.session.add(rev)
+    return rev.rev
+
+
+def plan_revisions(plan_id, user_id):
+    """[(rev, created_at, snapshot, bajty)] – pusta lista dla planu nigdy nieedytowanego."""
+    return db.session.query(
+        PlanRevision.rev, PlanRevision.created_at, PlanRevision.snapshot,
+        func.length(PlanRevision.input_blob) + func.length(PlanRevision.plan_blob),
+    ).filter(PlanRevision.plan_id == plan_id, PlanRevision.user_id == user_id).order_by(PlanRevision.rev).all()
+
+
+def materialize_revision(plan_id, user_id, rev):
+    """Revision wersji rev planu użytkownika albo None."""
+    key = (plan_id, rev)
+    with _revision_cache_lock:
+        hit = _revision_cache.get(key)
+        if hit is not None:
+            _revision_cache.move_to_end(key)
+    if hit is not None:
+        owner, revision = hit
+        return revision if owner == user_id else None
+
+    last_snapshot = (
+        select(func.max(PlanRevision.rev))
+        .where(PlanRevision.plan_id == plan_id, PlanRevision.snapshot.is_(True), PlanRevision.rev <= rev)
+        .scalar_subquery()
+    )
+    chain = PlanRevision.query.filter(
+        PlanRevision.plan_id == plan_id, PlanRevision.user_id == user_id,
+        PlanRevision.rev >= last_snapshot, PlanRevision.rev <= rev,
+    ).order_by(PlanRevision.rev).all()
+    if not chain or chain[-1].rev != rev:
+        return None
+
+    input_data = decompress_text(chain[0].input_blob, chain[0].codec)
+    plan_text = decompress_text(chain[0].plan_blob, chain[0].codec)
+    for r in chain[1:]:
+        input_data = apply_delta(input_data, json.loads(decompress_text(r.input_blob, r.codec)))
+        plan_text = apply_delta(plan_text, json.loads(decompress_text(r.plan_blob, r.codec)))
+
+    revision = Revision(rev, input_data, plan_text, chain[-1].created_at)
+    with _revision_cache_lock:
+        _revision_cache[key] = (user_id, revision)
+        while len(_revision_cache) > REVISION_CACHE_MAX:
+            _revision_cache.popitem(last=False)
+    return revision
+
+
+def delete_plan_revisions(plan_id):
+    PlanRevision.query.filter_by(plan_id=plan_id).delete()
+    with _revision_cache_lock:
+        for key in [k for k in _revision_cache if k[0] == plan_id]:
+            del _revision_cache[key]
+
+
+# -----------------------------------------------------------------------------
+# ANALITYKA GABINETU (agregaty utrzymywane przyrostowo)
+# -----------------------------------------------------------------------------
+# Dashboard czyta wyłącznie practice_stat (gabinet × miesiąc × wymiar), więc jego
+# koszt nie zależy od liczby planów. Każdy zapis, edycja i usunięcie planu
+# dodaje/odejmuje wkład planu (plan_stats) upsertem addytywnym; wkład jest też
+# zapisany w plan_stat, żeby dało się go odjąć bez ponownego parsowania.
+# Wstawienie plan_stat z pominięciem konfliktu czyni dodanie idempotentnym.
+# `flask rebuild-analytics` odtwarza obie tabele z istniejących planów.
+DASHBOARD_TOP_PROCEDURES = int(os.environ.get("DASHBOARD_TOP_PROCEDURES", "10"))
+
+_STAT_KEY = ("cabinet_id", "month", "dimension", "key")
+
+
+def plan_stats(parsed, result):
+    """Wkład planu: przychód (jak total_cost w API), liczba zębów i przychód per kategoria, kody procedur."""
+    # Higienizacja (znacznik "wszystkie zęby", bez ceny) pomijana – jak w szablonach planu
+    categories = {
+        category: [len(data["teeth"]), data.get("cost") or 0]
+        for category, data in result.items()
+        if data["teeth"] and category != "Higienizacja"
+    }
+    procedures = {}
+    for entry in parsed:
+        code = entry["procedure_code"][:128]
+        procedures[code] = procedures.get(code, 0) + 1
+    return {
+        "revenue": sum(amount for _, amount in categories.values()),
+        "categories": categories,
+        "procedures": procedures,
+    }
+
+
+def _stat_rows(cabinet_id, month, stats, sign):
+    rows = [{"dimension": "plan", "key": "", "count": sign, "amount": sign * stats["revenue"]}]
+    rows += [{"dimension": "category", "key": cat, "count": sign * n, "amount": sign * amount}
+             for cat, (n, amount) in stats["categories"].items()]
+    rows += [{"dimension": "procedure", "key": code, "count": sign * n, "amount": 0}
+             for code, n in stats["procedures"].items()]
+    for r in rows:
+        r.update(cabinet_id=cabinet_id, month=month)
+    return rows
+
+
+def _add_to_practice_stats(rows):
+    """count/amount += wartości z rows (upsert; poza SQLite/PostgreSQL – UPDATE, a gdy brak wiersza INSERT)."""
+    if not rows:
+        return
+    dialect = db.engine.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(PracticeStat)
+        stmt = stmt.on_conflict_do_update(index_elements=list(_STAT_KEY), set_={
+            "count": PracticeStat.count + stmt.excluded.count,
+            "amount": PracticeStat.amount + stmt.excluded.amount,
+        })
+        db.session.execute(stmt, rows)
+    else:
+        for r in rows:
+            where = [getattr(PracticeStat, k) == r[k] for k in _STAT_KEY]
+            res = db.session.execute(PracticeStat.__table__.update().where(*where).values(
+                count=PracticeStat.count + r["count"], amount=PracticeStat.amount + r["amount"]))
+            if res.rowcount == 0:
+                db.session.execute(insert(PracticeStat), r)
+
+
+def add_plan_stats(plan_id, cabinet_id, created_at, stats):
+    month = created_at.strftime("%Y-%m")
+    res = db.session.connection().execute(_insert_ignoring_conflicts(PlanStat), {
+        "plan_id": plan_id, "cabinet_id": cabinet_id, "month": month,
+        "data": json.dumps(stats, ensure_ascii=False, separators=(",", ":")),
+    })
+    if res.rowcount:
+        _add_to_practice_stats(_stat_rows(cabinet_id, month, stats, 1))
+
+
+def remove_plan_stats(plan_id):
+    row = db.session.execute(
+        select(PlanStat.cabinet_id, PlanStat.month, PlanStat.data).where(PlanStat.plan_id == plan_id)
+    ).first()
+    if row is None:
+        return
+    rows = _stat_rows(row.cabinet_id, row.month, json.loads(row.data), -1)
+    _add_to_practice_stats(rows)
+    db.session.execute(delete(PracticeStat).where(
+        PracticeStat.cabinet_id == row.cabinet_id, PracticeStat.month == row.month,
+        PracticeStat.count <= 0,
+    ))
+    db.session.execute(delete(PlanStat).where(PlanStat.plan_id == plan_id))
+
+
+def practice_dashboard(cabinet_ids, month_from, month_to, top=DASHBOARD_TOP_PROCEDURES):
+    """Agregaty dla gabinetów w przedziale miesięcy [month_from, month_to] (RRRR-MM)."""
+    in_range = (
+        PracticeStat.cabinet_id.in_(cabinet_ids),
+        PracticeStat.month >= month_from, PracticeStat.month <= month_to,
+    )
+    monthly = db.session.query(
+        PracticeStat.cabinet_id, PracticeStat.month, PracticeStat.count, PracticeStat.amount,
+    ).filter(*in_range, PracticeStat.dimension == "plan").order_by(PracticeStat.cabinet_id, PracticeStat.month)
+    categories = db.session.query(
+        PracticeStat.key, func.sum(PracticeStat.count), func.sum(PracticeStat.amount),
+    ).filter(*in_range, PracticeStat.dimension == "category").group_by(PracticeStat.key)
+    total = func.sum(PracticeStat.count)
+    procedures = db.session.query(PracticeStat.key, total).filter(
+        *in_range, PracticeStat.dimension == "procedure",
+    ).group_by(PracticeStat.key).order_by(total.desc(), PracticeStat.key).limit(top)
+
+    per_cabinet = defaultdict(list)
+    for cabinet_id, month, plans, revenue in monthly:
+        per_cabinet[cabinet_id].append({"month": month, "plans": plans, "revenue": revenue})
+    return {
+        "monthly": per_cabinet,
+        "categories": {cat: {"teeth": teeth, "revenue": revenue} for cat, teeth, revenue in categories},
+        "top_procedures": [{"code": code, "count": count} for code, count in procedures],
+    }
+
+
+def rebuild_practice_stats(batch_size=1000):
+    """Odtwarza plan_stat i practice_stat ze wszystkich planów (także zarchiwizowanych)."""
+    db.session.execute(delete(PlanStat))
+    db.session.execute(delete(PracticeStat))
+    pricing = {}
+    totals = {}
+    stat_rows = []
+
+    def plans():
+        hot = db.session.query(GeneratedPlan.id, GeneratedPlan.cabinet_id, GeneratedPlan.created_at,
+                               GeneratedPlan.input_data)
+        yield from hot.yield_per(batch_size)
+        cold = db.session.query(ArchivedPlan.id, ArchivedPlan.cabinet_id, ArchivedPlan.created_at,
+                                ArchivedPlan.codec, ArchivedPlan.input_blob)
+        for plan_id, cabinet_id, created_at, codec, blob in cold.yield_per(batch_size):
+            yield plan_id, cabinet_id, created_at, decompress_text(blob, codec)
+
+    count = 0
+    for plan_id, cabinet_id, created_at, input_data in plans():
+        if cabinet_id not in pricing:
+            pricing[cabinet_id] = load_pricing(cabinet_id, history=False)
+        price_map, desc_map, per_tooth_map, duration_map = pricing[cabinet_id]
+        parsed = parse_input(input_data)
+        stats = plan_stats(parsed, aggregate_plan(parsed, price_map, desc_map, duration_map, per_tooth_map))
+        month = created_at.strftime("%Y-%m")
+        stat_rows.append({"plan_id": plan_id, "cabinet_id": cabinet_id, "month": month,
+                          "data": json.dumps(stats, ensure_ascii=False, separators=(",", ":"))})
+        for r in _stat_rows(cabinet_id, month, stats, 1):
+            key = tuple(r[k] for k in _STAT_KEY)
+            acc = totals.setdefault(key, [0, 0])
+            acc[0] += r["count"]; acc[1] += r["amount"]
+        if len(stat_rows) >= batch_size:
+            db.session.execute(insert(PlanStat), stat_rows)
+            stat_rows = []
+        count += 1
+    if stat_rows:
+        db.session.execute(insert(PlanStat), stat_rows)
+    rows = [dict(zip(_STAT_KEY, key), count=c, amount=a) for key, (c, a) in totals.items()]
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(insert(PracticeStat), rows[i:i + batch_size])
+    db.session.commit()
+    return count, len(rows)
+
+
+@app.cli.command("rebuild-analytics")
+@click.option("--batch-size", default=1000, show_default=True)
+def rebuild_analytics_command(batch_size):
+    """Przelicza agregaty analityki od zera z zapisanych planów.
+
+    Przychód liczony jest według bieżących cen gabinetów – historia cen nie jest przechowywana.
+    """
+    plans, rows = rebuild_practice_stats(batch_size)
+    click.echo(f"Przeliczono {plans} planów, {rows} wierszy agregatów.")
+
+
+# -----------------------------------------------------------------------------
+# ODONTOGRAM (maski zębów planów)
+# -----------------------------------------------------------------------------
+# 32 zęby stałe FDI (kwadranty 1–4, zęby 1–8) -> bity 0..31: bit = (q-1)*8 + (n-1).
+# Przy zapisie planu dla każdej kategorii zapisywana jest maska zębów, więc pytanie
+# „które plany dotyczą zęba 36 (w kategorii X)” to predykat bitowy na indeksie
+# plan_tooth_mask, bez ponownego parsowania input_data.
+TOOTH_QUERY_LIMIT = 500
+ALL_CATEGORIES = "*"   # dodatkowy wiersz z sumą masek wszystkich kategorii planu
+
+
+def tooth_bit(tooth_code):
+    code = str(tooth_code).strip()
+    if len(code) != 2 or not code.isdigit():
+        return None
+    q, n = int(code[0]), int(code[1])
+    if not (1 <= q <= 4 and 1 <= n <= 8):
+        return None
+    return 1 << ((q - 1) * 8 + n - 1)
+
+
+TEETH_BY_BIT = [f"{q}{n}" for q in range(1, 5) for n in range(1, 9)]
+
+
+def mask_teeth(mask):
+    teeth = []
+    while mask:
+        low = mask & -mask
+        teeth.append(TEETH_BY_BIT[low.bit_length() - 1])
+        mask ^= low
+    return teeth
+
+
+def tooth_masks(parsed):
+    """{kategoria: maska} z wyniku parse_input (kategorie jak w aggregate_plan)."""
+    masks = {}
+    for entry in parsed:
+        category, tooth = classify_entry(entry)
+        bit = tooth_bit(tooth)
+        if category and bit:
+            masks[category] = masks.get(category, 0) | bit
+    return masks
+
+
+def _mask_rows(plan_id, user_id, cabinet_id, masks):
+    union = 0
+    for mask in masks.values():
+        union |= mask
+    rows = [{"plan_id": plan_id, "category": cat, "user_id": user_id, "cabinet_id": cabinet_id, "mask": mask}
+            for cat, mask in masks.items()]
+    rows.append({"plan_id": plan_id, "category": ALL_CATEGORIES, "user_id": user_id,
+                 "cabinet_id": cabinet_id, "mask": union})
+    return rows
+
+
+def _insert_tooth_masks(plan_id, user_id, cabinet_id, masks):
+    db.session.execute(_insert_ignoring_conflicts(PlanToothMask), _mask_rows(plan_id, user_id, cabinet_id, masks))
+
+
+def replace_tooth_masks(plan_id, user_id, cabinet_id, masks):
+    PlanToothMask.query.filter_by(plan_id=plan_id).delete()
+    if masks:
+        _insert_tooth_masks(plan_id, user_id, cabinet_id, masks)
+
+
+def _plan_ids_by_key(records):
+    """[(id, rekord)] dla planów wstawionych paczką (write-behind) – id ustalane po kluczu deduplikacji."""
+    if not records:
+        return []
+    keys = {(r["user_id"], r["cabinet_id"], r["input_hash"], r["pricing_version"]): r for r in records}
+    rows = db.session.query(
+        GeneratedPlan.id, GeneratedPlan.user_id, GeneratedPlan.cabinet_id,
+        GeneratedPlan.input_hash, GeneratedPlan.pricing_version,
+    ).filter(
+        GeneratedPlan.user_id.in_({k[0] for k in keys}),
+        GeneratedPlan.input_hash.in_({k[2] for k in keys}),
+    )
+    return [(plan_id, keys[tuple(key)]) for plan_id, *key in rows if tuple(key) in keys]
+
+
+def _insert_tooth_masks_by_key(keyed):
+    """Maski dla planów wstawionych paczką: keyed = [(id, rekord)] z _plan_ids_by_key."""
+    mask_rows = []
+    for plan_id, r in keyed:
+        mask_rows.extend(_mask_rows(plan_id, r["user_id"], r["cabinet_id"], r["tooth_masks"]))
+    if mask_rows:
+        db.session.execute(_insert_ignoring_conflicts(PlanToothMask), mask_rows)
+
+
+def plans_by_teeth(user_id, bits, category=None, cabinet_id=None, match_all=False, limit=TOOTH_QUERY_LIMIT):
+    """[(plan_id, {kategoria: maska})] planów użytkownika dotyczących zębów z maski bits.
+    match_all: plan musi obejmować wszystkie zęby (w kategorii albo łącznie we wszystkich)."""
+    m = PlanToothMask
+    hit = m.mask.op("&")(bits) == bits if match_all else m.mask.op("&")(bits) != 0
+    filters = [m.user_id == user_id, m.category == (category or ALL_CATEGORIES), hit]
+    if cabinet_id is not None:
+        filters.append(m.cabinet_id == cabinet_id)
+    ids = db.session.query(m.plan_id).filter(*filters).order_by(m.plan_id.desc()).limit(limit).subquery()
+    found = defaultdict(dict)
+    rows = db.session.query(m.plan_id, m.category, m.mask) \
+                     .filter(m.plan_id.in_(select(ids.c.plan_id)), m.category != ALL_CATEGORIES)
+    for plan_id, cat, mask in rows:
+        found[plan_id][cat] = mask
+    return sorted(found.items(), reverse=True)
+
+
+@app.cli.command("backfill-tooth-masks")
+@click.option("--batch-size", type=int, default=1000, show_default=True)
+def backfill_tooth_masks_command(batch_size):
+    """Liczy maski zębów dla planów zapisanych przed wprowadzeniem plan_tooth_mask."""
+    done = 0
+    for model in (GeneratedPlan, ArchivedPlan):
+        last_id = 0
+        while True:
+            batch = (
+                model.query
+                .filter(model.id > last_id,
+                        ~select(PlanToothMask.plan_id).where(PlanToothMask.plan_id == model.id).exists())
+                .order_by(model.id).limit(batch_size).all()
+            )
+            if not batch:
+                break
+            for row in batch:
+                plan = row.to_plan() if model is ArchivedPlan else row
+                masks = tooth_masks(parse_input(plan.input_data))
+                if masks:
+                    _insert_tooth_masks(plan.id, plan.user_id, plan.cabinet_id, masks)
+                    done += 1
+            last_id = batch[-1].id
+            db.session.commit()
+            db.session.expunge_all()
+    click.echo(f"Uzupełniono maski dla planów: {done}")
+
+
+# -----------------------------------------------------------------------------
+# KALENDARZ FOTELI (rezerwacje wizyt)
+# -----------------------------------------------------------------------------
+# Rezerwacje jednego fotela nie nachodzą na siebie, więc posortowane listy początków
+# i końców są indeksem przedziałów: pierwsza kolizja z [t, t+d) to bisect po końcach,
+# a wolna luka to przeskok po kolejnych rezerwacjach. Indeks gabinetu (wszystkie fotele,
+# rezerwacje od teraz do BOOKING_HORIZON_DAYS) trzymany jest w cache procesu; przy
+# zapisie rezerwacji kolizja jest i tak sprawdzana w bazie.
+#
+# Wizyty z generate_visit_plan układane są w kolejności listy (higienizacja, potem
+# CBCT/konsultacje, potem leczenie) – każda zaczyna się po końcu poprzedniej,
+# domyślnie najwcześniej następnego dnia.
+BOOKING_HORIZON_DAYS = int(os.environ.get("BOOKING_HORIZON_DAYS", "365"))
+BOOKING_CACHE_TTL    = float(os.environ.get("BOOKING_CACHE_TTL", "30"))
+
+_booking_cache = {}
+_booking_cache_lock = threading.Lock()
+
+
+class ChairIndex:
+    def __init__(self, chair_id, name, windows):
+        self.chair_id, self.name = chair_id, name
+        self.windows = windows          # dzień tygodnia -> [(start_minute, end_minute)]
+        self.starts, self.ends = [], []
+
+    def copy(self):
+        other = ChairIndex(self.chair_id, self.name, self.windows)
+        other.starts, other.ends = list(self.starts), list(self.ends)
+        return other
+
+    def add(self, start, end):
+        i = bisect.bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+
+    def is_free(self, start, end):
+        i = bisect.bisect_right(self.ends, start)   # pierwsza rezerwacja kończąca się po start
+        return i == len(self.starts) or self.starts[i] >= end
+
+    def earliest_fit(self, not_before, duration, until):
+        """Najwcześniejszy start >= not_before, w godzinach pracy, bez kolizji; None, gdy brak."""
+        day = datetime.combine(not_before.date(), datetime.min.time())
+        while day < until:
+            for w_start, w_end in self.windows.get(day.weekday(), ()):
+                cursor = max(not_before, day + timedelta(minutes=w_start))
+                window_end = day + timedelta(minutes=w_end)
+                i = bisect.bisect_right(self.ends, cursor)
+                while cursor + duration <= window_end:
+                    if i == len(self.starts) or self.starts[i] >= cursor + duration:
+                        return cursor
+                    cursor = max(cursor, self.ends[i])
+                    i += 1
+            day += timedelta(days=1)
+        return None
+
+
+def _load_booking_index(cabinet_id, now):
+    chairs = Chair.query.filter_by(cabinet_id=cabinet_id, active=True).order_by(Chair.id).all()
+    windows = defaultdict(lambda: defaultdict(list))
+    if chairs:
+        rows = ChairAvailability.query.filter(ChairAvailability.chair_id.in_([c.id for c in chairs]))
+        for a in rows:
+            windows[a.chair_id][a.weekday].append((a.start_minute, a.end_minute))
+    index = {c.id: ChairIndex(c.id, c.name, {d: sorted(w) for d, w in windows[c.id].items()}) for c in chairs}
+    if index:
+        bookings = (
+            db.session.query(Booking.chair_id, Booking.start, Booking.end)
+            .filter(Booking.chair_id.in_(list(index)), Booking.end > now)
+            .order_by(Booking.chair_id, Booking.start)
+        )
+        for chair_id, start, end in bookings:
+            ci = index[chair_id]
+            ci.starts.append(start); ci.ends.append(end)
+    return index
+
+
+def cabinet_booking_index(cabinet_id):
+    now = time.monotonic()
+    with _booking_cache_lock:
+        entry = _booking_cache.get(cabinet_id)
+    if entry and entry[0] > now:
+        return entry[1]
+    index = _load_booking_index(cabinet_id, datetime.now())
+    with _booking_cache_lock:
+        _booking_cache[cabinet_id] = (now + BOOKING_CACHE_TTL, index)
+    return index
+
+
+def invalidate_booking_index(cabinet_id):
+    with _booking_cache_lock:
+        _booking_cache.pop(cabinet_id, None)
+
+
+def schedule_visits(cabinet_id, visits, not_before=None, next_day=True):
+    """(terminy [{visit_idx, label, chair_id, start, end}], None) albo (terminy do tej pory,
+    wizyta, której nie da się umieścić w horyzoncie)."""
+    # indeks z cache jest współdzielony między wątkami – propozycje dopisywane do kopii,
+    # żeby kolejne wizyty tego samego planu widziały wcześniejsze
+    index = {cid: ci.copy() for cid, ci in cabinet_booking_index(cabinet_id).items()}
+    # nigdy w przeszłości – indeks zna tylko rezerwacje kończące się po teraz
+    now = datetime.now().replace(second=0, microsecond=0)
+    not_before = max(not_before, now) if not_before else now
+    until = now + timedelta(days=BOOKING_HORIZON_DAYS)
+    slots = []
+    for v in visits:
+        duration = timedelta(minutes=max(1, int(v["minutes"] or 0)))
+        best = None
+        for ci in index.values():
+            start = ci.earliest_fit(not_before, duration, until)
+            if start is not None and (best is None or start < best[1]):
+                best = (ci, start)
+        if best is None:
+            return slots, v
+        ci, start = best
+        end = start + duration
+        ci.add(start, end)
+        slots.append({"visit_idx": v["idx"], "label": v["label"], "category": v["category"],
+                      "chair_id": ci.chair_id, "chair": ci.name, "start": start, "end": end})
+        not_before = datetime.combine(end.date() + timedelta(days=1), datetime.min.time()) \
+            if next_day else end
+    return slots, None
+
+
+def _lock_chairs(chair_ids):
+    """Blokada foteli do końca transakcji – sprawdzenie kolizji i INSERT innego workera czekają."""
+    conn = db.session.connection()
+    if conn.dialect.name == "sqlite":
+        # SQLite nie zna FOR UPDATE: BEGIN IMMEDIATE od razu bierze blokadę zapisu bazy
+        # (gdy transakcja już pisze, blokadę ma). Drugi zapisujący czeka do busy timeout.
+        raw = conn.connection.dbapi_connection
+        if not raw.in_transaction:
+            raw.execute("BEGIN IMMEDIATE")
+        return
+    db.session.execute(
+        select(Chair.id).where(Chair.id.in_(sorted(chair_ids))).order_by(Chair.id).with_for_update()
+    )
+
+
+def book_slots(cabinet_id, slots, plan_id=None):
+    """Zapisuje terminy; False (bez zapisu), gdy któryś koliduje z rezerwacją z bazy
+    albo blokady foteli nie udało się uzyskać."""
+    try:
+        _lock_chairs({slot["chair_id"] for slot in slots})
+        for slot in slots:
+            clash = db.session.query(Booking.id).filter(
+                Booking.chair_id == slot["chair_id"], Booking.start < slot["end"], Booking.end > slot["start"],
+            ).first()
+            if clash:
+                db.session.rollback()
+                invalidate_booking_index(cabinet_id)
+                return False
+        db.session.execute(insert(Booking), [{
+            "chair_id": slot["chair_id"], "start": slot["start"], "end": slot["end"], "plan_id": plan_id,
+            "visit_idx": slot["visit_idx"], "label": f'{slot["label"]}: {slot["category"]}',
+            "created_at": datetime.utcnow(),
+        } for slot in slots])
+        db.session.commit()
+    except (IntegrityError, OperationalError):
+        # "database is locked" po busy timeout (SQLite) albo konflikt wykryty przez bazę
+        db.session.rollback()
+        invalidate_booking_index(cabinet_id)
+        return False
+    # copy-on-write: czytelnicy starego indeksu nie widzą list w trakcie zmiany
+    index = {cid: ci.copy() for cid, ci in cabinet_booking_index(cabinet_id).items()}
+    for slot in slots:
+        index[slot["chair_id"]].add(slot["start"], slot["end"])
+    with _booking_cache_lock:
+        _booking_cache[cabinet_id] = (time.monotonic() + BOOKING_CACHE_TTL, index)
+    return True
+
+
+# -----------------------------------------------------------------------------
+# KOMPRESJA / CACHE HTTP
+# -----------------------------------------------------------------------------
+COMPRESS_MIN_SIZE  = int(os.environ.get("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/csv", "application/json",
+    "application/javascript", "text/javascript", "image/svg+xml",
+}
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+DEBUG_IMAGE_MAX_AGE      = 24 * 3600
+
+_static_fingerprints = {}
+
+
+def static_fingerprint(filename):
+    """Skrót treści pliku statycznego (przeliczany tylko po zmianie mtime/rozmiaru)."""
+    path = safe_join(app.static_folder, filename)
+    if not path:
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _static_fingerprints.get(path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(65536), b""):
+            digest.update(block)
+    _static_fingerprints[path] = (stamp, digest.hexdigest()[:12])
+    return _static_fingerprints[path][1]
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', ...) -> /static/x.css?v=<skrót>; zmiana pliku = nowy URL
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        v = static_fingerprint(values["filename"])
+        if v:
+            values["v"] = v
+
+
+def _compress_response(response):
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"]:
+        encoding, body = "br", brotli.compress(data, quality=5)
+    elif accept["gzip"]:
+        encoding, body = "gzip", gzip.compress(data, compresslevel=6, mtime=0)
+    else:
+        return
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    etag, _ = response.get_etag()
+    if etag:
+        # skompresowany wariant ma inne bajty – ETag tylko słaby
+        response.set_etag(etag, weak=True)
+
+
+@app.after_request
+def http_cache_and_compress(response):
+    if request.endpoint == "static":
+        if request.args.get("v") and response.status_code in (200, 304):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+            response.cache_control.immutable = True
+        return response
+
+    if (request.method == "GET" and response.status_code == 200
+            and response.mimetype == "text/html" and not response.direct_passthrough):
+        # strony są per użytkownik – przeglądarka rewaliduje ETagiem (304 bez treści)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.add_etag()
+        response.make_conditional(request)
+
+    _compress_response(response)
+    return response
+
+# -----------------------------------------------------------------------------
+# ZASOBY FRONTENDU (lokalny pakiet z tools/build_assets.py)
+# -----------------------------------------------------------------------------
+# Gdy istnieje static/dist/manifest.json, szablony linkują lokalny, oczyszczony
+# pakiet z hashem w nazwie (warianty .br/.gz wybierane wg Accept-Encoding).
+# Bez manifestu (np. środowisko deweloperskie) zostają linki do CDN.
+ASSET_DIR = os.path.join(app.static_folder, "dist")
+CDN_CSS = [
+    "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css",
+    "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1/css/all.min.css",
+]
+CDN_JS = ["https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"]
+
+mimetypes.add_type("font/woff2", ".woff2")
+mimetypes.add_type("font/ttf", ".ttf")
+
+
+def load_asset_manifest():
+    try:
+        with open(os.path.join(ASSET_DIR, "manifest.json"), encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+ASSET_MANIFEST = load_asset_manifest()
+
+
+@app.template_global()
+def vendor_css():
+    if "vendor.css" in ASSET_MANIFEST:
+        hrefs = [url_for("assets", filename=ASSET_MANIFEST["vendor.css"])]
+    else:
+        hrefs = CDN_CSS
+    return Markup("\n  ".join(f'<link href="{h}" rel="stylesheet">' for h in hrefs))
+
+
+@app.template_global()
+def vendor_js():
+    if ASSET_MANIFEST:
+        # pakiet budowany bez JS, gdy szablony nie używają data-bs-*
+        srcs = [url_for("assets", filename=ASSET_MANIFEST["vendor.js"])] if "vendor.js" in ASSET_MANIFEST else []
+    else:
+        srcs = CDN_JS
+    return Markup("\n  ".join(f'<script src="{s}"></script>' for s in srcs))
+
+# -----------------------------------------------------------------------------
+# CACHE DOKUMENTÓW DOCX
+# -----------------------------------------------------------------------------
+# Gotowe pliki DOCX leżą na dysku pod kluczem = sha256(tekst planu + papier firmowy
+# gabinetu). Zmiana danych gabinetu lub logo (nazwy logo to hash treści) daje nowy
+# klucz, więc cache nie wymaga unieważniania. Klucz jest jednocześnie ETagiem.
+# Rozmiar katalogu jest ograniczony – przy przekroczeniu usuwane są pliki najdawniej
+# użyte (atime ustawiane jawnie przy każdym trafieniu, niezależnie od opcji montowania).
+DOCX_CACHE_DIR = os.environ.get("DOCX_CACHE_DIR") or os.path.join(app.instance_path, "docx_cache")
+DOCX_CACHE_MAX_BYTES = int(os.environ.get("DOCX_CACHE_MAX_MB", "256")) * 1024 * 1024
+DOCX_MIMETYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+DOCX_CACHE_REQUESTS = register_metric(Counter(
+    "lotti_docx_cache_requests_total", "Pobrania DOCX wg wyniku cache (hit/miss).", ("result",)))
+
+_docx_cache_bytes = None   # przybliżony rozmiar katalogu w tym procesie
+_docx_cache_lock = threading.Lock()
+
+
+def clinic_letterhead(cabinet):
+    """Dane nagłówka dokumentu dla create_word_doc (przyjmuje Cabinet lub CabinetInfo)."""
+    logo = cabinet.logo_docx or cabinet.logo
+    return {
+        "logo_path":   os.path.join(UPLOAD_FOLDER, logo) if logo
+                       else os.path.join(app.static_folder, "Lottiimage.png"),
+        "doctor_name": cabinet.doctor_name,
+        "clinic_name": cabinet.name,
+        "street":      cabinet.street,
+        "flat_number": cabinet.flat_number,
+        "postal_code": cabinet.postal_code,
+        "city":        cabinet.city,
+    }
+
+
+def docx_cache_key(plan_text, clinic, issued):
+    # data wystawienia jest w treści dokumentu, więc musi być częścią klucza
+    letterhead = json.dumps(clinic, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(f"{letterhead}\0{issued:%Y-%m-%d}\0{plan_text}".encode("utf-8")).hexdigest()[:40]
+
+
+def _docx_cache_size():
+    total = 0
+    with os.scandir(DOCX_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".docx"):
+                total += entry.stat().st_size
+    return total
+
+
+def _evict_docx_cache():
+    """Usuwa najdawniej używane pliki, aż katalog zejdzie do 90% limitu."""
+    entries = []
+    with os.scandir(DOCX_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".docx"):
+                st = entry.stat()
+                entries.append((st.st_atime, st.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    target = DOCX_CACHE_MAX_BYTES * 0.9
+    for _, size, path in sorted(entries):
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # usunięty równolegle przez inny worker
+        total -= size
+    return total
+
+
+def cached_word_doc(plan_text, clinic, issued=None):
+    """Ścieżka do pliku DOCX z cache (generowanego przy pierwszym użyciu) i jego klucz."""
+    global _docx_cache_bytes
+    issued = issued or datetime.now().date()
+    key = docx_cache_key(plan_text, clinic, issued)
+    path = os.path.join(DOCX_CACHE_DIR, f"{key}.docx")
+    try:
+        st = os.stat(path)
+        os.utime(path, (time.time(), st.st_mtime))  # LRU: atime = ostatnie użycie, mtime bez zmian
+        DOCX_CACHE_REQUESTS.inc("hit")
+        return path, key
+    except FileNotFoundError:
+        pass
+
+    DOCX_CACHE_REQUESTS.inc("miss")
+    with timed("docx"):
+        data = create_word_doc(plan_text, clinic, issued).getvalue()
+    os.makedirs(DOCX_CACHE_DIR, exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+
+    with _docx_cache_lock:
+        if _docx_cache_bytes is None:
+            _docx_cache_bytes = _docx_cache_size()
+        else:
+            _docx_cache_bytes += len(data)
+        if _docx_cache_bytes > DOCX_CACHE_MAX_BYTES:
+            _docx_cache_bytes = _evict_docx_cache()
+    return path, key
+
+
+def send_word_doc(plan_text, clinic, download_name="plan_leczenia.docx", issued=None):
+    issued = issued or datetime.now().date()
+    path, key = cached_word_doc(plan_text, clinic, issued)
+    try:
+        response = send_file(
+            path, as_attachment=True, download_name=download_name, mimetype=DOCX_MIMETYPE,
+            etag=key, last_modified=os.stat(path).st_mtime, conditional=True,
+        )
+    except FileNotFoundError:
+        # plik usunięty przez eviction innego workera między stat a otwarciem
+        return send_file(create_word_doc(plan_text, clinic, issued), as_attachment=True,
+                         download_name=download_name, mimetype=DOCX_MIMETYPE)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# -----------------------------------------------------------------------------
+# PRZETWARZANIE WSADOWE (CLI)
+# -----------------------------------------------------------------------------
+# flask --app app batch-plans karty.jsonl plany.jsonl [--workers N] [--docx-dir DIR]
+#
+# Wejście: JSONL z rekordami {"cabinet_id": ..., "input_data": "...", "id": opcjonalne}.
+# Wyjście: JSONL w kolejności wejścia, jeden rekord wyniku (lub błędu) na linię.
+# Plik czytany jest oknami po workers * chunk_size * 4 rekordów – Pool.imap sam z siebie
+# wciągnąłby cały iterator do kolejki, więc pamięć nie zależy od rozmiaru pliku tylko dzięki oknom.
+VISIT_EXPORT_FIELDS = ("idx", "label", "category", "teeth", "count", "minutes", "base_cost", "extra")
+
+_batch_cabinets = {}   # per proces roboczy: cabinet_id -> (Pricing, nagłówek DOCX) lub None
+_batch_docx_dir = None
+
+
+def _batch_worker_init(docx_dir):
+    global _batch_docx_dir
+    _batch_docx_dir = docx_dir
+    _batch_cabinets.clear()
+    # połączenia odziedziczone po fork nie mogą być współdzielone z procesem nadrzędnym
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def _batch_cabinet(cabinet_id):
+    if cabinet_id not in _batch_cabinets:
+        cabinet = db.session.get(Cabinet, cabinet_id)
+        _batch_cabinets[cabinet_id] = (
+            (load_pricing(cabinet_id), clinic_letterhead(cabinet)) if cabinet else None
+        )
+    return _batch_cabinets[cabinet_id]
+
+
+def _batch_plan(task):
+    lineno, record = task
+    out = {"line": lineno}
+    if "id" in record:
+        out["id"] = record["id"]
+    try:
+        cabinet_id = int(record["cabinet_id"])
+        input_data = str(record.get("input_data") or "").strip()
+        out["cabinet_id"] = cabinet_id
+        with app.app_context():
+            cabinet = _batch_cabinet(cabinet_id)
+        if cabinet is None:
+            out["error"] = f"nieznany gabinet {cabinet_id}"
+            return out
+        pricing, clinic = cabinet
+
+        parsed = parse_input(input_data)
+        result = aggregate_plan(parsed, pricing.price_map, pricing.desc_map,
+                                pricing.duration_map, pricing.per_tooth_map)
+        visits = generate_visit_plan(parsed, pricing.duration_map, pricing.price_map, pricing.per_tooth_map)
+        out["plan_text"] = format_plan_as_text(result, pricing.price_map)
+        out["visits"] = [{k: v[k] for k in VISIT_EXPORT_FIELDS if k in v} for v in visits]
+
+        if _batch_docx_dir:
+            name = f"{record.get('id', lineno)}.docx"
+            path = os.path.join(_batch_docx_dir, secure_filename(name) or f"{lineno}.docx")
+            with open(path, "wb") as fh:
+                fh.write(create_word_doc(out["plan_text"], clinic).getvalue())
+            out["docx"] = path
+    except Exception as exc:
+        out["error"] = f"{type(exc).__name__}: {exc}"
+    return out
+
+
+def _read_batch_tasks(fh):
+    for lineno, line in enumerate(fh, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict) or "cabinet_id" not in record:
+                raise ValueError("oczekiwano obiektu z polem cabinet_id")
+        except ValueError as exc:
+            yield lineno, {"__error__": str(exc)}
+            continue
+        yield lineno, record
+
+
+def _window(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@app.cli.command("batch-plans")
+@click.argument("input_path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output_path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--workers", type=int, default=os.cpu_count() or 1, show_default=True)
+@click.option("--chunk-size", type=int, default=32, show_default=True, help="rekordów na zadanie procesu")
+@click.option("--docx-dir", type=click.Path(file_okay=False), help="katalog na pliki DOCX (opcjonalnie)")
+def batch_plans_command(input_path, output_path, workers, chunk_size, docx_dir):
+    """Generuje plany z pliku JSONL kart w puli procesów."""
+    if docx_dir:
+        os.makedirs(docx_dir, exist_ok=True)
+    ok = failed = 0
+    started = time.perf_counter()
+    with open(input_path, encoding="utf-8") as src, \
+         open(output_path, "w", encoding="utf-8") as dst, \
+         multiprocessing.Pool(workers, initializer=_batch_worker_init, initargs=(docx_dir,)) as pool:
+        for window in _window(_read_batch_tasks(src), workers * chunk_size * 4):
+            valid = [t for t in window if "__error__" not in t[1]]
+            results = iter(pool.imap(_batch_plan, valid, chunksize=chunk_size))
+            for lineno, record in window:
+                if "__error__" in record:
+                    out = {"line": lineno, "error": record["__error__"]}
+                else:
+                    out = next(results)
+                failed += "error" in out
+                ok += "error" not in out
+                dst.write(json.dumps(out, ensure_ascii=False) + "\n")
+    elapsed = time.perf_counter() - started
+    click.echo(f"Plany: {ok} ok, {failed} błędów w {elapsed:.1f} s ({(ok + failed) / max(elapsed, 1e-9):.0f} rek./s)")
+
+
+# -----------------------------------------------------------------------------
+# HASŁA (weryfikacja w osobnej, ograniczonej puli)
+# -----------------------------------------------------------------------------
+# Hashowanie (scrypt/pbkdf2) zwalnia GIL, ale potrafi zająć rdzeń na setki ms.
+# Fala logowań nie może zagłodzić wątków obsługujących plany, więc weryfikacja
+# idzie do puli PASSWORD_HASH_WORKERS wątków; ponad PASSWORD_HASH_MAX_PENDING
+# oczekujących logowanie dostaje 503 zamiast czekać w nieskończoność.
+#
+# PASSWORD_HASH_METHOD to metoda werkzeug, np. "scrypt", "scrypt:65536:8:1",
+# "pbkdf2:sha256:600000". Hash zapisany inną metodą/kosztem jest po udanym
+# logowaniu przeliczany według bieżącej polityki.
+PASSWORD_HASH_METHOD      = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+PASSWORD_HASH_WORKERS     = int(os.environ.get("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get("PASSWORD_HASH_MAX_PENDING", "32"))
+PASSWORD_HASH_TIMEOUT     = float(os.environ.get("PASSWORD_HASH_TIMEOUT", "10"))
+
+_hash_executor = None
+_hash_executor_pid = None
+_hash_executor_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(PASSWORD_HASH_MAX_PENDING)
+_hash_pending = 0
+_policy_prefix = None
+_dummy_hash = None
+
+LOGIN_HASH_SECONDS = register_metric(Histogram(
+    "lotti_login_hash_seconds", "Czas weryfikacji hasła: oczekiwanie w kolejce i samo hashowanie.", ("phase",)))
+LOGINS = register_metric(Counter(
+    "lotti_logins_total", "Próby logowania wg wyniku (ok, invalid, rejected, rehashed).", ("result",)))
+register_metric(Gauge(
+    "lotti_login_hash_pending", "Weryfikacje haseł w kolejce lub w trakcie.", lambda: _hash_pending))
+
+
+class HashQueueFull(Exception):
+    pass
+
+
+def _executor():
+    """Pula tworzona leniwie i na nowo po fork (wątki nie przechodzą do procesu potomnego)."""
+    global _hash_executor, _hash_executor_pid
+    if _hash_executor_pid != os.getpid():
+        with _hash_executor_lock:
+            if _hash_executor_pid != os.getpid():
+                _hash_executor = concurrent.futures.ThreadPoolExecutor(
+                    PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+                _hash_executor_pid = os.getpid()
+    return _hash_executor
+
+
+def _run_hashing(fn, *args):
+    global _hash_pending
+    if not _hash_slots.acquire(blocking=False):
+        raise HashQueueFull()
+    with _hash_executor_lock:
+        _hash_pending += 1
+    submitted = time.perf_counter()
+
+    def task():
+        started = time.perf_counter()
+        LOGIN_HASH_SECONDS.observe(started - submitted, "queue")
+        try:
+            return fn(*args)
+        finally:
+            LOGIN_HASH_SECONDS.observe(time.perf_counter() - started, "hash")
+
+    def done(_future):
+        # slot zwalnia zakończenie (lub anulowanie) zadania, nie koniec czekania wywołującego –
+        # hash porzucony po timeoucie nadal zajmuje pulę i jest liczony w kolejce
+        global _hash_pending
+        with _hash_executor_lock:
+            _hash_pending -= 1
+        _hash_slots.release()
+
+    try:
+        future = _executor().submit(task)
+    except BaseException:
+        done(None)
+        raise
+    future.add_done_callback(done)
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        future.cancel()  # jeszcze w kolejce – nie zostanie policzony
+        raise HashQueueFull()
+
+
+def password_policy_prefix():
+    """Metoda z parametrami kosztu (część hasha przed pierwszym '$') dla bieżącej polityki."""
+    global _policy_prefix
+    if _policy_prefix is None:
+        _policy_prefix = generate_password_hash("", method=PASSWORD_HASH_METHOD).split("$", 1)[0]
+    return _policy_prefix
+
+
+def verify_login(username, password):
+    """User przy poprawnych danych, inaczej None; HashQueueFull przy przeciążeniu puli."""
+    global _dummy_hash
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        # ten sam koszt co dla istniejącego konta – czas odpowiedzi nie zdradza loginów
+        if _dummy_hash is None:
+            _dummy_hash = generate_password_hash("-", method=PASSWORD_HASH_METHOD)
+        _run_hashing(check_password_hash, _dummy_hash, password)
+        LOGINS.inc("invalid")
+        return None
+    if not _run_hashing(check_password_hash, user.password_hash, password):
+        LOGINS.inc("invalid")
+        return None
+    LOGINS.inc("ok")
+    if user.password_hash.split("$", 1)[0] != password_policy_prefix():
+        try:
+            user.password_hash = _run_hashing(generate_password_hash, password, PASSWORD_HASH_METHOD)
+        except HashQueueFull:
+            # hasło jest poprawne – przehashowanie poczeka do któregoś z kolejnych logowań
+            return user
+        db.session.commit()
+        LOGINS.inc("rehashed")
+    return user
+
+
 # -----------------------------------------------------------------------------
 # AUTH / GUARD
 # -----------------------------------------------------------------------------
 @app.before_request
 def require_login():
-    allowed = {"login", "static", "healthz", "__healthz", "debug_image"}
-    if request.endpoint not in allowed and "user_id" not in session:
+    allowed = {"login", "static", "assets", "healthz", "__healthz", "readyz", "debug_image", "metrics"}
+    g.user_id = session.get("user_id")
+    if request.endpoint not in allowed and g.user_id is None:
+        if request.path.startswith(API_PREFIX):
+            return json_response({"error": "unauthorized"}, 401)
         return redirect(url_for("login"))
 
 @app.route("/login", methods=["GET","POST"])
 def login():
     error = ""
     if request.method == "POST":
-        u = User.query.filter_by(username=request.form["username"]).first()
-        if u and u.check_password(request.form["password"]):
+        try:
+            u = verify_login(request.form["username"], request.form["password"])
+        except HashQueueFull:
+            LOGINS.inc("rejected")
+            error = "Serwer jest chwilowo przeciążony – spróbuj ponownie za kilka sekund."
+            return render_template_string(login_template, error=error), 503, {"Retry-After": "5"}
+        if u:
             session["user_id"] = u.id
             return redirect(url_for("index"))
         error = "Niepoprawna nazwa użytkownika lub hasło."
@@ -1659,23 +3935,160 @@ def logout():
     session.clear()
     return redirect(url_for("login"))
 
+# -----------------------------------------------------------------------------
+# ADMISJA (limity współbieżności drogich endpointów)
+# -----------------------------------------------------------------------------
+# Generowanie planu i DOCX zajmują CPU w stałej puli wątków gunicorna. Każda
+# grupa endpointów ma własną bramkę: ADMIT_<GRUPA>_CONCURRENCY żądań naraz,
+# a pozostałe czekają w kolejce ograniczonej per klasa priorytetu. Ruch
+# interaktywny (formularze klinicystów) ma pierwszeństwo przed wsadowym
+# (/api/* lub nagłówek X-Lotti-Priority: batch), a wsadowy zajmuje najwyżej
+# ADMIT_BATCH_MAX_ACTIVE miejsc. Ponad kolejkę albo po ADMIT_WAIT_SECONDS
+# oczekiwania żądanie dostaje od razu 503 z Retry-After.
+ADMISSION          = os.environ.get("ADMISSION", "1") != "0"
+ADMIT_WAIT_SECONDS = float(os.environ.get("ADMIT_WAIT_SECONDS", "5"))
+ADMIT_RETRY_AFTER  = os.environ.get("ADMIT_RETRY_AFTER", "2")
+ADMIT_QUEUE = {
+    "interactive": int(os.environ.get("ADMIT_QUEUE_INTERACTIVE", "16")),
+    "batch":       int(os.environ.get("ADMIT_QUEUE_BATCH", "4")),
+}
+PRIORITIES = ("interactive", "batch")   # od najważniejszej
+
+# (endpoint, metoda) -> bramka
+ADMISSION_ROUTES = {
+    ("index", "POST"): "plan",
+    ("view_or_edit_plan", "GET"): "plan",   # zimny planner = pełne przeliczenie planu
+    ("view_or_edit_plan", "POST"): "plan",
+    ("api_plan", "POST"): "plan",
+    ("api_compare", "POST"): "plan",
+    ("download_docx", "POST"): "docx",
+    ("download_saved_plan", "GET"): "docx",
+}
+
+ADMISSION_DECISIONS = register_metric(Counter(
+    "lotti_admission_total", "Decyzje bramek (admitted, rejected = pełna kolejka, timeout).",
+    ("gate", "priority", "result")))
+ADMISSION_WAIT = register_metric(Histogram(
+    "lotti_admission_wait_seconds", "Czas oczekiwania w kolejce bramki.", ("gate", "priority")))
+
+
+class AdmissionGate:
+    def __init__(self, name, limit, batch_limit, queues, timeout):
+        self.name, self.limit, self.timeout = name, limit, timeout
+        self.class_limit = {"interactive": limit, "batch": min(batch_limit, limit)}
+        self.queues = queues
+        self.active = dict.fromkeys(PRIORITIES, 0)
+        self.waiting = dict.fromkeys(PRIORITIES, 0)
+        self._cond = threading.Condition()
+
+    def _can_enter(self, priority):
+        if sum(self.active.values()) >= self.limit or self.active[priority] >= self.class_limit[priority]:
+            return False
+        # wyższe klasy czekające w kolejce wchodzą pierwsze
+        higher = PRIORITIES[:PRIORITIES.index(priority)]
+        return not any(self.waiting[p] for p in higher)
+
+    def acquire(self, priority):
+        """'admitted', 'rejected' (kolejka pełna) albo 'timeout'."""
+        with self._cond:
+            if self._can_enter(priority):
+                self.active[priority] += 1
+                return "admitted"
+            if self.waiting[priority] >= self.queues[priority]:
+                return "rejected"
+            self.waiting[priority] += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while not self._can_enter(priority):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return "timeout"
+                    self._cond.wait(remaining)
+                self.active[priority] += 1
+                return "admitted"
+            finally:
+                self.waiting[priority] -= 1
+                # zwolnione miejsce w kolejce wyższej klasy może odblokować niższą
+                self._cond.notify_all()
+
+    def release(self, priority):
+        with self._cond:
+            self.active[priority] -= 1
+            self._cond.notify_all()
+
+
+def _gate(name, default_limit):
+    limit = int(os.environ.get(f"ADMIT_{name.upper()}_CONCURRENCY", default_limit))
+    batch_limit = int(os.environ.get("ADMIT_BATCH_MAX_ACTIVE", max(1, limit // 2)))
+    return AdmissionGate(name, limit, batch_limit, ADMIT_QUEUE, ADMIT_WAIT_SECONDS)
+
+
+ADMISSION_GATES = {gate.name: gate for gate in (_gate("plan", 4), _gate("docx", 2))}
+
+register_metric(Gauge(
+    "lotti_admission_queue_length", "Żądania czekające w kolejce bramki.",
+    lambda: {(n, p): gate.waiting[p] for n, gate in ADMISSION_GATES.items() for p in PRIORITIES},
+    ("gate", "priority")))
+register_metric(Gauge(
+    "lotti_admission_active", "Żądania obsługiwane w ramach bramki.",
+    lambda: {(n, p): gate.active[p] for n, gate in ADMISSION_GATES.items() for p in PRIORITIES},
+    ("gate", "priority")))
+
+
+def request_priority():
+    # nagłówek może tylko obniżyć priorytet – klient wsadowy nie podszyje się pod interaktywny
+    if request.path.startswith(API_PREFIX) or request.headers.get("X-Lotti-Priority", "").lower() == "batch":
+        return "batch"
+    return "interactive"
+
+
+@app.before_request
+def admission_control():
+    if not ADMISSION:
+        return None
+    gate = ADMISSION_GATES.get(ADMISSION_ROUTES.get((request.endpoint, request.method)))
+    if gate is None:
+        return None
+    priority = request_priority()
+    t0 = time.perf_counter()
+    result = gate.acquire(priority)
+    ADMISSION_WAIT.observe(time.perf_counter() - t0, gate.name, priority)
+    ADMISSION_DECISIONS.inc(gate.name, priority, result)
+    if result == "admitted":
+        g.admission = (gate, priority)
+        return None
+    headers = {"Retry-After": ADMIT_RETRY_AFTER}
+    if request.path.startswith(API_PREFIX):
+        resp = json_response({"error": "overloaded", "gate": gate.name}, 503)
+        resp.headers.update(headers)
+        return resp
+    return "Serwer jest chwilowo przeciążony – spróbuj ponownie za kilka sekund.", 503, headers
+
+
+@app.teardown_request
+def admission_release(exc):
+    admission = g.pop("admission", None)
+    if admission is not None:
+        gate, priority = admission
+        gate.release(priority)
+
 # -----------------------------------------------------------------------------
 # ENDPOINTY GŁÓWNE
 # -----------------------------------------------------------------------------
 @app.route("/", methods=["GET","POST"])
 def index():
-    all_cabinets = Cabinet.query.filter_by(user_id=session["user_id"]).all()
+    all_cabinets = user_cabinets(g.user_id)
     input_data  = ""
     result      = {}
     visits      = []
     error       = ""
     selected_id = None
 
-    types     = TreatmentType.query.all()
-    price_map = {t.name: t.default_price       for t in types}
-    desc_map  = {t.name: t.default_description for t in types}
+    cat       = catalog()
+    price_map = dict(cat.price_map)
+    desc_map  = dict(cat.desc_map)
 
-    duration_map = {pc.code: pc.default_duration for pc in ProcedureCode.query.all()}
+    duration_map = dict(cat.duration_map)
 
     if request.method == "POST":
         selected_id = request.form.get("cabinet_id")
@@ -1689,47 +4102,23 @@ def index():
             if len(all_cabinets) == 1:
                 selected_id = all_cabinets[0].id
 
-            treatments = Treatment.query.filter_by(cabinet_id=selected_id).all()
-            cds        = CodeDuration.query.filter_by(cabinet_id=selected_id).all()
-
-            by_code = defaultdict(list)
-            for cd in cds:
-                by_code[cd.procedure_code].append(cd.duration)
-            for proc_code, lst in by_code.items():
-                ds = sorted(lst); n=len(ds); trim=int(n*0.1)
-                trimmed = ds[trim: n-trim] or ds
-                optimal = sum(trimmed)//len(trimmed)
-                duration_map[proc_code] = optimal
-
-            per_tooth_map = {}
-            for t in treatments:
-                desc_map[t.type] = t.description or ""
-                if t.type == "Gingiwoplastyka":
-                    price_map[t.type]     = t.base_price or 0
-                    per_tooth_map[t.type] = t.per_tooth_price or 0
-                else:
-                    price_map[t.type]     = t.price or 0
+            # tylko gabinety użytkownika – cudzy lub nieprawidłowy identyfikator -> 404
+            selected_id = user_cabinet_or_404(selected_id).id
+            pricing = load_pricing(selected_id)
+            price_map, desc_map, per_tooth_map, duration_map = pricing
 
             if input_data:
-                result = generate_treatment_plan(input_data, price_map, desc_map, duration_map, per_tooth_map)
-                parsed = parse_input(input_data)
-                visits = generate_visit_plan(parsed, duration_map, price_map, per_tooth_map)
-                plan_text = format_plan_as_text(result, price_map)
-
-                new_plan = GeneratedPlan(
-                    user_id=session["user_id"],
-                    cabinet_id=selected_id,
-                    input_data=input_data,
-                    plan_text=plan_text
-                )
-                db.session.add(new_plan); db.session.commit()
+                built = build_plan(input_data, pricing)
+                result, visits = built.result, built.visits
+                save_generated_plan(session["user_id"], selected_id, input_data, built.plan_text,
+                                    built.input_hash, built.pricing_version, built.tooth_masks, built.stats)
 
     result_items = []
     for cat, data in result.items():
         teeth = data.get("teeth", [])
         times = data.get("times", [])
-        data["items"] = list(zip(teeth, times))
-        result_items.append((cat, data))
+        # kopia – result może pochodzić ze współdzielonego cache build_plan
+        result_items.append((cat, dict(data, items=list(zip(teeth, times)))))
 
     return render_template_string(
         main_template,
@@ -1748,54 +4137,70 @@ def index():
 def list_generated_plans():
     user_id = session.get("user_id")
     if not user_id: return redirect(url_for("login"))
-    plans = GeneratedPlan.query.filter_by(user_id=user_id).order_by(GeneratedPlan.created_at.desc()).all()
+    # projekcja z nazwą gabinetu (JOIN) zamiast leniwego p.cabinet per wiersz;
+    # plan_text nie jest potrzebny na liście, a input_data tylko w skrócie
+    # plany zarchiwizowane dochodzą przez UNION ALL ze skrótem wejścia zapisanym jawnie
+    hot = select(
+        GeneratedPlan.id, GeneratedPlan.created_at,
+        func.substr(GeneratedPlan.input_data, 1, 200).label("input_data"), GeneratedPlan.cabinet_id,
+    ).where(GeneratedPlan.user_id == user_id)
+    cold = select(
+        ArchivedPlan.id, ArchivedPlan.created_at,
+        ArchivedPlan.input_preview.label("input_data"), ArchivedPlan.cabinet_id,
+    ).where(ArchivedPlan.user_id == user_id)
+    all_plans = union_all(hot, cold).subquery()
+    plans = (
+        db.session.query(
+            all_plans.c.id,
+            all_plans.c.created_at,
+            all_plans.c.input_data,
+            Cabinet.name.label("cabinet_name"),
+        )
+        .join(Cabinet, Cabinet.id == all_plans.c.cabinet_id)
+        .order_by(all_plans.c.created_at.desc())
+        .all()
+    )
     return render_template_string(plans_list_template, plans=plans)
 
 @app.route("/plans/<int:plan_id>", methods=["GET","POST"])
 def view_or_edit_plan(plan_id):
-    plan = GeneratedPlan.query.get_or_404(plan_id)
+    plan = load_plan_or_404(plan_id)
     if plan.user_id != session.get("user_id"):
         return redirect(url_for("list_generated_plans"))
 
-    types = TreatmentType.query.all()
-    price_map = {t.name: t.default_price for t in types}
-    desc_map  = {t.name: t.default_description for t in types}
-
-    treatments_db = Treatment.query.filter_by(cabinet_id=plan.cabinet_id).all()
-    per_tooth_map = {}
-    for t in treatments_db:
-        desc_map[t.type] = t.description or ""
-        if t.type == "Gingiwoplastyka":
-            price_map[t.type] = t.base_price or 0
-            per_tooth_map[t.type] = t.per_tooth_price or 0
-        else:
-            price_map[t.type] = t.price or 0
-
-    duration_map = {pc.code: pc.default_duration for pc in ProcedureCode.query.all()}
+    # czasy z katalogu, bez historii gabinetu – jak przy pierwotnym podglądzie planu
+    pricing = load_pricing(plan.cabinet_id, history=False)
+    price_map, desc_map, per_tooth_map, duration_map = pricing
 
     if request.method == "POST":
         new_input = (request.form.get("input_data") or "").strip()
         if new_input:
-            parsed = parse_input(new_input)
-            new_result = generate_treatment_plan(new_input, price_map, desc_map, duration_map, per_tooth_map)
-            new_visits = generate_visit_plan(parsed, duration_map, price_map, per_tooth_map)
-            new_plan_text = format_plan_as_text(new_result, price_map)
+            # podgląd przed edycją zostawił stan plannera – przeliczane są tylko zmienione kategorie
+            built = plan_incrementally(plan.id, new_input, pricing)
+            if plan.is_archived:
+                plan = restore_archived_plan(plan.id)
+            now = datetime.utcnow()
+            record_plan_revision(plan, new_input, built.plan_text, now)
             plan.input_data = new_input
-            plan.plan_text  = new_plan_text
-            plan.created_at = datetime.utcnow()
+            plan.plan_text  = built.plan_text
+            plan.created_at = now
+            # klucz deduplikacji opisywał poprzednią treść; NULL nie koliduje w ux_generated_plan_dedupe
+            plan.input_hash = plan.pricing_version = None
+            replace_tooth_masks(plan.id, plan.user_id, plan.cabinet_id, built.tooth_masks)
+            remove_plan_stats(plan.id)
+            add_plan_stats(plan.id, plan.cabinet_id, now, built.stats)
             db.session.commit()
         return redirect(url_for("list_generated_plans"))
 
-    parsed = parse_input(plan.input_data)
-    result = generate_treatment_plan(plan.input_data, price_map, desc_map, duration_map, per_tooth_map)
-    visits = generate_visit_plan(parsed, duration_map, price_map, per_tooth_map)
+    built = plan_incrementally(plan.id, plan.input_data, pricing)
+    result, visits = built.result, built.visits
 
     result_items = []
     for cat, data in result.items():
         teeth = data.get("teeth", [])
         times = data.get("times", [])
-        data["items"] = list(zip(teeth, times))
-        result_items.append((cat, data))
+        # kopia – bloki kategorii są współdzielone ze stanem plannera
+        result_items.append((cat, dict(data, items=list(zip(teeth, times)))))
 
     return render_template_string(
         plan_detail_template,
@@ -1811,56 +4216,39 @@ def view_or_edit_plan(plan_id):
 
 @app.route("/plans/<int:plan_id>/delete", methods=["POST"])
 def delete_plan(plan_id):
-    plan = GeneratedPlan.query.get_or_404(plan_id)
+    plan = load_plan_or_404(plan_id)
     if plan.user_id != session.get("user_id"):
         return redirect(url_for("list_generated_plans"))
-    db.session.delete(plan); db.session.commit()
+    if plan.is_archived:
+        db.session.query(ArchivedPlan).filter_by(id=plan.id).delete()
+    else:
+        db.session.delete(plan)
+    PlanToothMask.query.filter_by(plan_id=plan.id).delete()
+    delete_plan_revisions(plan.id)
+    remove_plan_stats(plan.id)
+    db.session.commit()
+    forget_planner(plan.id)
     return redirect(url_for("list_generated_plans"))
 
 @app.route("/download", methods=["POST"])
 def download_docx():
     cabinet_id = request.form["cabinet_id"]
     input_data = (request.form.get("input_data") or "").strip()
-    cabinet    = Cabinet.query.get_or_404(cabinet_id)
-
-    types         = TreatmentType.query.all()
-    price_map     = {t.name: t.default_price       for t in types}
-    desc_map      = {t.name: t.default_description for t in types}
-    treatments    = Treatment.query.filter_by(cabinet_id=cabinet_id).all()
-    per_tooth_map = {}
-    for t in treatments:
-        desc_map[t.type] = t.description
-        if t.type == "Gingiwoplastyka":
-            price_map[t.type]     = t.base_price or 0
-            per_tooth_map[t.type] = t.per_tooth_price or 0
-        else:
-            price_map[t.type]     = t.price or 0
-
-    duration_map = {pc.code: pc.default_duration for pc in ProcedureCode.query.all()}
-    for t in treatments:
-        if t.duration is not None:
-            duration_map[t.type] = t.duration
-
-    plan      = generate_treatment_plan(input_data, price_map, desc_map, duration_map, per_tooth_map)
-    plan_text = format_plan_as_text(plan, price_map)
-
-    logo_path = os.path.join(app.static_folder, "uploads", cabinet.logo) if cabinet.logo \
-                else os.path.join(app.static_folder, "Lottiimage.png")
-
-    clinic = {
-        "logo_path":   logo_path,
-        "doctor_name": cabinet.doctor_name,
-        "clinic_name": cabinet.name,
-        "street":      cabinet.street,
-        "flat_number": cabinet.flat_number,
-        "postal_code": cabinet.postal_code,
-        "city":        cabinet.city
-    }
-    f = create_word_doc(plan_text, clinic)
-    return send_file(
-        f, as_attachment=True, download_name="plan_leczenia.docx",
-        mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    )
+    cabinet    = user_cabinet_or_404(cabinet_id)
+
+    # ten sam cennik co strona główna i API – zwykle trafienie w cache build_plan po POST /
+    plan_text = build_plan(input_data, load_pricing(cabinet.id)).plan_text
+    return send_word_doc(plan_text, clinic_letterhead(cabinet))
+
+@app.route("/plans/<int:plan_id>/download")
+def download_saved_plan(plan_id):
+    """DOCX zapisanego planu – z zapisanego tekstu, bez ponownego generowania."""
+    plan = load_plan_or_404(plan_id)
+    if plan.user_id != g.user_id:
+        abort(404)
+    cabinet = user_cabinet_or_404(plan.cabinet_id)
+    return send_word_doc(plan.plan_text, clinic_letterhead(cabinet),
+                         download_name=f"plan_leczenia_{plan.id}.docx", issued=plan.created_at.date())
 
 @app.route("/admin/cabinets", methods=["GET","POST"])
 def admin_cabinets():
@@ -1874,27 +4262,25 @@ def admin_cabinets():
         postal_code = request.form["postal_code"].strip()
         city        = request.form["city"].strip()
 
-        logo_filename = None
-        if logo_file and logo_file.filename:
-            logo_filename = f"{uuid.uuid4().hex}_{secure_filename(logo_file.filename)}"
-            logo_file.save(os.path.join(UPLOAD_FOLDER, logo_filename))
+        logos = process_logo_upload(logo_file) or {}
 
         cab = Cabinet(
-            name=name, logo=logo_filename, doctor_name=doctor_name,
+            name=name, doctor_name=doctor_name, **logos,
             street=street, flat_number=flat_number, postal_code=postal_code,
             city=city, user_id=session["user_id"]
         )
         db.session.add(cab); db.session.commit()
+        invalidate_user_cabinets(session["user_id"])
         message = f"Gabinet „{name}” został dodany."
 
-    cabinets = Cabinet.query.filter_by(user_id=session["user_id"]).all()
+    cabinets = user_cabinets(g.user_id)
     return render_template_string(cabinets_template, cabinets=cabinets, message=message)
 
 @app.route("/admin/cabinets/<cabinet_id>/treatments", methods=["GET","POST"])
 def admin_treatments(cabinet_id):
-    cabinet = Cabinet.query.get_or_404(cabinet_id)
+    cabinet = user_cabinet_or_404(cabinet_id)
     message = ""
-    types = TreatmentType.query.all()
+    types = catalog().types
 
     if request.method == "POST":
         chosen_name = request.form["type"]
@@ -1913,14 +4299,14 @@ def admin_treatments(cabinet_id):
 
 @app.route("/admin/cabinets/<cabinet_id>/treatments/<treatment_id>/delete", methods=["POST"])
 def delete_treatment(cabinet_id, treatment_id):
-    cabinet = Cabinet.query.get_or_404(cabinet_id)
+    cabinet = user_cabinet_or_404(cabinet_id)
     tr = Treatment.query.filter_by(id=treatment_id, cabinet_id=cabinet.id).first_or_404()
     db.session.delete(tr); db.session.commit()
     return redirect(url_for("admin_treatments", cabinet_id=cabinet.id))
 
 @app.route("/admin/cabinets/<cabinet_id>/treatments/<treatment_id>/edit", methods=["GET","POST"])
 def edit_treatment(cabinet_id, treatment_id):
-    cabinet = Cabinet.query.get_or_404(cabinet_id)
+    cabinet = user_cabinet_or_404(cabinet_id)
     tr = Treatment.query.filter_by(id=treatment_id, cabinet_id=cabinet.id).first_or_404()
     if request.method == "POST":
         tr.description = request.form["description"].strip()
@@ -1929,9 +4315,19 @@ def edit_treatment(cabinet_id, treatment_id):
         return redirect(url_for("admin_treatments", cabinet_id=cabinet.id))
     return render_template_string(edit_treatment_template, cabinet=cabinet, treatment=tr)
 
+def _code_matches_treatment(procedure_code, treatment_type):
+    if treatment_type == "Gingiwoplastyka":
+        return procedure_code.strip().endswith("Gingiwoplastyka")
+    m = re.match(r"^(\d{2})\s+(.+)$", procedure_code)
+    if m:
+        tooth_code = m.group(1); proc_short = m.group(2).strip()
+        cat, _ = classify_entry({"tooth_code": tooth_code, "treatment_code": proc_short})
+        return cat == treatment_type
+    return procedure_code == treatment_type
+
 @app.route("/admin/cabinets/<cabinet_id>/treatments/<treatment_id>/durations", methods=["GET","POST"])
 def add_duration(cabinet_id, treatment_id):
-    cabinet   = Cabinet.query.get_or_404(cabinet_id)
+    cabinet   = user_cabinet_or_404(cabinet_id)
     treatment = Treatment.query.filter_by(id=treatment_id, cabinet_id=cabinet.id).first_or_404()
 
     all_durations = (
@@ -1942,38 +4338,40 @@ def add_duration(cabinet_id, treatment_id):
     seeded = [pc.code for pc in ProcedureCode.query.filter_by(category_name=treatment.type).all()]
     if not seeded: seeded = [treatment.type]
 
-    history_entries = []
-    for entry in all_durations:
-        if treatment.type == "Gingiwoplastyka":
-            if entry.procedure_code.strip().endswith("Gingiwoplastyka"):
-                history_entries.append(entry)
-        else:
-            m = re.match(r"^(\d{2})\s+(.+)$", entry.procedure_code)
-            if m:
-                tooth_code = m.group(1); proc_short = m.group(2).strip()
-                cat, _ = classify_entry({"tooth_code": tooth_code, "treatment_code": proc_short})
-                if cat == treatment.type: history_entries.append(entry)
-            else:
-                if entry.procedure_code == treatment.type: history_entries.append(entry)
+    history_entries = [e for e in all_durations if _code_matches_treatment(e.procedure_code, treatment.type)]
 
     grouped = defaultdict(list)
     for e in history_entries: grouped[e.procedure_code].append(e)
 
+    # zwinięta (zarchiwizowana) historia: te same reguły przypisania kodu do zabiegu
+    rolled_up = rollup_duration_counts(cabinet.id)
+    rolled_codes = [c for c in rolled_up if c not in grouped and _code_matches_treatment(c, treatment.type)]
+    for c in rolled_codes: grouped[c] = []
+
+    categories_by_code = dict(
+        db.session.query(ProcedureCode.code, ProcedureCode.category_name)
+        .filter(ProcedureCode.code.in_(list(grouped)))
+    ) if grouped else {}
+
+    def merged_counts(proc_code, durations):
+        hist = dict(rolled_up.get(proc_code, {}))
+        for d in durations:
+            hist[d] = hist.get(d, 0) + 1
+        return hist
+
     history_groups = []
     for proc_code, entries in grouped.items():
-        pc_obj = ProcedureCode.query.get(proc_code)
-        category_name = pc_obj.category_name if pc_obj else treatment.type
+        category_name = categories_by_code.get(proc_code, treatment.type)
         durations_list_for_code = [e.duration for e in entries]
-        ds = sorted(durations_list_for_code); n=len(ds); low=int(n*0.1); high=n-low
-        trimmed = ds[low:high] or ds
-        optimal_for_this_code = int(sum(trimmed)/len(trimmed))
+        optimal_for_this_code = optimal_duration_counts(merged_counts(proc_code, durations_list_for_code))
         history_groups.append({
             "category": category_name, "procedure_code": proc_code,
-            "durations": durations_list_for_code, "optimal": optimal_for_this_code
+            "durations": durations_list_for_code, "optimal": optimal_for_this_code,
+            "archived": sum(rolled_up.get(proc_code, {}).values()),
         })
     history_groups.sort(key=lambda x: (x["category"], x["procedure_code"]))
 
-    used = [e.procedure_code for e in history_entries]
+    used = [e.procedure_code for e in history_entries] + rolled_codes
     codes = sorted(set(seeded + used))
 
     code = request.args.get("procedure_code") or request.form.get("procedure_code")
@@ -1997,15 +4395,14 @@ def add_duration(cabinet_id, treatment_id):
                 cabinet_id=cabinet.id, procedure_code=pc, duration=allocated
             ))
         db.session.commit()
+        invalidate_cabinet_durations(cabinet.id)
 
         first_code = procedure_codes[0] if procedure_codes else None
         return redirect(url_for('add_duration', cabinet_id=cabinet.id, treatment_id=treatment.id, procedure_code=first_code))
 
     optimal = "—"
-    if durations_list:
-        ds = sorted(durations_list); n=len(ds); low=int(n*0.1); high=n-low
-        trimmed = ds[low:high] or ds
-        optimal = int(sum(trimmed)/len(trimmed))
+    if durations_list or rolled_up.get(code):
+        optimal = optimal_duration_counts(merged_counts(code, durations_list))
 
     return render_template_string(
         durations_template,
@@ -2014,9 +4411,48 @@ def add_duration(cabinet_id, treatment_id):
         history_groups=history_groups
     )
 
+@app.route("/admin/cabinets/<cabinet_id>/durations/import", methods=["POST"])
+def import_durations(cabinet_id):
+    cabinet = user_cabinet_or_404(cabinet_id)
+    upload  = request.files.get("file")
+    if not upload or not upload.filename:
+        summary = {"inserted": 0, "rejected": 0, "errors": ["Nie wybrano pliku."]}
+    else:
+        summary = import_code_durations(cabinet.id, upload)
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify(summary)
+
+    types      = catalog().types
+    treatments = Treatment.query.filter_by(cabinet_id=cabinet.id).all()
+    message    = f"Zaimportowano {summary['inserted']} czasów, odrzucono {summary['rejected']}."
+    return render_template_string(
+        treatments_template, cabinet=cabinet, treatments=treatments, types=types,
+        message=message, import_errors=summary["errors"]
+    )
+
+@app.route("/assets/<path:filename>")
+def assets(filename):
+    path = safe_join(ASSET_DIR, filename)
+    if not path or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    accept = request.accept_encodings
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if accept[encoding] and os.path.isfile(path + suffix):
+            response = send_file(path + suffix, mimetype=mimetype, max_age=STATIC_IMMUTABLE_MAX_AGE)
+            response.headers["Content-Encoding"] = encoding
+            break
+    else:
+        response = send_file(path, mimetype=mimetype, max_age=STATIC_IMMUTABLE_MAX_AGE)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route("/debug_image")
 def debug_image():
-    return send_from_directory(app.static_folder, "Lottiimage.png")
+    return send_from_directory(app.static_folder, "Lottiimage.png", max_age=DEBUG_IMAGE_MAX_AGE)
 
 @app.route("/healthz")
 def healthz():
@@ -2026,11 +4462,414 @@ def healthz():
 def __healthz():
     return "", 200
 
+@app.route("/readyz")
+def readyz():
+    """Gotowość do ruchu: rozgrzewka zakończona i baza odpowiada (healthz = proces żyje)."""
+    if not _ready.is_set():
+        return "warming up", 503
+    try:
+        db.session.execute(select(1))
+    except Exception:
+        return "database unavailable", 503
+    return "ready", 200
+
+@app.route("/metrics")
+def metrics():
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if auth != f"Bearer {METRICS_TOKEN}" and request.args.get("token") != METRICS_TOKEN:
+            return "forbidden", 403
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+# -----------------------------------------------------------------------------
+# API JSON
+# -----------------------------------------------------------------------------
+# Dla integracji (np. system recepcji): plan prosto z funkcji rdzenia, bez
+# renderowania szablonu. Uwierzytelnienie tą samą sesją co panel (cookie po /login).
+API_PREFIX = "/api/"
+
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(obj, status=200):
+    return app.response_class(json_dumps(obj), status=status, mimetype="application/json")
+
+
+@app.errorhandler(HTTPException)
+def api_http_error(exc):
+    if request.path.startswith(API_PREFIX):
+        return json_response({"error": exc.name.lower(), "description": exc.description}, exc.code)
+    return exc
+
+
+def _flag(value, default):
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() not in ("0", "false", "no", "off", "")
+
+
+@app.route("/api/plan", methods=["POST"])
+def api_plan():
+    """POST {cabinet_id, input_data, persist=true} -> plan zagregowany, wizyty i koszty."""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        payload = request.form
+    input_data = str(payload.get("input_data") or "").strip()
+    if not input_data:
+        abort(400, description="input_data jest wymagane")
+    cabinet = user_cabinet_or_404(payload.get("cabinet_id"))
+    persist = _flag(request.args.get("persist", payload.get("persist")), True)
+
+    built = build_plan(input_data, load_pricing(cabinet.id))
+    result, visits, plan_text = built.result, built.visits, built.plan_text
+
+    # plan_id = null także przy persist, gdy zapis czeka w kolejce write-behind
+    plan_id = None
+    if persist:
+        plan_id = save_generated_plan(g.user_id, cabinet.id, input_data, plan_text,
+                                      built.input_hash, built.pricing_version, built.tooth_masks, built.stats)
+
+    categories = [
+        {
+            "category":    cat,
+            "teeth":       data.get("teeth", []),
+            "times":       data.get("times", []),
+            "cost":        data.get("cost"),
+            "description": data.get("description"),
+        }
+        for cat, data in result.items()
+    ]
+    return json_response({
+        "cabinet_id":    cabinet.id,
+        "plan_id":       plan_id,
+        "categories":    categories,
+        "visits":        [{k: v[k] for k in VISIT_EXPORT_FIELDS if k in v} for v in visits],
+        "total_cost":    sum(c["cost"] or 0 for c in categories),
+        "total_minutes": sum(v["minutes"] or 0 for v in visits),
+        "plan_text":     plan_text,
+    })
+
+
+@app.route("/api/plans/by-tooth")
+def api_plans_by_tooth():
+    """GET ?tooth=36[&tooth=37][&category=...][&cabinet_id=...][&match=all][&limit=N]"""
+    teeth = request.args.getlist("tooth")
+    bits = 0
+    for tooth in teeth:
+        bit = tooth_bit(tooth)
+        if bit is None:
+            abort(400, description=f"nieprawidłowy numer zęba (FDI 11–48): {tooth}")
+        bits |= bit
+    if not bits:
+        abort(400, description="podaj co najmniej jeden parametr tooth")
+    cabinet_id = request.args.get("cabinet_id")
+    if cabinet_id is not None:
+        cabinet_id = user_cabinet_or_404(cabinet_id).id
+    limit = min(request.args.get("limit", TOOTH_QUERY_LIMIT, type=int), TOOTH_QUERY_LIMIT)
+
+    found = plans_by_teeth(g.user_id, bits, request.args.get("category"), cabinet_id,
+                           request.args.get("match") == "all", limit)
+    ids = [plan_id for plan_id, _ in found]
+    meta = {}
+    if ids:
+        hot = select(GeneratedPlan.id, GeneratedPlan.created_at, GeneratedPlan.cabinet_id) \
+            .where(GeneratedPlan.id.in_(ids))
+        cold = select(ArchivedPlan.id, ArchivedPlan.created_at, ArchivedPlan.cabinet_id) \
+            .where(ArchivedPlan.id.in_(ids))
+        meta = {r.id: r for r in db.session.execute(union_all(hot, cold))}
+    return json_response({
+        "teeth": mask_teeth(bits),
+        "count": len(ids),
+        "plans": [
+            {
+                "id": plan_id,
+                "created_at": meta[plan_id].created_at.isoformat() if plan_id in meta else None,
+                "cabinet_id": meta[plan_id].cabinet_id if plan_id in meta else None,
+                "categories": {cat: mask_teeth(mask) for cat, mask in masks.items()},
+            }
+            for plan_id, masks in found
+        ],
+    })
+
+
+@app.route("/api/plans/<int:plan_id>/teeth")
+def api_plan_teeth(plan_id):
+    rows = PlanToothMask.query.filter(PlanToothMask.plan_id == plan_id, PlanToothMask.user_id == g.user_id,
+                                      PlanToothMask.category != ALL_CATEGORIES).all()
+    if not rows:
+        plan = load_plan_or_404(plan_id)
+        if plan.user_id != g.user_id:
+            abort(404)
+    return json_response({"id": plan_id, "categories": {r.category: mask_teeth(r.mask) for r in rows}})
+
+
+@app.route("/api/plans/<int:plan_id>/revisions")
+def api_plan_revisions(plan_id):
+    """Historia wersji planu; plan nigdy nieedytowany ma jedną wersję – bieżącą."""
+    rows = plan_revisions(plan_id, g.user_id)
+    if not rows:
+        plan = load_plan_or_404(plan_id)
+        if plan.user_id != g.user_id:
+            abort(404)
+        rows = [(1, plan.created_at, True, None)]
+    return json_response({"id": plan_id, "revisions": [
+        {"rev": rev, "created_at": created_at.isoformat(), "snapshot": snapshot, "stored_bytes": size,
+         "current": rev == rows[-1][0]}
+        for rev, created_at, snapshot, size in rows
+    ]})
+
+
+@app.route("/api/plans/<int:plan_id>/revisions/<int:rev>")
+def api_plan_revision(plan_id, rev):
+    revision = materialize_revision(plan_id, g.user_id, rev)
+    if revision is None:
+        plan = load_plan_or_404(plan_id)
+        if plan.user_id != g.user_id or rev != 1 or plan_revisions(plan_id, g.user_id):
+            abort(404)
+        revision = Revision(1, plan.input_data, plan.plan_text, plan.created_at)
+    return json_response({
+        "id": plan_id, "rev": revision.rev, "created_at": revision.created_at.isoformat(),
+        "input_data": revision.input_data, "plan_text": revision.plan_text,
+    })
+
+
+@app.route("/api/dashboard")
+def api_dashboard():
+    """GET ?from=RRRR-MM&to=RRRR-MM[&cabinet_id=..][&top=N] – agregaty gabinetów użytkownika."""
+    def month_arg(name, default):
+        month = request.args.get(name) or default
+        if not re.fullmatch(r"\d{4}-(0[1-9]|1[0-2])", month):
+            abort(400, description=f"{name}: nieprawidłowy miesiąc (RRRR-MM): {month}")
+        return month
+
+    month_to = month_arg("to", datetime.utcnow().strftime("%Y-%m"))
+    month_from = month_arg("from", f"{int(month_to[:4]) - 1}{month_to[4:]}")
+    cabinets = user_cabinets(g.user_id)
+    if request.args.get("cabinet_id"):
+        cabinets = (user_cabinet_or_404(request.args["cabinet_id"]),)
+    top = max(1, min(request.args.get("top", DASHBOARD_TOP_PROCEDURES, type=int), 100))
+    with timed("db"):
+        dash = practice_dashboard([c.id for c in cabinets], month_from, month_to, top)
+    return json_response({
+        "from": month_from, "to": month_to,
+        "cabinets": [
+            {"id": c.id, "name": c.name, "months": dash["monthly"].get(c.id, []),
+             "plans": sum(m["plans"] for m in dash["monthly"].get(c.id, [])),
+             "revenue": sum(m["revenue"] for m in dash["monthly"].get(c.id, []))}
+            for c in cabinets
+        ],
+        "categories": dash["categories"],
+        "top_procedures": dash["top_procedures"],
+    })
+
+
+@app.route("/api/compare", methods=["POST"])
+def api_compare():
+    """POST {input_data} -> wycena karty we wszystkich gabinetach użytkownika, od najtańszej."""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        payload = request.form
+    input_data = str(payload.get("input_data") or "").strip()
+    if not input_data:
+        abort(400, description="input_data jest wymagane")
+    cabinets = user_cabinets(g.user_id)
+    if not cabinets:
+        return json_response({"counts": {}, "quotes": []})
+    with timed("compare"):
+        counts, quotes = compare_cabinet_quotes(cabinets, input_data)
+    return json_response({"counts": counts, "quotes": quotes})
+
+
+def _parse_hhmm(value):
+    h, m = str(value).split(":")
+    minutes = int(h) * 60 + int(m)
+    if not 0 <= minutes <= 24 * 60:
+        raise ValueError(value)
+    return minutes
+
+
+def _chair_json(chair):
+    return {
+        "id": chair.id, "name": chair.name, "doctor": chair.doctor, "active": chair.active,
+        "availability": [
+            {"weekday": a.weekday, "start": f"{a.start_minute // 60:02d}:{a.start_minute % 60:02d}",
+             "end": f"{a.end_minute // 60:02d}:{a.end_minute % 60:02d}"}
+            for a in sorted(chair.availability, key=lambda a: (a.weekday, a.start_minute))
+        ],
+    }
+
+
+def _booking_json(b):
+    return {"id": b.id, "chair_id": b.chair_id, "start": b.start.isoformat(), "end": b.end.isoformat(),
+            "plan_id": b.plan_id, "visit_idx": b.visit_idx, "label": b.label}
+
+
+@app.route("/api/cabinets/<cabinet_id>/chairs", methods=["GET", "POST"])
+def api_chairs(cabinet_id):
+    """GET – fotele gabinetu; POST {name, doctor?, availability: [{weekday, start: "08:00", end: "16:00"}]}."""
+    cabinet = user_cabinet_or_404(cabinet_id)
+    if request.method == "POST":
+        payload = request.get_json(silent=True) or {}
+        if not isinstance(payload, dict):
+            abort(400, description="oczekiwano obiektu JSON")
+        name = str(payload.get("name") or "").strip()
+        if not name:
+            abort(400, description="name jest wymagane")
+        chair = Chair(cabinet_id=cabinet.id, name=name, doctor=payload.get("doctor"))
+        try:
+            for a in payload.get("availability") or []:
+                start, end, weekday = _parse_hhmm(a["start"]), _parse_hhmm(a["end"]), int(a["weekday"])
+                if not (0 <= weekday <= 6 and start < end):
+                    raise ValueError(a)
+                chair.availability.append(ChairAvailability(weekday=weekday, start_minute=start, end_minute=end))
+        except (KeyError, TypeError, ValueError):
+            abort(400, description="availability: oczekiwano [{weekday: 0-6, start: 'HH:MM', end: 'HH:MM'}]")
+        db.session.add(chair); db.session.commit()
+        invalidate_booking_index(cabinet.id)
+        return json_response(_chair_json(chair), 201)
+    chairs = Chair.query.filter_by(cabinet_id=cabinet.id).order_by(Chair.id).all()
+    return json_response({"chairs": [_chair_json(c) for c in chairs]})
+
+
+@app.route("/api/cabinets/<cabinet_id>/schedule", methods=["POST"])
+def api_schedule(cabinet_id):
+    """POST {plan_id | input_data, not_before?: ISO, next_day?: true, book?: false}
+    -> najwcześniejsze terminy dla wizyt planu; book=true zapisuje rezerwacje."""
+    cabinet = user_cabinet_or_404(cabinet_id)
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict):
+        abort(400, description="oczekiwano obiektu JSON")
+    plan_id = payload.get("plan_id")
+    if plan_id is not None:
+        if isinstance(plan_id, bool) or not re.fullmatch(r"\d{1,18}", str(plan_id)):
+            abort(400, description="plan_id: oczekiwano liczby całkowitej")
+        plan_id = int(plan_id)
+        plan = load_plan_or_404(plan_id)
+        if plan.user_id != g.user_id or plan.cabinet_id != cabinet.id:
+            abort(404)
+        input_data = plan.input_data
+    else:
+        input_data = str(payload.get("input_data") or "").strip()
+    if not input_data:
+        abort(400, description="podaj plan_id albo input_data")
+    not_before = payload.get("not_before")
+    if not_before:
+        try:
+            not_before = datetime.fromisoformat(not_before)
+        except (TypeError, ValueError):
+            abort(400, description="not_before: oczekiwano daty ISO 8601")
+        if not_before.tzinfo is not None:
+            # terminarz liczy w lokalnym czasie gabinetu (naiwne daty)
+            not_before = not_before.astimezone().replace(tzinfo=None)
+    else:
+        not_before = None
+
+    visits = build_plan(input_data, load_pricing(cabinet.id)).visits
+    with timed("schedule"):
+        slots, unplaced = schedule_visits(cabinet.id, visits, not_before, _flag(payload.get("next_day"), True))
+    if unplaced is not None:
+        return json_response({
+            "error": f"brak wolnego terminu na {unplaced['label']} ({unplaced['minutes']} min) "
+                     f"w horyzoncie {BOOKING_HORIZON_DAYS} dni",
+            "visit_idx": unplaced["idx"],
+        }, 409)
+    booked = False
+    if _flag(payload.get("book"), False):
+        booked = book_slots(cabinet.id, slots, plan_id)
+        if not booked:
+            return json_response({"error": "termin został w międzyczasie zajęty – spróbuj ponownie"}, 409)
+    return json_response({
+        "booked": booked,
+        "slots": [dict(s, start=s["start"].isoformat(), end=s["end"].isoformat()) for s in slots],
+    })
+
+
+@app.route("/api/cabinets/<cabinet_id>/bookings")
+def api_bookings(cabinet_id):
+    """GET ?from=ISO&to=ISO[&chair_id=..] – rezerwacje gabinetu w przedziale."""
+    cabinet = user_cabinet_or_404(cabinet_id)
+    try:
+        start = datetime.fromisoformat(request.args["from"]) if request.args.get("from") else datetime.now()
+        end = datetime.fromisoformat(request.args["to"]) if request.args.get("to") else start + timedelta(days=7)
+    except ValueError:
+        abort(400, description="from/to: oczekiwano daty ISO 8601")
+    q = (
+        Booking.query.join(Chair, Chair.id == Booking.chair_id)
+        .filter(Chair.cabinet_id == cabinet.id, Booking.start < end, Booking.end > start)
+    )
+    if request.args.get("chair_id"):
+        q = q.filter(Booking.chair_id == request.args.get("chair_id", type=int))
+    return json_response({"bookings": [_booking_json(b) for b in q.order_by(Booking.start)]})
+
+
+@app.route("/api/bookings/<int:booking_id>", methods=["DELETE"])
+def api_delete_booking(booking_id):
+    booking = db.session.get(Booking, booking_id) or abort(404)
+    chair = db.session.get(Chair, booking.chair_id)
+    cabinet = user_cabinet_or_404(chair.cabinet_id)
+    db.session.delete(booking); db.session.commit()
+    invalidate_booking_index(cabinet.id)
+    return json_response({"deleted": booking_id})
+
+
 # -----------------------------------------------------------------------------
 # SEED BAZY
 # -----------------------------------------------------------------------------
+def _ensure_columns(model):
+    """create_all nie zmienia istniejących tabel – brakujące (nullable) kolumny dodajemy ALTER-em."""
+    table = model.__table__
+    existing = {c["name"] for c in db.inspect(db.engine).get_columns(table.name)}
+    with db.engine.begin() as conn:
+        for col in table.columns:
+            if col.name not in existing:
+                ddl = col.type.compile(dialect=db.engine.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{col.name}" {ddl}')
+    for index in table.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def _ensure_sqlite_autoincrement(model, *id_tables):
+    """Przebudowuje tabelę SQLite utworzoną bez AUTOINCREMENT (ALTER tego nie potrafi).
+
+    Licznik sqlite_sequence ustawiany jest ponad największe id także w id_tables
+    (archiwum), żeby nowe wiersze nie dostały id, które już gdzieś istnieje.
+    """
+    table = model.__table__
+    if db.engine.dialect.name != "sqlite" or not table.dialect_options["sqlite"]["autoincrement"]:
+        return
+    with db.engine.begin() as conn:
+        ddl = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+        ).scalar()
+        if "AUTOINCREMENT" in ddl.upper():
+            return
+        tmp = table.to_metadata(db.metadata, name=f"{table.name}_new")
+        try:
+            conn.execute(CreateTable(tmp))
+        finally:
+            db.metadata.remove(tmp)
+        cols = ", ".join(f'"{c.name}"' for c in table.columns)
+        conn.exec_driver_sql(f'INSERT INTO "{tmp.name}" ({cols}) SELECT {cols} FROM "{table.name}"')
+        conn.exec_driver_sql(f'DROP TABLE "{table.name}"')
+        conn.exec_driver_sql(f'ALTER TABLE "{tmp.name}" RENAME TO "{table.name}"')
+        for index in table.indexes:
+            index.create(conn)
+        top = max(conn.execute(select(func.max(t.id))).scalar() or 0 for t in (model, *id_tables))
+        conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = ?", (table.name,))
+        conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, top))
+
+
 with app.app_context():
     db.create_all()
+    _ensure_columns(Cabinet)
+    _ensure_columns(GeneratedPlan)
+    _ensure_sqlite_autoincrement(GeneratedPlan, ArchivedPlan)
     if not User.query.filter_by(username="admin").first():
         u = User(username="admin"); u.set_password("password"); db.session.add(u); db.session.commit()
 
@@ -2057,6 +4896,37 @@ with app.app_context():
         if not ProcedureCode.query.get(code):
             db.session.add(ProcedureCode(code=code, category_name="Mikroskopowe leczenie odtwórcze", default_duration=mins))
     db.session.commit()
+    invalidate_catalog()
+
+# -----------------------------------------------------------------------------
+# ROZGRZEWKA
+# -----------------------------------------------------------------------------
+# Wykonywana przy imporcie modułu, czyli z gunicorn.conf.py (preload_app) raz w
+# masterze przed fork: workery dziedziczą skompilowane szablony, wektoryzator
+# i katalog jako strony współdzielone copy-on-write. gc.freeze() przenosi te
+# obiekty poza śledzenie GC, żeby przebiegi kolektora w workerach ich nie
+# dotykały (zapis nagłówków obiektów kopiowałby strony).
+WARMUP = os.environ.get("WARMUP", "1") != "0"
+_ready = threading.Event()
+
+
+def warm_up():
+    t0 = time.perf_counter()
+    for source in TEMPLATE_SOURCES:
+        compiled_template(source)
+    similarity_model()
+    with app.app_context():
+        catalog()
+    gc.collect()
+    gc.freeze()
+    _ready.set()
+    app.logger.info("Rozgrzewka zakończona w %.0f ms", (time.perf_counter() - t0) * 1e3)
+
+
+if WARMUP:
+    warm_up()
+else:
+    _ready.set()
 
 # -----------------------------------------------------------------------------
 # WSGI alias dla gunicorna
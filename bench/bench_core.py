@@ -0,0 +1,261 @@
+"""Benchmark rdzenia generowania planu (parse/classify/aggregate/visits/format/docx).
+
+Uruchomienie (z katalogu repozytorium):
+
+    python bench/bench_core.py                    # porównanie z bench/baseline.json
+    python bench/bench_core.py --update-baseline  # zapis nowego baseline
+    python bench/bench_core.py --only parse_input --scenario typical
+
+Dla każdej pary (funkcja, scenariusz) raportuje ops/s, p50/p99 oraz alokacje
+(tracemalloc: szczyt i pamięć pozostała po wywołaniu). Kod wyjścia 1
+oznacza regresję względem baseline większą niż --tolerance.
+
+Baseline zależy od maszyny – po zmianie sprzętu/Pythona należy go
+wygenerować ponownie na tej samej maszynie, na której odbywa się porównanie.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# benchmark nie może dotykać produkcyjnej bazy
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import app as lotti  # noqa: E402
+
+BASELINE_PATH = os.path.join(ROOT, "bench", "baseline.json")
+
+TEETH = [f"{q}{n}" for q in "1234" for n in range(1, 9)]
+PROCEDURES = ["MOD", "MO", "OD", "O", "D", "M", "po endo", "brak", "nakład", "korona", "ex", "OMD"]
+
+PRICE_MAP = {
+    "Mikroskopowe leczenie odtwórcze": 500,
+    "Weryfikacja zębów po leczeniu kanałowym": 500,
+    "Odbudowa protetyczna - nakład": 1900,
+    "Odbudowa protetyczna - korona": 2000,
+    "Konsultacja implantologiczna celem odbudowy braku zęba": 250,
+    "Gingiwoplastyka": 300,
+    "Higienizacja": 0,
+    "Do usunięcia": 0,
+}
+PER_TOOTH_MAP = {"Gingiwoplastyka": 150}
+DESC_MAP = {k: "Standardowy opis …" for k in PRICE_MAP}
+DURATION_MAP = {
+    "35 OD": 75, "36 O": 75, "27 OM": 90, "46 O": 45, "36 OD": 60, "46 D": 60, "17 OM": 45,
+}
+CLINIC = {
+    "logo_path": None, "doctor_name": "Jan Kowalski", "clinic_name": "Gabinet Testowy",
+    "street": "Prosta", "flat_number": "1", "postal_code": "00-001", "city": "Warszawa",
+}
+
+
+# -----------------------------------------------------------------------------
+# Generatory syntetycznych kart
+# -----------------------------------------------------------------------------
+def chart_small(rng):
+    return ", ".join(f"{t} {rng.choice(['MOD', 'MO', 'O'])}" for t in rng.sample(TEETH, 3))
+
+def chart_typical(rng):
+    entries = [f"{t} {rng.choice(PROCEDURES)}" for t in rng.sample(TEETH, 12)]
+    entries.append("gingi 11-13")
+    return ", ".join(entries)
+
+def chart_full_mouth(rng):
+    entries = [f"{t} {rng.choice(PROCEDURES)}" for t in TEETH]
+    entries.append("gingi 11-18, 21-28")
+    return ", ".join(entries)
+
+def chart_pathological_gingi(rng):
+    # wielokrotnie powtórzone pełne zakresy – jedna ogromna kategoria do klastrowania
+    ranges = ", ".join(["11-18", "21-28", "31-38", "41-48"] * 8)
+    return f"gingi {ranges}, " + ", ".join(f"{t} MOD" for t in rng.sample(TEETH, 8))
+
+SCENARIOS = {
+    "small": chart_small,
+    "typical": chart_typical,
+    "full_mouth": chart_full_mouth,
+    "pathological_gingi": chart_pathological_gingi,
+}
+
+
+# -----------------------------------------------------------------------------
+# Przypadki benchmarku: (nazwa, przygotowanie(input) -> callable bez argumentów)
+# -----------------------------------------------------------------------------
+def _prepared(text):
+    parsed = lotti.parse_input(text)
+    plan = lotti.aggregate_plan(parsed, PRICE_MAP, DESC_MAP, DURATION_MAP, PER_TOOTH_MAP)
+    plan_text = lotti.format_plan_as_text(plan, PRICE_MAP)
+    return parsed, plan, plan_text
+
+def case_parse_input(text):
+    return lambda: lotti.parse_input(text)
+
+def case_classify_entry(text):
+    parsed = lotti.parse_input(text)
+    classify = lotti.classify_entry
+    return lambda: [classify(e) for e in parsed]
+
+def case_aggregate_plan(text):
+    parsed = lotti.parse_input(text)
+    return lambda: lotti.aggregate_plan(parsed, PRICE_MAP, DESC_MAP, DURATION_MAP, PER_TOOTH_MAP)
+
+def case_generate_visit_plan(text):
+    parsed = lotti.parse_input(text)
+    return lambda: lotti.generate_visit_plan(parsed, DURATION_MAP, PRICE_MAP, PER_TOOTH_MAP)
+
+def case_format_plan_as_text(text):
+    _, plan, _ = _prepared(text)
+    return lambda: lotti.format_plan_as_text(plan, PRICE_MAP)
+
+def case_create_word_doc(text):
+    _, _, plan_text = _prepared(text)
+    return lambda: lotti.create_word_doc(plan_text, CLINIC)
+
+CASES = {
+    "parse_input": case_parse_input,
+    "classify_entry": case_classify_entry,
+    "aggregate_plan": case_aggregate_plan,
+    "generate_visit_plan": case_generate_visit_plan,
+    "format_plan_as_text": case_format_plan_as_text,
+    "create_word_doc": case_create_word_doc,
+}
+
+
+# -----------------------------------------------------------------------------
+# Pomiar
+# -----------------------------------------------------------------------------
+def _percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(q * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+def measure(fn, min_time, min_iters, alloc_iters, rounds=3):
+    for _ in range(3):
+        fn()  # rozgrzewka
+
+    # kilka rund, do porównań brana najlepsza mediana (jak w timeit)
+    samples, best_median = [], None
+    iters_per_round = max(1, -(-min_iters // rounds))
+    for _ in range(rounds):
+        chunk = []
+        started = time.perf_counter()
+        while len(chunk) < iters_per_round or time.perf_counter() - started < min_time / rounds:
+            t0 = time.perf_counter_ns()
+            fn()
+            chunk.append(time.perf_counter_ns() - t0)
+        chunk.sort()
+        median = _percentile(chunk, 0.50)
+        best_median = median if best_median is None else min(best_median, median)
+        samples.extend(chunk)
+    total_s = sum(samples) / 1e9
+    samples.sort()
+
+    # alokacje mierzone osobno – tracemalloc spowalnia wykonanie
+    tracemalloc.start()
+    peak, retained = 0, 0
+    for _ in range(alloc_iters):
+        tracemalloc.reset_peak()
+        cur0 = tracemalloc.get_traced_memory()[0]
+        fn()
+        cur1, peak1 = tracemalloc.get_traced_memory()
+        peak = max(peak, peak1 - cur0)
+        retained += max(0, cur1 - cur0)
+    tracemalloc.stop()
+
+    return {
+        "iterations": len(samples),
+        # ops/s liczone z najlepszej mediany – odporne na przestoje maszyny
+        "ops_per_sec": 1e9 / best_median if best_median else 0.0,
+        "mean_ops_per_sec": len(samples) / total_s if total_s else 0.0,
+        "p50_us": _percentile(samples, 0.50) / 1e3,
+        "p99_us": _percentile(samples, 0.99) / 1e3,
+        "mean_us": statistics.fmean(samples) / 1e3,
+        "peak_alloc_kib": peak / 1024,
+        "retained_kib_per_call": retained / 1024 / max(alloc_iters, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Zwraca listę regresji (ops/s niższe lub p99 wyższe o więcej niż tolerance)."""
+    regressions = []
+    for key, cur in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if cur["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            regressions.append(f"{key}: ops/s {cur['ops_per_sec']:.0f} < baseline {base['ops_per_sec']:.0f}")
+        if cur["p99_us"] > base["p99_us"] * (1 + tolerance) * 2:
+            # p99 jest dużo bardziej zaszumione – osobny, luźniejszy próg
+            regressions.append(f"{key}: p99 {cur['p99_us']:.1f}us > baseline {base['p99_us']:.1f}us")
+    return regressions
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--only", action="append", choices=sorted(CASES), help="tylko wybrane funkcje")
+    ap.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="tylko wybrane scenariusze")
+    ap.add_argument("--seed", type=int, default=1234)
+    ap.add_argument("--min-time", type=float, default=0.3, help="minimalny czas pomiaru na przypadek [s]")
+    ap.add_argument("--min-iters", type=int, default=20)
+    ap.add_argument("--rounds", type=int, default=3)
+    ap.add_argument("--alloc-iters", type=int, default=5)
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--tolerance", type=float, default=0.3, help="dopuszczalny spadek ops/s (ułamek)")
+    ap.add_argument("--update-baseline", action="store_true")
+    ap.add_argument("--json", help="zapisz wyniki do pliku JSON")
+    args = ap.parse_args(argv)
+
+    results = {}
+    for scen_name in args.scenario or SCENARIOS:
+        text = SCENARIOS[scen_name](random.Random(args.seed))
+        for case_name in args.only or CASES:
+            key = f"{case_name}/{scen_name}"
+            results[key] = measure(CASES[case_name](text), args.min_time, args.min_iters,
+                                   args.alloc_iters, args.rounds)
+            r = results[key]
+            print(f"{key:<42} {r['ops_per_sec']:>11.1f} ops/s  p50 {r['p50_us']:>9.1f}us  "
+                  f"p99 {r['p99_us']:>9.1f}us  peak {r['peak_alloc_kib']:>8.1f}KiB  "
+                  f"retained {r['retained_kib_per_call']:>7.1f}KiB")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+
+    if args.update_baseline:
+        doc = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "seed": args.seed,
+            "results": results,
+        }
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(doc, fh, indent=2, sort_keys=True)
+            fh.write("\n")
+        print(f"Zapisano baseline: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("Brak baseline – uruchom z --update-baseline.")
+        return 0
+    with open(args.baseline, encoding="utf-8") as fh:
+        baseline = json.load(fh)
+    regressions = compare(results, baseline.get("results", {}), args.tolerance)
+    if regressions:
+        print("\nREGRESJE:")
+        for line in regressions:
+            print("  " + line)
+        return 1
+    print("\nBrak regresji względem baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""Test różnicowy plannera przyrostowego: wynik po każdej edycji == pełne przeliczenie.
+
+Uruchomienie (z katalogu repozytorium):
+
+    python bench/incremental_plan.py
+    python bench/incremental_plan.py --charts 200 --edits 50 --big-teeth 2000
+
+Dla losowych kart wykonuje serię edycji (zmiana, dodanie, usunięcie wpisu,
+przestawienie fragmentu, zmiana zakresu gingi) i po każdej porównuje agregat,
+wizyty i tekst planu z aggregate_plan/generate_visit_plan/format_plan_as_text.
+Na końcu mierzy koszt pojedynczej edycji dużej karty: pełne przeliczenie vs
+planner. Kod wyjścia 1 oznacza rozbieżność.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import app as lotti  # noqa: E402
+from bench_core import SCENARIOS, TEETH, PROCEDURES, PRICE_MAP, DESC_MAP, PER_TOOTH_MAP, DURATION_MAP  # noqa: E402
+
+PRICING = lotti.Pricing(PRICE_MAP, DESC_MAP, PER_TOOTH_MAP, DURATION_MAP)
+
+
+def full_plan(text):
+    parsed = lotti.parse_input(text)
+    result = lotti.aggregate_plan(parsed, PRICE_MAP, DESC_MAP, DURATION_MAP, PER_TOOTH_MAP)
+    visits = lotti.generate_visit_plan(parsed, DURATION_MAP, PRICE_MAP, PER_TOOTH_MAP)
+    return result, visits, lotti.format_plan_as_text(result, PRICE_MAP)
+
+
+def edit(entries, rng):
+    """Jedna losowa edycja listy wpisów karty (tekstów oddzielanych przecinkami)."""
+    entries = list(entries)
+    op = rng.choice(("change", "add", "remove", "move", "gingi"))
+    if op == "change" and entries:
+        entries[rng.randrange(len(entries))] = f"{rng.choice(TEETH)} {rng.choice(PROCEDURES)}"
+    elif op == "remove" and entries:
+        del entries[rng.randrange(len(entries))]
+    elif op == "move" and len(entries) > 1:
+        i, j = rng.randrange(len(entries)), rng.randrange(len(entries))
+        entries.insert(j, entries.pop(i))
+    elif op == "gingi":
+        a = rng.choice("1234")
+        entries.append(f"gingi {a}{rng.randint(1, 4)}-{a}{rng.randint(5, 8)}")
+    else:
+        entries.insert(rng.randrange(len(entries) + 1), f"{rng.choice(TEETH)} {rng.choice(PROCEDURES)}")
+    return entries
+
+
+def check(args):
+    rng = random.Random(args.seed)
+    mismatches = 0
+    for n in range(args.charts):
+        entries = rng.choice(list(SCENARIOS.values()))(rng).split(", ")
+        plan_id = f"chart-{n}"
+        for _ in range(args.edits):
+            text = ", ".join(entries)
+            built = lotti.plan_incrementally(plan_id, text, PRICING)
+            result, visits, plan_text = full_plan(text)
+            same = (
+                built.result == result and list(built.result) == list(result)
+                and built.visits == visits and built.plan_text == plan_text
+            )
+            same = same and built.tooth_masks == lotti.tooth_masks(lotti.parse_input(text))
+            if not same:
+                mismatches += 1
+                print(f"ROZBIEŻNOŚĆ: {text}")
+            entries = edit(entries, rng)
+        lotti.forget_planner(plan_id)
+    print(f"{args.charts} kart × {args.edits} edycji: rozbieżności {mismatches}")
+    return mismatches
+
+
+def timing(args):
+    rng = random.Random(args.seed)
+    entries = [f"{rng.choice(TEETH)} {rng.choice(PROCEDURES)}" for _ in range(args.big_teeth)]
+    texts = []
+    for _ in range(args.edits):
+        # edycja jednego wpisu karty
+        entries = list(entries)
+        entries[rng.randrange(len(entries))] = f"{rng.choice(TEETH)} {rng.choice(PROCEDURES)}"
+        texts.append(", ".join(entries))
+
+    lotti.plan_incrementally("big", texts[0], PRICING)
+    t0 = time.perf_counter()
+    for text in texts:
+        lotti.plan_incrementally("big", text, PRICING)
+    incremental = (time.perf_counter() - t0) / len(texts)
+    t0 = time.perf_counter()
+    for text in texts:
+        full_plan(text)
+    full = (time.perf_counter() - t0) / len(texts)
+    print(f"karta {args.big_teeth} wpisów, edycja 1 zęba: pełne {full * 1e3:.1f} ms, "
+          f"przyrostowe {incremental * 1e3:.1f} ms (×{full / incremental:.1f})")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--charts", type=int, default=100)
+    ap.add_argument("--edits", type=int, default=30)
+    ap.add_argument("--big-teeth", type=int, default=1000, help="wielkość karty w pomiarze czasu")
+    ap.add_argument("--seed", type=int, default=1234)
+    args = ap.parse_args(argv)
+    mismatches = check(args)
+    timing(args)
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
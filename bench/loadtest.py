@@ -0,0 +1,269 @@
+"""Test obciążeniowy HTTP na lokalnej kopii wdrożenia (gunicorn gthread + tymczasowy SQLite).
+
+Uruchomienie (z katalogu repozytorium):
+
+    python bench/loadtest.py --workers 2 --threads 8 --clients 16 --duration 30
+    python bench/loadtest.py --cabinets 5000 --plans 50000 --json wynik.json
+
+Skrypt:
+  1. tworzy tymczasową bazę i zasila ją realistycznymi wolumenami
+     (użytkownicy, gabinety, zabiegi, historia CodeDuration, GeneratedPlan),
+  2. uruchamia gunicorna z tą bazą (DATABASE_URL),
+  3. współbieżnie wykonuje przepływ: logowanie -> POST / -> /download -> /plans,
+  4. raportuje przepustowość, opóźnienia (p50/p95/p99) i odsetek błędów per krok.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "loadtest"
+
+
+# -----------------------------------------------------------------------------
+# Zasilanie bazy
+# -----------------------------------------------------------------------------
+def seed_database(db_url, args):
+    """Importuje aplikację z tymczasową bazą i wstawia dane hurtowo."""
+    os.environ["DATABASE_URL"] = db_url
+    sys.path.insert(0, ROOT)
+    from bench_core import SCENARIOS, PRICE_MAP, DESC_MAP, PER_TOOTH_MAP, DURATION_MAP
+    import app as lotti
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    with lotti.app.app_context():
+        db = lotti.db
+        # jeden hash dla wszystkich kont – hashowanie tysięcy haseł trwałoby minuty
+        pwd_hash = generate_password_hash(PASSWORD)
+        db.session.execute(insert(lotti.User), [
+            {"username": f"load{u}", "password_hash": pwd_hash} for u in range(args.users)
+        ])
+        user_ids = [u.id for u in lotti.User.query.filter(lotti.User.username.like("load%")).all()]
+
+        db.session.execute(insert(lotti.Cabinet), [{
+            "name": f"Gabinet {c}", "doctor_name": f"Lekarz {c}", "street": "Prosta",
+            "flat_number": str(c % 50), "postal_code": "00-001", "city": "Warszawa",
+            "user_id": user_ids[c % len(user_ids)],
+        } for c in range(args.cabinets)])
+        cabinets = [(c.id, c.user_id) for c in lotti.Cabinet.query.all()]
+
+        treatments = []
+        for cab_id, _ in cabinets:
+            for cat, price in PRICE_MAP.items():
+                row = {"cabinet_id": cab_id, "type": cat, "description": DESC_MAP[cat]}
+                if cat == "Gingiwoplastyka":
+                    row.update(base_price=price, per_tooth_price=PER_TOOTH_MAP[cat])
+                else:
+                    row["price"] = price * rng.uniform(0.8, 1.2)
+                treatments.append(row)
+        db.session.execute(insert(lotti.Treatment), treatments)
+
+        codes = list(DURATION_MAP)
+        db.session.execute(insert(lotti.CodeDuration), [{
+            "cabinet_id": rng.choice(cabinets)[0], "procedure_code": rng.choice(codes),
+            "duration": rng.randint(30, 120), "timestamp": now - timedelta(minutes=rng.randint(0, 500000)),
+        } for _ in range(args.durations)])
+
+        scen = list(SCENARIOS.values())[:3]  # bez patologicznego – nie dominuje w historii
+        plans = []
+        for _ in range(args.plans):
+            cab_id, user_id = rng.choice(cabinets)
+            text = rng.choice(scen)(rng)
+            parsed = lotti.parse_input(text)
+            agg = lotti.aggregate_plan(parsed, PRICE_MAP, DESC_MAP, DURATION_MAP, PER_TOOTH_MAP)
+            plans.append({
+                "user_id": user_id, "cabinet_id": cab_id, "input_data": text,
+                "plan_text": lotti.format_plan_as_text(agg, PRICE_MAP),
+                "created_at": now - timedelta(minutes=rng.randint(0, 500000)),
+            })
+        db.session.execute(insert(lotti.GeneratedPlan), plans)
+        db.session.commit()
+
+    by_user = defaultdict(list)
+    for cab_id, user_id in cabinets:
+        by_user[user_id].append(cab_id)
+    return {f"load{i}": by_user[uid] for i, uid in enumerate(user_ids)}
+
+
+# -----------------------------------------------------------------------------
+# Serwer
+# -----------------------------------------------------------------------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_gunicorn(db_url, port, args, workdir):
+    env = dict(os.environ, DATABASE_URL=db_url)
+    cmd = [
+        sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT, "gunicorn.conf.py"),
+        "-w", str(args.workers), "-k", "gthread",
+        "--threads", str(args.threads), "-b", f"127.0.0.1:{port}", "--chdir", ROOT,
+        "--log-level", "warning", "app:application",
+    ]
+    log = open(os.path.join(workdir, "gunicorn.log"), "w")
+    proc = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn zakończył się (kod {proc.returncode}), log: {log.name}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/readyz", timeout=1):
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("gunicorn nie wystartował w ciągu 60 s")
+
+
+# -----------------------------------------------------------------------------
+# Klient
+# -----------------------------------------------------------------------------
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *a, **kw):
+        return None
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, step, seconds, ok):
+        with self.lock:
+            self.samples[step].append(seconds)
+            if not ok:
+                self.errors[step] += 1
+
+
+def _request(opener, stats, step, url, data=None, expect=(200,)):
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    t0 = time.perf_counter()
+    status = None
+    try:
+        with opener.open(url, data=body, timeout=60) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as exc:
+        status = exc.code
+    except OSError:
+        status = None
+    stats.record(step, time.perf_counter() - t0, status in expect)
+    return status
+
+
+def client_loop(base, username, cabinet_ids, stats, deadline, rng):
+    from bench_core import SCENARIOS
+    scen = [SCENARIOS["small"], SCENARIOS["typical"], SCENARIOS["typical"], SCENARIOS["full_mouth"]]
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), _NoRedirect)
+    _request(opener, stats, "login", f"{base}/login",
+             {"username": username, "password": PASSWORD}, expect=(302,))
+    while time.time() < deadline:
+        form = {"cabinet_id": rng.choice(cabinet_ids), "input_data": rng.choice(scen)(rng)}
+        _request(opener, stats, "POST /", f"{base}/", form)
+        _request(opener, stats, "POST /download", f"{base}/download", form)
+        _request(opener, stats, "GET /plans", f"{base}/plans")
+
+
+def _pct(vals, q):
+    return vals[min(len(vals) - 1, int(q * (len(vals) - 1) + 0.5))] if vals else 0.0
+
+
+def report(stats, elapsed):
+    rows = {}
+    print(f"\n{'krok':<16}{'n':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'błędy %':>9}")
+    for step, vals in stats.samples.items():
+        vals = sorted(vals)
+        row = {
+            "count": len(vals), "rps": len(vals) / elapsed,
+            "p50_ms": _pct(vals, 0.50) * 1e3, "p95_ms": _pct(vals, 0.95) * 1e3,
+            "p99_ms": _pct(vals, 0.99) * 1e3, "max_ms": vals[-1] * 1e3,
+            "error_rate": stats.errors[step] / len(vals),
+        }
+        rows[step] = row
+        print(f"{step:<16}{row['count']:>8}{row['rps']:>9.1f}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}{row['error_rate'] * 100:>9.2f}")
+    total = sum(r["count"] for r in rows.values())
+    print(f"\nłącznie {total} żądań w {elapsed:.1f} s = {total / elapsed:.1f} req/s")
+    return rows
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--clients", type=int, default=16, help="liczba równoległych klientów")
+    ap.add_argument("--duration", type=float, default=30, help="czas trwania [s]")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--cabinets", type=int, default=2000)
+    ap.add_argument("--durations", type=int, default=50000, help="wiersze historii CodeDuration")
+    ap.add_argument("--plans", type=int, default=20000, help="wiersze GeneratedPlan")
+    ap.add_argument("--seed", type=int, default=1234)
+    ap.add_argument("--json", help="zapisz raport do pliku JSON")
+    ap.add_argument("--keep", action="store_true", help="nie usuwaj katalogu tymczasowego")
+    args = ap.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="lotti-load-")
+    db_url = f"sqlite:///{os.path.join(workdir, 'lotti.db')}"
+    proc = None
+    try:
+        t0 = time.time()
+        users = seed_database(db_url, args)
+        print(f"Baza zasilona w {time.time() - t0:.1f} s ({workdir})")
+
+        port = free_port()
+        proc = start_gunicorn(db_url, port, args, workdir)
+        base = f"http://127.0.0.1:{port}"
+
+        stats = Stats()
+        rng = random.Random(args.seed)
+        names = [u for u, cabs in users.items() if cabs]
+        deadline = time.time() + args.duration
+        threads = [
+            threading.Thread(target=client_loop, daemon=True, args=(
+                base, names[i % len(names)], users[names[i % len(names)]],
+                stats, deadline, random.Random(rng.random())))
+            for i in range(args.clients)
+        ]
+        started = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        rows = report(stats, time.time() - started)
+
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as fh:
+                json.dump({"config": vars(args), "steps": rows}, fh, indent=2)
+        return 0 if all(r["error_rate"] == 0 for r in rows.values()) else 1
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+        if args.keep:
+            print(f"Katalog roboczy: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
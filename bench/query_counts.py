@@ -0,0 +1,102 @@
+"""Strażnik N+1: liczba zapytań SQL na stronę nie może rosnąć z liczbą wierszy.
+
+Uruchomienie (z katalogu repozytorium):
+
+    python bench/query_counts.py
+
+Dla każdej strony listującej zasila bazę małym i dużym wolumenem danych,
+liczy zapytania SQL jednego żądania (zdarzenia silnika SQLAlchemy) i kończy
+się kodem 1, jeśli liczby się różnią.
+"""
+import io
+import os
+import sys
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+import app as lotti  # noqa: E402
+from sqlalchemy import event, insert  # noqa: E402
+
+PAGES = [
+    "/",
+    "/plans",
+    "/admin/cabinets",
+    "/admin/cabinets/{cabinet_id}/treatments",
+    "/admin/cabinets/{cabinet_id}/treatments/{treatment_id}/durations",
+]
+
+
+def seed(n_rows):
+    """Czyści dane użytkownika admin i wstawia n_rows gabinetów/planów/czasów."""
+    db = lotti.db
+    with lotti.app.app_context():
+        for model in (lotti.GeneratedPlan, lotti.CodeDuration, lotti.Treatment, lotti.Cabinet):
+            db.session.query(model).delete()
+        user = lotti.User.query.filter_by(username="admin").first()
+        db.session.execute(insert(lotti.Cabinet), [{
+            "name": f"Gabinet {i}", "doctor_name": "Dr", "street": "Prosta", "flat_number": "1",
+            "postal_code": "00-001", "city": "Warszawa", "user_id": user.id,
+        } for i in range(n_rows)])
+        cabinet_id = lotti.Cabinet.query.first().id
+        cabinet_ids = [c.id for c in lotti.Cabinet.query.all()]
+        db.session.execute(insert(lotti.Treatment), [{
+            "cabinet_id": cabinet_id, "type": "Mikroskopowe leczenie odtwórcze",
+            "description": f"opis {i}", "price": 500,
+        } for i in range(n_rows)])
+        treatment_id = lotti.Treatment.query.first().id
+        codes = [pc.code for pc in lotti.ProcedureCode.query.all()]
+        db.session.execute(insert(lotti.CodeDuration), [{
+            "cabinet_id": cabinet_id, "procedure_code": codes[i % len(codes)],
+            "duration": 30 + i % 60, "timestamp": datetime.utcnow(),
+        } for i in range(n_rows)])
+        db.session.execute(insert(lotti.GeneratedPlan), [{
+            "user_id": user.id, "cabinet_id": cabinet_ids[i % len(cabinet_ids)],
+            "input_data": "13 MOD, 14 MO", "plan_text": "plan", "created_at": datetime.utcnow(),
+        } for i in range(n_rows)])
+        db.session.commit()
+    return {"cabinet_id": cabinet_id, "treatment_id": treatment_id}
+
+
+def count_queries(client, url):
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(lotti.Engine, "before_cursor_execute", on_execute)
+    try:
+        resp = client.get(url)
+    finally:
+        event.remove(lotti.Engine, "before_cursor_execute", on_execute)
+    assert resp.status_code == 200, (url, resp.status_code)
+    return len(statements)
+
+
+def main():
+    results = {}
+    for n_rows in (5, 500):
+        ids = seed(n_rows)
+        # nowy klient = nowa sesja, a cache gabinetów per proces trzeba wyczyścić
+        lotti._cabinet_cache.clear()
+        lotti._duration_cache.clear()
+        client = lotti.app.test_client()
+        client.post("/login", data={"username": "admin", "password": "password"})
+        for page in PAGES:
+            url = page.format(**ids)
+            # pierwsze żądanie rozgrzewa cache, mierzone jest drugie
+            count_queries(client, url)
+            results.setdefault(page, []).append(count_queries(client, url))
+
+    failed = False
+    for page, counts in results.items():
+        ok = len(set(counts)) == 1
+        failed |= not ok
+        print(f"{'OK ' if ok else 'N+1'} {page:<70} zapytania: {counts}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
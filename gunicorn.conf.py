@@ -0,0 +1,23 @@
+"""Konfiguracja gunicorna (czytana automatycznie z katalogu roboczego lub przez -c).
+
+Aplikacja jest importowana i rozgrzewana raz w masterze (preload_app), a workery
+dziedziczą ją przez fork – szablony, wektoryzator i katalog zabiegów są
+współdzielone copy-on-write zamiast budowane osobno w każdym workerze.
+Opcje z linii poleceń (-w, --threads, -b) mają pierwszeństwo przed tym plikiem.
+"""
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+preload_app = True
+
+
+def post_fork(server, worker):
+    # połączenia otwarte w masterze (seed, rozgrzewka) nie mogą być współdzielone
+    # między procesami – worker porzuca pulę mastera bez zamykania jej gniazd
+    from app import app, db
+
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -0,0 +1,233 @@
+"""Budowa lokalnego pakietu zasobów frontendu (Bootstrap + FontAwesome) do static/dist.
+
+Uruchomienie (z katalogu repozytorium, zwykle w trakcie budowy obrazu):
+
+    python tools/build_assets.py                        # pobiera przypięte wersje z CDN
+    python tools/build_assets.py --source-dir vendor/   # pliki źródłowe z katalogu lokalnego
+
+Kroki:
+  1. zbiera klasy CSS używane w szablonach (app.py, templates/),
+  2. z Bootstrapa i FontAwesome (tylko styl solid) zostawia wyłącznie reguły,
+     których selektory dotyczą tych klas, i łączy je w jeden plik CSS,
+  3. JS Bootstrapa dołącza tylko, jeśli szablony używają atrybutów data-bs-*,
+  4. zapisuje pliki z hashem treści w nazwie oraz warianty .gz/.br,
+  5. zapisuje static/dist/manifest.json czytany przez aplikację.
+
+Bez manifestu aplikacja nadal linkuje zasoby z CDN.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DIST = os.path.join(ROOT, "static", "dist")
+
+BOOTSTRAP = "https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist"
+FONTAWESOME = "https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.1.1"
+SOURCES = {
+    "bootstrap.min.css": f"{BOOTSTRAP}/css/bootstrap.min.css",
+    "bootstrap.bundle.min.js": f"{BOOTSTRAP}/js/bootstrap.bundle.min.js",
+    "fontawesome.min.css": f"{FONTAWESOME}/css/fontawesome.min.css",
+    "solid.min.css": f"{FONTAWESOME}/css/solid.min.css",
+    "fa-solid-900.woff2": f"{FONTAWESOME}/webfonts/fa-solid-900.woff2",
+    "fa-solid-900.ttf": f"{FONTAWESOME}/webfonts/fa-solid-900.ttf",
+}
+
+# klasy dodawane przez JS Bootstrapa lub warunkowo – nie występują literalnie w szablonach
+SAFELIST = {"show", "fade", "collapsing", "active", "disabled", "was-validated", "is-invalid", "is-valid"}
+
+COMPRESSIBLE = (".css", ".js", ".svg", ".ttf")
+
+
+# -----------------------------------------------------------------------------
+# Źródła
+# -----------------------------------------------------------------------------
+def fetch_sources(source_dir):
+    data = {}
+    for name, url in SOURCES.items():
+        if source_dir:
+            with open(os.path.join(source_dir, name), "rb") as fh:
+                data[name] = fh.read()
+        else:
+            with urllib.request.urlopen(url, timeout=60) as resp:
+                data[name] = resp.read()
+    return data
+
+
+def template_sources():
+    texts = []
+    with open(os.path.join(ROOT, "app.py"), encoding="utf-8") as fh:
+        texts.append(fh.read())
+    tpl_dir = os.path.join(ROOT, "templates")
+    if os.path.isdir(tpl_dir):
+        for name in sorted(os.listdir(tpl_dir)):
+            if name.endswith(".html"):
+                with open(os.path.join(tpl_dir, name), encoding="utf-8") as fh:
+                    texts.append(fh.read())
+    return "\n".join(texts)
+
+
+def used_classes(text):
+    classes = set(SAFELIST)
+    attrs = re.findall(r'class="([^"]*)"', text) + re.findall(r"className\s*=\s*'([^']*)'", text)
+    for attr in attrs:
+        attr = re.sub(r"{[{%].*?[%}]}", " ", attr)  # wstawki Jinja
+        classes.update(tok for tok in attr.split() if re.match(r"^[A-Za-z][\w-]*$", tok))
+    return classes
+
+
+# -----------------------------------------------------------------------------
+# Oczyszczanie CSS
+# -----------------------------------------------------------------------------
+def split_rules(css):
+    """Dzieli CSS na listę (prelude, body); body=None dla at-reguł bez bloku."""
+    rules, i, n = [], 0, len(css)
+    while i < n:
+        brace = css.find("{", i)
+        semi = css.find(";", i)
+        if brace == -1:
+            break
+        if semi != -1 and semi < brace:
+            rules.append((css[i:semi].strip(), None))
+            i = semi + 1
+            continue
+        depth, k, quote = 1, brace + 1, None
+        while depth and k < n:
+            ch = css[k]
+            if quote:
+                if ch == quote and css[k - 1] != "\\":
+                    quote = None
+            elif ch in "\"'":
+                quote = ch
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+            k += 1
+        rules.append((css[i:brace].strip(), css[brace + 1:k - 1]))
+        i = k
+    return rules
+
+
+def selector_used(selector, classes):
+    bare = re.sub(r":not\([^)]*\)", "", selector)
+    needed = re.findall(r"\.(-?[_a-zA-Z][\w-]*)", bare)
+    return all(c in classes for c in needed)
+
+
+def purge(css, classes, fonts):
+    out = []
+    for prelude, body in split_rules(css):
+        if body is None:
+            if not prelude.startswith("@charset"):
+                out.append(prelude + ";")
+            continue
+        if prelude.startswith(("@media", "@supports", "@container", "@layer")):
+            inner = purge(body, classes, fonts)
+            if inner:
+                out.append(f"{prelude}{{{inner}}}")
+        elif prelude.startswith("@font-face"):
+            body = re.sub(r"url\(\.\./webfonts/([^)]+)\)", lambda m: f"url({fonts.get(m.group(1), m.group(1))})", body)
+            out.append(f"{prelude}{{{body}}}")
+        elif prelude.startswith("@"):
+            out.append(f"{prelude}{{{body}}}")
+        else:
+            kept = [s for s in prelude.split(",") if selector_used(s.strip(), classes)]
+            if kept:
+                out.append(",".join(s.strip() for s in kept) + "{" + body.strip() + "}")
+    return "".join(out)
+
+
+def drop_unused_keyframes(css):
+    rules = split_rules(css)
+    names = {m.group(2) for p, _ in rules for m in [re.match(r"@(-webkit-)?keyframes\s+([\w-]+)", p)] if m}
+    body_text = "".join(b or "" for p, b in rules if not p.startswith(("@keyframes", "@-webkit-keyframes")))
+    unused = {n for n in names if not re.search(rf"\b{re.escape(n)}\b", body_text)}
+    return "".join(
+        (f"{p};" if b is None else f"{p}{{{b}}}")
+        for p, b in rules
+        if not any(re.match(rf"@(-webkit-)?keyframes\s+{re.escape(n)}$", p) for n in unused)
+    )
+
+
+def license_banners(css):
+    return "".join(m + "\n" for m in re.findall(r"/\*!.*?\*/", css, flags=re.S))
+
+
+def strip_comments(css):
+    return re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+
+
+# -----------------------------------------------------------------------------
+# Zapis
+# -----------------------------------------------------------------------------
+def write_hashed(logical, data, manifest):
+    stem, ext = os.path.splitext(logical)
+    name = f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+    path = os.path.join(DIST, name)
+    with open(path, "wb") as fh:
+        fh.write(data)
+    if ext in COMPRESSIBLE:
+        with open(path + ".gz", "wb") as fh:
+            fh.write(gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            with open(path + ".br", "wb") as fh:
+                fh.write(brotli.compress(data, quality=11))
+    manifest[logical] = name
+    return name
+
+
+def build(source_dir):
+    src = fetch_sources(source_dir)
+    templates = template_sources()
+    classes = used_classes(templates)
+
+    if os.path.isdir(DIST):
+        shutil.rmtree(DIST)
+    os.makedirs(DIST)
+    manifest = {}
+
+    fonts = {name: write_hashed(name, src[name], manifest) for name in ("fa-solid-900.woff2", "fa-solid-900.ttf")}
+    parts = []
+    for name in ("bootstrap.min.css", "fontawesome.min.css", "solid.min.css"):
+        css = src[name].decode("utf-8")
+        parts.append(license_banners(css) + purge(strip_comments(css), classes, fonts))
+    app_css = drop_unused_keyframes("".join(parts))
+    write_hashed("vendor.css", app_css.encode("utf-8"), manifest)
+
+    if "data-bs-" in templates:
+        write_hashed("vendor.js", src["bootstrap.bundle.min.js"], manifest)
+
+    with open(os.path.join(DIST, "manifest.json"), "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+        fh.write("\n")
+
+    original = sum(len(src[n]) for n in ("bootstrap.min.css", "fontawesome.min.css", "solid.min.css"))
+    print(f"vendor.css: {original / 1024:.0f} KiB -> {len(app_css) / 1024:.0f} KiB "
+          f"({len(classes)} klas używanych w szablonach)")
+    print(f"vendor.js: {'dołączony' if 'vendor.js' in manifest else 'pominięty (brak data-bs-* w szablonach)'}")
+    print(f"manifest: {os.path.join(DIST, 'manifest.json')}")
+    return manifest
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--source-dir", help="katalog z plikami źródłowymi zamiast pobierania z CDN")
+    args = ap.parse_args(argv)
+    build(args.source_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())